@@ -0,0 +1,286 @@
+from database_utils import _split_sql_script
+from date_parsing import DateParser
+from sqlalchemy import BigInteger, Boolean, Date, Float, SmallInteger, String
+from sqlalchemy.dialects.postgresql import UUID
+from table_schemas import TABLE_SCHEMAS
+import argparse
+import datetime
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import re
+import time
+
+
+"""
+Local Analytics
+
+Runs the warehouse SQL (mdrc_data_query.sql, star_schema.sql) on an in-process DuckDB database instead of Postgres,
+so the milestone 4 metrics can be worked on from the cleaned DataFrames or the staged Parquet files alone, with no
+upload and no database server.
+
+Tables are registered in the shape the warehouse gives them: the derived columns of TABLE_SCHEMAS computed the same
+way, and every column cast to the DuckDB equivalent of its Postgres type. The few Postgres-only constructs of the
+scripts are rewritten for DuckDB by POSTGRES_REWRITES.
+
+Usage:
+    python analytics.py [--staging-dir DIR] [--sql PATH ...] [--no-star-schema]
+- Loads every staged table from DIR (default 'staging'), applies star_schema.sql unless --no-star-schema, and prints
+  the result and run time of every query of each script (default mdrc_data_query.sql).
+"""
+
+# DuckDB type of each SQLAlchemy type of TABLE_SCHEMAS, checked in order (Text is a String, FLOAT is 4 bytes in DuckDB)
+DUCKDB_TYPES = (
+    (UUID, 'UUID'),
+    (BigInteger, 'BIGINT'),
+    (SmallInteger, 'SMALLINT'),
+    (String, 'VARCHAR'),
+    (Float, 'DOUBLE'),
+    (Date, 'DATE'),
+    (Boolean, 'BOOLEAN'),
+)
+# Postgres datetime template patterns and their strptime equivalents, longest first
+TIMESTAMP_PATTERNS = (('YYYY', '%Y'), ('HH24', '%H'), ('MM', '%m'), ('DD', '%d'), ('MI', '%M'), ('SS', '%S'))
+# DuckDB function of each Postgres function taking a datetime template as its last argument
+TEMPLATE_FUNCTIONS = {'TO_TIMESTAMP': 'strptime', 'TO_CHAR': 'strftime'}
+# (pattern, replacement) applied in order to every statement before it runs on DuckDB
+POSTGRES_REWRITES = (
+    # TO_TIMESTAMP(text, template) is strptime(text, format), TO_CHAR(datetime, template) strftime(datetime, format).
+    # Only the template literal closing the call is rewritten; the first argument may hold quoted literals and calls
+    # nested one level deep (e.g. CONCAT(year, '-', month)).
+    (re.compile(r"\b(TO_TIMESTAMP|TO_CHAR)\s*\(((?:[^()']|'(?:[^']|'')*'|\((?:[^()']|'(?:[^']|'')*')*\))*?),\s*"
+                r"'((?:YYYY|MM|DD|HH24|MI|SS|[-: /.T])+)'\s*\)", re.IGNORECASE),
+     lambda match: (f"{TEMPLATE_FUNCTIONS[match.group(1).upper()]}({match.group(2)}, "
+                    f"'{_strptime_format(match.group(3))}')")),
+    # '~' matches anywhere in Postgres, but the whole string in DuckDB
+    (re.compile(r"(\w+)\s*~\s*('[^']*')"), r'regexp_matches(\1, \2)'),
+    # A bare DECIMAL is DECIMAL(18, 3) in DuckDB, which would round sums to 3 places before ROUND(..., 2) does
+    (re.compile(r"\bAS\s+decimal\s*\)", re.IGNORECASE), 'AS DECIMAL(38, 10))'),
+)
+
+
+def _strptime_format(template):
+    for pattern, directive in TIMESTAMP_PATTERNS:
+        template = template.replace(pattern, directive)
+    return template
+
+
+def to_duckdb_sql(query):
+    for pattern, replacement in POSTGRES_REWRITES:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def report_differences(expected, actual):
+    """
+    Compares the result of a query on two engines.
+
+    Numbers are compared with a cent of tolerance, as the engines add up sums in a different order and may round the
+    last cent of a total differently. Intervals are compared to 1e-5 of their length: DuckDB averages intervals a few
+    milliseconds away from the exact mean Postgres returns, on means of an hour. Other values must be equal.
+
+    Returns:
+        - str: Description of the first difference, or None if the results match.
+    """
+    if list(expected.columns) != list(actual.columns):
+        return f"columns {list(expected.columns)} != {list(actual.columns)}"
+    if len(expected) != len(actual):
+        return f"{len(expected)} rows != {len(actual)} rows"
+    for column in expected.columns:
+        left = expected[column].to_numpy(dtype=object)
+        right = actual[column].to_numpy(dtype=object)
+        if any(isinstance(value, datetime.timedelta) for value in left):
+            left = pd.to_timedelta(left).total_seconds().to_numpy()
+            right = pd.to_timedelta(right).total_seconds().to_numpy()
+            if not np.allclose(left, right, rtol=1e-5, atol=1e-3, equal_nan=True):
+                return f"column '{column}' differs"
+            continue
+        try:
+            left, right = left.astype(float), right.astype(float)
+        except (TypeError, ValueError):
+            if not (left == right).all():
+                return f"column '{column}' differs"
+            continue
+        if not np.allclose(left, right, rtol=1e-9, atol=0.011, equal_nan=True):
+            return f"column '{column}' differs"
+    return None
+
+
+class LocalAnalytics:
+    """
+    This class holds the warehouse tables in an in-process DuckDB database and runs the warehouse SQL on them.
+
+    The DataFrames are handed to DuckDB as Arrow tables, without a copy for most columns, and the queries run on its
+    vectorized, multi-threaded engine.
+
+    Attributes:
+        database (str): DuckDB database file, ':memory:' (default) to keep the tables in memory only.
+        threads (int): Threads DuckDB runs each query on, None for one per core.
+
+    Methods:
+        1. register(table_name, df, append=False)
+            - Creates the table from a cleaned DataFrame, as DatabaseConnector.upload_to_db would in the warehouse,
+              or appends the rows to it.
+            - Returns:
+                - int: Number of rows registered.
+
+        2. register_staged(staging, table_name)
+            - Creates the table from its files in the staging area, one file at a time.
+
+        3. load_staged(staging, table_names=None)
+            - Registers every table of TABLE_SCHEMAS found in the staging area, or only those of table_names.
+            - Returns:
+                - dict: Number of rows registered per table.
+
+        4. query(query)
+            - Runs a Postgres query, rewritten for DuckDB.
+            - Returns:
+                - DataFrame: The result, with the lower case column names Postgres gives unquoted aliases.
+
+        5. run_sql_file(path)
+            - Runs every statement of a script.
+            - Returns:
+                - list: (label, DataFrame or None, seconds) for each statement.
+
+        6. compare_with(db_connector, path='mdrc_data_query.sql', target='warehouse')
+            - Runs the script here and on the database, and compares the results with report_differences.
+            - Returns:
+                - list: (label, difference or None) for each query.
+
+        7. close()
+            - Closes the database. LocalAnalytics is also a context manager.
+    """
+    def __init__(self, database=':memory:', threads=None):
+        self.database = database
+        self.threads = threads
+        # Parses the dates of every table registered, remembering each distinct string
+        self._date_parser = DateParser()
+        self._connection = duckdb.connect(database)
+        if threads is not None:
+            self._connection.execute(f"SET threads TO {int(threads)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def register(self, table_name, df, append=False):
+        # The same frame upload_to_db writes: the index as a column, derived columns computed, columns in order
+        frame = df.reset_index()
+        schema = TABLE_SCHEMAS.get(table_name)
+        if schema is not None:
+            frame = _parse_dates(schema.prepare(frame), schema, self._date_parser)
+        arrow_table = pa.Table.from_pandas(_text_objects(frame), preserve_index=False)
+        self._connection.register('__frame__', arrow_table)
+        try:
+            if schema is None:
+                columns = '*'
+            else:
+                columns = ', '.join(f'CAST("{column}" AS {_duckdb_type(column_type)}) AS "{column}"'
+                                    for column, column_type in schema.columns.items())
+            if append:
+                self._connection.execute(f'INSERT INTO "{table_name}" SELECT {columns} FROM __frame__')
+            else:
+                self._connection.execute(f'CREATE OR REPLACE TABLE "{table_name}" AS SELECT {columns} FROM __frame__')
+        finally:
+            self._connection.unregister('__frame__')
+        return len(frame)
+
+    def register_staged(self, staging, table_name):
+        rows = 0
+        for staged_data in staging.read_partitions(table_name):
+            rows += self.register(table_name, staged_data, append=rows > 0)
+        return rows
+
+    def load_staged(self, staging, table_names=None):
+        staged = staging.manifest()
+        table_names = table_names or [table_name for table_name in TABLE_SCHEMAS if table_name in staged]
+        return {table_name: self.register_staged(staging, table_name) for table_name in table_names}
+
+    def query(self, query):
+        result = self._connection.execute(to_duckdb_sql(query)).df()
+        # DuckDB keeps the case of unquoted aliases ('Total_sales'), Postgres folds them to lower case
+        result.columns = [column.lower() for column in result.columns]
+        return result
+
+    def run_sql_file(self, path):
+        with open(path) as sql_file:
+            script = sql_file.read()
+        results = []
+        for label, query in _split_sql_script(script):
+            start = time.perf_counter()
+            cursor = self._connection.execute(to_duckdb_sql(query))
+            result = None
+            if cursor.description is not None:
+                result = cursor.df()
+                result.columns = [column.lower() for column in result.columns]
+            results.append((label, result, time.perf_counter() - start))
+        return results
+
+    def compare_with(self, db_connector, path='mdrc_data_query.sql', target='warehouse'):
+        with open(path) as sql_file:
+            script = sql_file.read()
+        differences = []
+        with db_connector.get_engine(target).connect() as connection:
+            # Through the DBAPI cursor, so that a '%' in the query is not taken for a parameter
+            with connection.connection.cursor() as cursor:
+                for label, query in _split_sql_script(script):
+                    cursor.execute(query)
+                    expected = pd.DataFrame(cursor.fetchall(), columns=[column.name for column in cursor.description])
+                    differences.append((label, report_differences(expected, self.query(query))))
+            connection.connection.rollback()
+        return differences
+
+
+def _duckdb_type(column_type):
+    for sql_type, duckdb_type in DUCKDB_TYPES:
+        if isinstance(column_type, sql_type):
+            return duckdb_type
+    raise ValueError(f"No DuckDB type for {column_type!r}")
+
+
+def _parse_dates(frame, schema, date_parser):
+    # Postgres reads dates written in many formats ('1959 May 18', '2005/05/01'), DuckDB only YYYY-MM-DD
+    for column, column_type in schema.columns.items():
+        values = frame[column]
+        if isinstance(column_type, Date) and not pd.api.types.is_datetime64_any_dtype(values.dtype):
+            frame[column] = date_parser.parse(values)
+    return frame
+
+
+def _text_objects(frame):
+    # COPY sends every value as text, so object columns mixing types (numbers and strings) are loaded as text too.
+    # Arrow needs a single type per column. frame is a copy made by register, so it is changed in place.
+    for column in frame.columns:
+        if frame[column].dtype == object:
+            values = frame[column]
+            frame[column] = values.where(values.isna(), values.astype(str))
+    return frame
+
+
+if __name__ == "__main__":
+    from staging import StagingArea
+
+    parser = argparse.ArgumentParser(description="Run the warehouse SQL on the staged tables, without Postgres.")
+    parser.add_argument("--staging-dir", default="staging", help="directory of the staged tables")
+    parser.add_argument("--sql", nargs="+", default=["mdrc_data_query.sql"], help="scripts to run")
+    parser.add_argument("--no-star-schema", action="store_true",
+                        help="do not add the dimension rows of star_schema.sql before running the scripts")
+    args = parser.parse_args()
+    with LocalAnalytics() as analytics:
+        start = time.perf_counter()
+        for table_name, rows in analytics.load_staged(StagingArea(args.staging_dir)).items():
+            print(f"Registered '{table_name}': {rows} rows")
+        if not args.no_star_schema:
+            analytics.run_sql_file('star_schema.sql')
+        print(f"Tables ready in {time.perf_counter() - start:.2f} s")
+        for path in args.sql:
+            for label, result, seconds in analytics.run_sql_file(path):
+                print(f"\n{label} ({seconds * 1000:.1f} ms)")
+                if result is not None:
+                    print(result.to_string(index=False))
@@ -0,0 +1,1269 @@
+"""
+Benchmarks
+
+This script measures the throughput of the pipeline's slow paths against local stand-ins, so that it can be run
+offline without the AWS endpoints or the RDS database.
+
+Benchmarks:
+- store_fetch: DataExtractor.retrieve_stores_data (serial) vs retrieve_stores_data_concurrently against a stub
+  HTTP server with artificial latency.
+- bulk_load: DatabaseConnector.upload_to_db with method='insert' (to_sql) vs method='copy' against the local
+  Postgres described in db_creds_local.yaml.
+- product_weights: DataCleaning._convert_product_weights vs the previous row-by-row iterrows parser on synthetic
+  product weights.
+- phone_numbers: DataCleaning._standardize_phone_numbers vs the previous per-row apply implementation, and the
+  vectorized version alone at 4x the size to check that it scales linearly.
+- card_pdf: DataExtractor.retrieve_pdf_data parsed serially vs on a process pool, on a locally generated
+  multi-hundred-page card details PDF. Requires Java, like tabula itself.
+- cleaning: every DataCleaning entry point (clean_user_data, clean_card_data, clean_store_data,
+  clean_product_data, clean_orders_data, clean_time) on seeded synthetic data from synthetic_data.py, at each
+  --sizes row count. Reports rows/sec, peak traced memory and the number of memory blocks the result keeps alive,
+  and compares rows/sec with a stored baseline, flagging slowdowns beyond REGRESSION_THRESHOLD.
+- products_stream: DataExtractor.stream_s3_csv feeding clean_product_data chunk by chunk, on synthetic products
+  CSVs of each --csv-mb size, from a local path and from an in-process S3 stand-in with parallel range reads. Each
+  run happens in a fresh process, so its peak RSS shows memory staying flat as the file grows. Whole-file
+  pd.read_csv is measured alongside for the files up to FULL_READ_LIMIT_MB.
+- date_times_json: DataExtractor.extract_s3_json, decoding the JSON incrementally into typed columns, vs the
+  previous json.load + DataFrame.from_dict path, each followed by clean_time, on a local column-oriented JSON fixture.
+  Each run happens in a fresh process to report its peak RSS; the cleaned results are checked for equality first.
+- compact_dtypes: the memory of each cleaned table with the default object dtypes vs compact mode
+  (compact_dtypes.py), checking that both modes produce the same values.
+- schema_on_load: every table loaded the way star_schema.sql used to type it (as TEXT, then rewritten by
+  ALTER TABLE ... TYPE, the latitude merge and the product UPDATEs, kept here as LEGACY_CASTS) vs loaded in its final
+  shape with table_schemas.py, against the local Postgres. Checks that both give the same column types and rows.
+- keys: a synthetic star schema loaded into a separate 'benchmark_keys' Postgres schema, the mdrc_data_query.sql
+  queries run with EXPLAIN ANALYZE on the freshly loaded tables (no keys, indexes or statistics), and again after
+  DatabaseConnector.create_primary_keys, create_indexes, create_foreign_keys and analyze. Reports the key building
+  times and, per query, the execution time and the scan and join nodes of both plans.
+- parallel_cleaning: every DataCleaning entry point run serially vs on PartitionedCleaner (parallel_cleaning.py)
+  with 1, 2 and 4 workers, checking that each partitioned result is exactly the serial one. Speedups are relative to
+  the serial run, and can only approach the worker count on a machine with at least that many cores.
+- rollups: a synthetic star schema loaded into a separate 'benchmark_rollups' Postgres schema, the sales rollups
+  (rollups.py) built, then refreshed after appending orders, and rebuilt. Checks after each step that every
+  SalesRollups report matches the result of its mdrc_data_query.sql query, then times both.
+- analytics: a synthetic star schema uploaded to a separate 'benchmark_analytics' Postgres schema and queried with
+  mdrc_data_query.sql, the way main.py builds the warehouse, vs registered in an in-process DuckDB database by
+  LocalAnalytics (analytics.py) and queried there. Checks that both give the same results, then reports the load
+  time, the end-to-end time and the time of every query.
+- incremental_orders: a synthetic legacy orders table in a separate 'benchmark_incremental' Postgres schema loaded in
+  full, then appended batches of new orders, each loaded by IncrementalLoader.append (incremental_load.py). Checks
+  that every source row ends up in orders_table exactly once, and compares each append with the full load.
+- dimension_upsert: a synthetic star schema loaded into a separate 'benchmark_upsert' Postgres schema, the row
+  fingerprints of dim_date_times recorded, then the table upserted by DimensionUpserter (dimension_upsert.py) with
+  the same rows, and with a next extraction changing, adding and deleting rows. Checks the reported counts and that
+  the table ends up with the rows of a full reload, then compares the upsert with a full reload and its keys.
+- date_parsing: each store, user and card date column, 10M rows mixing the formats of the sources, parsed by
+  DateParser (date_parsing.py), then a second chunk parsed by the same DateParser, vs the first 1M rows parsed the
+  way DataCleaning used to (pd.to_datetime with an inferred or fixed format). Checks that every date parsed before
+  is parsed the same, and reports the rows/s and the share of rows each approach parsed.
+- cli_startup: the time main.py takes to start, each in a fresh interpreter: --help and --dry-run, a run of every
+  command up to its first stage, then the sources its stage imports, vs the modules main.py used to import up front
+  (LEGACY_STARTUP_IMPORTS). The list_db_tables round trip to RDS the old startup also made is not included.
+
+Usage:
+    python benchmarks.py [benchmark ...] [--sizes 10000 100000 ...] [--baseline PATH] [--save-baseline]
+                         [--csv-mb 256 1024 ...]
+
+Running the cleaning benchmark exits with status 1 when a regression against the baseline is found.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import re
+import resource
+import numpy as np
+import pandas as pd
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import warnings
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _start_stub_store_api(number_of_stores, latency):
+    class StubStoreHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)
+            if self.path == '/number_stores':
+                body = {'statusCode': 200, 'number_stores': number_of_stores}
+            else:
+                store_number = int(self.path.rsplit('/', 1)[-1])
+                body = {'index': store_number, 'store_code': f'ST-{store_number:06d}', 'staff_numbers': '12',
+                        'opening_date': '2010-06-12', 'store_type': 'Local', 'country_code': 'GB',
+                        'continent': 'Europe', 'locality': 'High Wycombe'}
+            payload = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubStoreHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def benchmark_store_fetch(number_of_stores=200, latency=0.02, max_workers=16):
+    from data_extraction import DataExtractor
+
+    server = _start_stub_store_api(number_of_stores, latency)
+    store_endpoint = f"http://127.0.0.1:{server.server_address[1]}/store_details/{{store_number}}"
+    header = {'x-api-key': 'benchmark'}
+    extractor = DataExtractor(db_connector=None)
+    try:
+        serial_df, serial_time = _timed(extractor.retrieve_stores_data, store_endpoint, header, number_of_stores)
+        concurrent_df, concurrent_time = _timed(extractor.retrieve_stores_data_concurrently, store_endpoint, header,
+                                                number_of_stores, max_workers=max_workers)
+    finally:
+        server.shutdown()
+    assert serial_df.equals(concurrent_df), "Concurrent fetch does not match the serial result"
+    print(f"store_fetch: {number_of_stores} stores, {latency * 1000:.0f} ms latency")
+    print(f"  serial:     {serial_time:.2f} s")
+    print(f"  concurrent: {concurrent_time:.2f} s ({max_workers} workers, {serial_time / concurrent_time:.1f}x)")
+
+
+
+def benchmark_bulk_load(rows=200000):
+    from data_cleaning import DataCleaning
+    from database_utils import DatabaseConnector
+    from synthetic_data import generate_orders
+
+    orders = DataCleaning().clean_orders_data(generate_orders(rows))
+    connector = DatabaseConnector()
+    _, insert_time = _timed(connector.upload_to_db, orders, 'benchmark_orders', method='insert')
+    _, copy_time = _timed(connector.upload_to_db, orders, 'benchmark_orders', method='copy')
+    print(f"bulk_load: {rows} rows")
+    print(f"  to_sql: {insert_time:.2f} s ({rows / insert_time:,.0f} rows/s)")
+    print(f"  COPY:   {copy_time:.2f} s ({rows / copy_time:,.0f} rows/s, {insert_time / copy_time:.1f}x)")
+    connector.close_connection()
+
+
+def _legacy_convert_product_weights(df):
+    # The iterrows implementation that _convert_product_weights replaced, kept as the reference
+    decimal_of_kg = []
+    for index, row in df.iterrows():
+        weight = str(row['weight']).strip('.')
+        weight = str(weight).strip('l')
+        weight = str(weight).strip()
+        if weight.endswith('kg'):
+            decimal_of_kg.append(float(weight[:-2]))
+        elif 'x' in weight:
+            num, unit = weight.split('x')
+            decimal_of_kg.append(float(num) * float(unit.rstrip('g')) / 1000)
+        elif weight.endswith('g'):
+            decimal_of_kg.append(float(weight[:-1]) / 1000)
+        elif weight.endswith('oz'):
+            decimal_of_kg.append(float(weight[:-2]) * 0.0283)
+        elif weight.endswith('m'):
+            decimal_of_kg.append(float(weight[:-1]) / 1000)
+        else:
+            decimal_of_kg.append(float(weight))
+    df.loc[:, 'weight'] = decimal_of_kg
+    return df
+
+
+def _synthetic_weights(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(1, 2000, rows)
+    formats = ['{}g', '{}kg', '{}ml', '{}oz', '{} x {}g', '{}g .', '{}']
+    choices = rng.integers(0, len(formats), rows)
+    return pd.DataFrame({'weight': [
+        formats[choice].format(value % 24 + 2, value) if choice == 4 else formats[choice].format(value)
+        for choice, value in zip(choices, values)
+    ]})
+
+
+def benchmark_product_weights(rows=1000000):
+    from data_cleaning import DataCleaning
+
+    products = _synthetic_weights(rows)
+    legacy, legacy_time = _timed(_legacy_convert_product_weights, products.copy())
+    vectorized, vectorized_time = _timed(DataCleaning()._convert_product_weights, products.copy())
+    assert np.array_equal(legacy['weight'].astype(float), vectorized['weight'].astype(float)), \
+        "Vectorized weights do not match the iterrows parser"
+    print(f"product_weights: {rows} rows")
+    print(f"  iterrows:   {legacy_time:.2f} s ({rows / legacy_time:,.0f} rows/s)")
+    print(f"  vectorized: {vectorized_time:.2f} s ({rows / vectorized_time:,.0f} rows/s, "
+          f"{legacy_time / vectorized_time:.1f}x)")
+
+
+def _legacy_standardize_phone_numbers(df):
+    # The per-row apply implementation that _standardize_phone_numbers replaced, kept as the reference
+    df['phone_number'] = df.apply(lambda row: re.sub(fr'^\+44|^\+49|^{row["country_code"]}', '', row['phone_number']), axis=1)
+    df['phone_number'] = df['phone_number'].apply(lambda phone: re.sub(r'\D', '', phone))
+    df['phone_number'] = df['phone_number'].apply(lambda phone: '0' + phone if not phone.startswith('0') else phone)
+    return df
+
+
+def _synthetic_phone_numbers(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    formats = ['+44(0){}', '0{} 960', '+49(0)30 {}', '(030) {}', '+1-{}-0100', '001-{}x123', '({}) 555-0101']
+    choices = rng.integers(0, len(formats), rows)
+    numbers = rng.integers(1000, 99999, rows)
+    return pd.DataFrame({
+        'phone_number': [formats[choice].format(number) for choice, number in zip(choices, numbers)],
+        'country_code': rng.choice(['GB', 'DE', 'US'], rows),
+    })
+
+
+def benchmark_phone_numbers(rows=1000000):
+    from data_cleaning import DataCleaning
+
+    users = _synthetic_phone_numbers(rows)
+    legacy, legacy_time = _timed(_legacy_standardize_phone_numbers, users.copy())
+    vectorized, vectorized_time = _timed(DataCleaning()._standardize_phone_numbers, users.copy())
+    assert legacy.equals(vectorized), "Vectorized phone numbers do not match the per-row implementation"
+    _, scaled_time = _timed(DataCleaning()._standardize_phone_numbers, _synthetic_phone_numbers(4 * rows, seed=1))
+    print(f"phone_numbers: {rows} rows")
+    print(f"  apply:      {legacy_time:.2f} s ({rows / legacy_time:,.0f} rows/s)")
+    print(f"  vectorized: {vectorized_time:.2f} s ({rows / vectorized_time:,.0f} rows/s, "
+          f"{legacy_time / vectorized_time:.1f}x)")
+    print(f"  vectorized at {4 * rows} rows: {scaled_time:.2f} s ({4 * rows / scaled_time:,.0f} rows/s)")
+
+
+def _write_synthetic_card_pdf(path, pages, rows_per_page=45, seed=0):
+    # Writes a minimal PDF by hand: one text table per page, laid out in fixed columns that tabula can detect
+    rng = np.random.default_rng(seed)
+    columns = [('card_number', 50), ('expiry_date', 200), ('card_provider', 290), ('date_payment_confirmed', 430)]
+    providers = ['VISA 16 digit', 'JCB 16 digit', 'Mastercard', 'Diners Club / Carte Blanche']
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    page_ids = []
+    for page in range(pages):
+        lines = [[name for name, _ in columns]]
+        for _ in range(rows_per_page):
+            lines.append([str(rng.integers(10 ** 15, 10 ** 16)), f'{rng.integers(1, 13):02d}/{rng.integers(22, 30)}',
+                          providers[rng.integers(0, len(providers))],
+                          f'{rng.integers(2000, 2023)}-{rng.integers(1, 13):02d}-{rng.integers(1, 29):02d}'])
+        content = []
+        for row, values in enumerate(lines):
+            for (_, x), value in zip(columns, values):
+                content.append(f'BT /F1 9 Tf {x} {800 - row * 16} Td ({value}) Tj ET')
+        stream = '\n'.join(content).encode()
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> '
+                       b'/Contents %d 0 R >>' % len(objects))
+        page_ids.append(len(objects))
+    kids = ' '.join(f'{page_id} 0 R' for page_id in page_ids).encode()
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, pages)
+    with open(path, 'wb') as pdf_file:
+        pdf_file.write(b'%PDF-1.4\n')
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(pdf_file.tell())
+            pdf_file.write(b'%d 0 obj\n%s\nendobj\n' % (number, body))
+        xref_offset = pdf_file.tell()
+        pdf_file.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+        for offset in offsets:
+            pdf_file.write(b'%010d 00000 n \n' % offset)
+        pdf_file.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref_offset))
+
+
+def benchmark_card_pdf(pages=300, workers=4):
+    from data_extraction import DataExtractor
+
+    handle, pdf_path = tempfile.mkstemp(suffix='.pdf')
+    os.close(handle)
+    try:
+        _write_synthetic_card_pdf(pdf_path, pages)
+        extractor = DataExtractor(db_connector=None)
+        serial_df, serial_time = _timed(extractor.retrieve_pdf_data, pdf_path)
+        parallel_df, parallel_time = _timed(extractor.retrieve_pdf_data, pdf_path, workers=workers)
+    finally:
+        os.remove(pdf_path)
+    assert serial_df.equals(parallel_df), "Parallel PDF extraction does not match the serial result"
+    print(f"card_pdf: {pages} pages, {len(serial_df)} rows")
+    print(f"  serial:   {serial_time:.2f} s")
+    print(f"  parallel: {parallel_time:.2f} s ({workers} workers, {serial_time / parallel_time:.1f}x)")
+
+
+CLEANING_GENERATORS = {
+    'clean_user_data': 'generate_users',
+    'clean_card_data': 'generate_cards',
+    'clean_store_data': 'generate_stores',
+    'clean_product_data': 'generate_products',
+    'clean_orders_data': 'generate_orders',
+    'clean_time': 'generate_date_times',
+}
+DEFAULT_SIZES = [10000, 100000, 1000000]
+BASELINE_PATH = 'benchmark_baseline.json'
+# A method is reported as a regression when its rows/sec drops by more than this fraction of the baseline
+REGRESSION_THRESHOLD = 0.2
+
+
+def _measure_cleaning(method_name, data, repeat):
+    from data_cleaning import DataCleaning
+
+    method = getattr(DataCleaning(), method_name)
+    # Time without tracemalloc first, since tracing slows allocation-heavy code down, keeping the best of the runs
+    elapsed = min(_timed(method, data.copy())[1] for _ in range(repeat))
+    data = data.copy()
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    result = method(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained_blocks = sys.getallocatedblocks() - blocks_before
+    del result
+    return {'rows_per_sec': len(data) / elapsed, 'seconds': elapsed, 'peak_mb': peak / 1024 ** 2,
+            'retained_blocks': retained_blocks}
+
+
+def benchmark_cleaning(sizes=DEFAULT_SIZES, baseline_path=BASELINE_PATH, save_baseline=False):
+    import synthetic_data
+
+    with open(baseline_path) if os.path.exists(baseline_path) else open(os.devnull) as baseline_file:
+        baseline = json.loads(baseline_file.read() or '{}')
+    results = {}
+    regressions = []
+    print(f"{'method':<20} {'rows':>10} {'rows/s':>12} {'peak MB':>9} {'blocks':>10} {'vs baseline':>12}")
+    for method_name, generator_name in CLEANING_GENERATORS.items():
+        generate = getattr(synthetic_data, generator_name)
+        results[method_name] = {}
+        for rows in sizes:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                measurement = _measure_cleaning(method_name, generate(rows), repeat=3 if rows <= 1000000 else 1)
+            results[method_name][str(rows)] = measurement
+            reference = baseline.get(method_name, {}).get(str(rows))
+            change = ''
+            if reference:
+                ratio = measurement['rows_per_sec'] / reference['rows_per_sec']
+                change = f"{(ratio - 1) * 100:+.0f}%"
+                if ratio < 1 - REGRESSION_THRESHOLD:
+                    change += ' REGRESSION'
+                    regressions.append((method_name, rows))
+            print(f"{method_name:<20} {rows:>10} {measurement['rows_per_sec']:>12,.0f} "
+                  f"{measurement['peak_mb']:>9.1f} {measurement['retained_blocks']:>10} {change:>12}")
+    if save_baseline:
+        for method_name, measurements in results.items():
+            baseline.setdefault(method_name, {}).update(measurements)
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+    return not regressions
+
+
+def _assert_same_values(default, compact):
+    assert list(default.columns) == list(compact.columns) and default.index.equals(compact.index)
+    for column in default.columns:
+        if default[column].dtype == object:
+            # Text the compact mode turned into integers, such as staff_numbers, is compared as text
+            left = default[column].astype(str)
+            right = compact[column].astype(object).where(compact[column].notna(), None).astype(str)
+            right = right.where(default[column].notna(), left)
+            assert (left == right).all(), f"Compact mode changed the values of '{column}'"
+        else:
+            pd.testing.assert_series_equal(default[column], compact[column].astype(default[column].dtype))
+
+
+def benchmark_compact_dtypes(rows=1000000):
+    from compact_dtypes import compact_frame, memory_bytes
+    from data_cleaning import DataCleaning
+    import synthetic_data
+
+    print(f"compact_dtypes: {rows} rows")
+    for method_name, generator_name in CLEANING_GENERATORS.items():
+        raw = getattr(synthetic_data, generator_name)(rows)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            default, default_time = _timed(getattr(DataCleaning(), method_name), raw.copy())
+            compact, compact_time = _timed(getattr(DataCleaning(compact=True), method_name), compact_frame(raw))
+        _assert_same_values(default, compact)
+        default_bytes, compact_bytes = memory_bytes(default), memory_bytes(compact)
+        print(f"  {method_name:<20} {default_bytes / 1024 ** 2:8.1f} MB -> {compact_bytes / 1024 ** 2:7.1f} MB "
+              f"({default_bytes / compact_bytes:.1f}x smaller), cleaned in {default_time:.2f} s -> {compact_time:.2f} s")
+
+
+def _start_stub_s3(objects):
+    # Serves HEAD and (ranged) GET for path-style s3 requests, /bucket/key, from local files
+    class StubS3Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _object(self):
+            path = objects.get(self.path.split('?', 1)[0].lstrip('/'))
+            if path is None:
+                self.send_error(404)
+            return path
+
+        def do_HEAD(self):
+            path = self._object()
+            if path:
+                self.send_response(200)
+                self.send_header('Content-Length', str(os.path.getsize(path)))
+                self.send_header('ETag', f'"{int(os.path.getmtime(path))}"')
+                self.end_headers()
+
+        def do_GET(self):
+            path = self._object()
+            if not path:
+                return
+            size = os.path.getsize(path)
+            first_byte, last_byte = 0, size - 1
+            ranged = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if ranged:
+                first_byte = int(ranged.group(1))
+                last_byte = min(int(ranged.group(2) or size - 1), size - 1)
+            self.send_response(206 if ranged else 200)
+            self.send_header('Content-Length', str(last_byte - first_byte + 1))
+            if ranged:
+                self.send_header('Content-Range', f'bytes {first_byte}-{last_byte}/{size}')
+            self.end_headers()
+            with open(path, 'rb') as object_file:
+                object_file.seek(first_byte)
+                remaining = last_byte - first_byte + 1
+                while remaining:
+                    block = object_file.read(min(remaining, 1024 * 1024))
+                    self.wfile.write(block)
+                    remaining -= len(block)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubS3Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _write_synthetic_products_csv(path, megabytes, block_rows=100000):
+    # Repeats one block of synthetic products until the file reaches the requested size
+    from synthetic_data import generate_products
+
+    block = generate_products(block_rows).to_csv(header=False)
+    header = ',' + ','.join(generate_products(1).columns) + '\n'
+    with open(path, 'w') as csv_file:
+        csv_file.write(header)
+        while csv_file.tell() < megabytes * 1024 ** 2:
+            csv_file.write(block)
+
+
+def _peak_rss_mb():
+    # VmHWM starts again from zero after exec, unlike ru_maxrss, which keeps the peak of the forking parent
+    with open('/proc/self/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_products_stream(address, workers, full_read, environment):
+    # Runs in a fresh process, so that the peak RSS is the peak of this run alone
+    os.environ.update(environment)
+    from data_cleaning import DataCleaning
+    from data_extraction import DataExtractor
+    from instrumentation import instrumentation
+
+    instrumentation.enabled = False
+    cleaner = DataCleaning()
+    start = time.perf_counter()
+    rows = 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if full_read:
+            rows = len(cleaner.clean_product_data(pd.read_csv(address, index_col=0)))
+        else:
+            for chunk in DataExtractor(db_connector=None).stream_s3_csv(address, workers=workers):
+                rows += len(cleaner.clean_product_data(chunk))
+    return rows, time.perf_counter() - start, _peak_rss_mb()
+
+
+# Whole-file reads of larger CSVs would not fit in memory next to the streamed runs
+FULL_READ_LIMIT_MB = 512
+
+
+def _run_date_times_json(path, incremental):
+    # Runs in a fresh process, so that the peak RSS is the peak of this run alone
+    from data_cleaning import DataCleaning
+    from data_extraction import DataExtractor
+    from instrumentation import instrumentation
+
+    instrumentation.enabled = False
+    start = time.perf_counter()
+    if incremental:
+        time_data = DataExtractor(db_connector=None).extract_s3_json(path)
+    else:
+        # The previous implementation of extract_s3_json
+        with open(path) as json_file:
+            time_data = pd.DataFrame.from_dict(json.load(json_file))
+    rows = len(DataCleaning().clean_time(time_data))
+    return rows, time.perf_counter() - start, _peak_rss_mb()
+
+
+def benchmark_date_times_json(rows=1000000):
+    from data_cleaning import DataCleaning
+    from data_extraction import DataExtractor
+    from synthetic_data import generate_date_times
+
+    handle, path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        generate_date_times(100000).to_json(path)
+        with open(path) as json_file:
+            previous = DataCleaning().clean_time(pd.DataFrame.from_dict(json.load(json_file)))
+        incremental = DataCleaning().clean_time(DataExtractor(db_connector=None).extract_s3_json(path))
+        pd.testing.assert_frame_equal(previous, incremental, check_dtype=False, check_categorical=False)
+        generate_date_times(rows).to_json(path)
+        print(f"date_times_json: {rows} rows, {os.path.getsize(path) / 1024 ** 2:.0f} MB of JSON")
+        print(f"  {'parser':<28} {'seconds':>8} {'peak RSS MB':>12}")
+        for label, incremental in [('json.load + from_dict', False), ('incremental, typed columns', True)]:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                _, seconds, peak_mb = executor.submit(_run_date_times_json, path, incremental).result()
+            print(f"  {label:<28} {seconds:>8.1f} {peak_mb:>12.0f}")
+    finally:
+        os.remove(path)
+
+
+def benchmark_products_stream(sizes_mb=(256, 1024, 2048), workers=4):
+    directory = tempfile.mkdtemp()
+    server = _start_stub_s3({f'benchmark-bucket/products_{size}.csv': os.path.join(directory, f'products_{size}.csv')
+                             for size in sizes_mb})
+    # boto3 reads the endpoint and the (dummy) credentials from the environment
+    environment = {'AWS_ENDPOINT_URL_S3': f'http://127.0.0.1:{server.server_port}', 'AWS_ACCESS_KEY_ID': 'benchmark',
+                   'AWS_SECRET_ACCESS_KEY': 'benchmark', 'AWS_DEFAULT_REGION': 'us-east-1'}
+    print(f"products_stream: {workers} range reads in flight for s3")
+    print(f"{'CSV MB':>8} {'source':<22} {'rows':>11} {'seconds':>8} {'peak RSS MB':>12}")
+    try:
+        for size in sizes_mb:
+            path = os.path.join(directory, f'products_{size}.csv')
+            _write_synthetic_products_csv(path, size)
+            runs = [('local', path, 1, False), ('s3 stand-in', f's3://benchmark-bucket/products_{size}.csv', workers,
+                                                False)]
+            if size <= FULL_READ_LIMIT_MB:
+                runs.append(('local, whole file', path, 1, True))
+            for label, address, run_workers, full_read in runs:
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    rows, seconds, peak_mb = executor.submit(_run_products_stream, address, run_workers, full_read,
+                                                             environment).result()
+                print(f"{size:>8} {label:<22} {rows:>11,} {seconds:>8.1f} {peak_mb:>12.0f}")
+            os.remove(path)
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# Tasks 1 to 7 of star_schema.sql before the column types moved to table_schemas.py, with '{table}' for the table
+# name. Two statements are corrected so that the script runs and matches the registry: the still_available CASE
+# accepts the 'Still_avaliable' spelling of the source, and the casts to DATE that lacked a USING clause have one.
+LEGACY_CASTS = {
+    'orders_table': """
+        ALTER TABLE {table}
+        ALTER COLUMN date_uuid TYPE UUID USING date_uuid::UUID,
+        ALTER COLUMN user_uuid TYPE UUID USING user_uuid::UUID,
+        ALTER COLUMN card_number TYPE VARCHAR(19),
+        ALTER COLUMN store_code TYPE VARCHAR(12),
+        ALTER COLUMN product_code TYPE VARCHAR(12),
+        ALTER COLUMN product_quantity TYPE SMALLINT;""",
+    'dim_users': """
+        ALTER TABLE {table}
+        ALTER COLUMN first_name TYPE VARCHAR(255),
+        ALTER COLUMN last_name TYPE VARCHAR(255),
+        ALTER COLUMN country_code TYPE VARCHAR(2),
+        ALTER COLUMN date_of_birth TYPE DATE USING date_of_birth::DATE,
+        ALTER COLUMN join_date TYPE DATE USING join_date::DATE,
+        ALTER COLUMN user_uuid TYPE UUID USING user_uuid::UUID;""",
+    'dim_store_details': """
+        ALTER TABLE {table} ADD COLUMN merged_latitude TEXT NULL;
+        UPDATE {table} SET merged_latitude = NULLIF(CONCAT(lat, '', latitude), '');
+        ALTER TABLE {table} DROP lat, DROP COLUMN latitude;
+        ALTER TABLE {table} RENAME COLUMN merged_latitude TO latitude;
+        ALTER TABLE {table}
+        ALTER COLUMN longitude TYPE FLOAT USING longitude::FLOAT,
+        ALTER COLUMN locality TYPE VARCHAR(255),
+        ALTER COLUMN store_code TYPE VARCHAR(12),
+        ALTER COLUMN staff_numbers TYPE SMALLINT USING staff_numbers::SMALLINT,
+        ALTER COLUMN opening_date TYPE DATE USING opening_date::DATE,
+        ALTER COLUMN store_type TYPE VARCHAR(255),
+        ALTER COLUMN latitude TYPE FLOAT USING latitude::FLOAT,
+        ALTER COLUMN country_code TYPE VARCHAR(2),
+        ALTER COLUMN continent TYPE VARCHAR(255);""",
+    'dim_products': """
+        UPDATE {table} SET product_price = REPLACE(product_price, '£', '') WHERE product_price LIKE '£%';
+        ALTER TABLE {table} ADD weight_class VARCHAR(14);
+        UPDATE {table} SET weight_class = CASE
+            WHEN weight < 2 THEN 'Light'
+            WHEN weight >= 2 AND weight < 40 THEN 'Mid_Sized'
+            WHEN weight >= 40 AND weight < 140 THEN 'Heavy'
+            ELSE 'Truck_Required'
+        END;
+        ALTER TABLE {table} RENAME COLUMN removed TO still_available;
+        ALTER TABLE {table}
+        ALTER COLUMN product_price TYPE FLOAT USING product_price::FLOAT,
+        ALTER COLUMN weight TYPE FLOAT,
+        ALTER COLUMN "EAN" TYPE VARCHAR(17),
+        ALTER COLUMN product_code TYPE VARCHAR(12),
+        ALTER COLUMN date_added TYPE DATE USING date_added::DATE,
+        ALTER COLUMN uuid TYPE UUID USING uuid::UUID,
+        ALTER COLUMN weight_class TYPE VARCHAR(14);
+        ALTER TABLE {table}
+        ALTER COLUMN still_available TYPE BOOL
+        USING CASE
+            WHEN still_available IN ('Still_available', 'Still_avaliable') THEN true
+            WHEN still_available = 'Removed' THEN false
+            ELSE NULL
+        END;""",
+    'dim_date_times': """
+        ALTER TABLE {table}
+        ALTER COLUMN month TYPE VARCHAR(2),
+        ALTER COLUMN year TYPE VARCHAR(4),
+        ALTER COLUMN day TYPE VARCHAR(2),
+        ALTER COLUMN time_period TYPE VARCHAR(10),
+        ALTER COLUMN date_uuid TYPE UUID USING date_uuid::UUID;""",
+    'dim_card_details': """
+        ALTER TABLE {table}
+        ALTER COLUMN card_number TYPE VARCHAR(19),
+        ALTER COLUMN expiry_date TYPE VARCHAR(5),
+        ALTER COLUMN date_payment_confirmed TYPE DATE USING date_payment_confirmed::DATE;""",
+}
+SCHEMA_TABLES = {
+    'orders_table': 'clean_orders_data',
+    'dim_users': 'clean_user_data',
+    'dim_store_details': 'clean_store_data',
+    'dim_products': 'clean_product_data',
+    'dim_date_times': 'clean_time',
+    'dim_card_details': 'clean_card_data',
+}
+
+
+def _column_types(connection, table_name):
+    from sqlalchemy import text
+
+    rows = connection.execute(text(
+        "SELECT column_name, data_type, character_maximum_length FROM information_schema.columns "
+        "WHERE table_name = :table_name"), {'table_name': table_name})
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+def benchmark_schema_on_load(rows=200000):
+    from data_cleaning import DataCleaning
+    from database_utils import DatabaseConnector
+    from instrumentation import instrumentation
+    from table_schemas import TABLE_SCHEMAS
+    import synthetic_data
+
+    instrumentation.enabled = False
+    connector = DatabaseConnector()
+    engine = connector.get_engine('warehouse')
+    print(f"schema_on_load: {rows} rows per table")
+    print(f"  {'table':<20} {'TEXT + ALTER s':>15} {'typed load s':>13}")
+    for table_name, method_name in SCHEMA_TABLES.items():
+        generator_name = CLEANING_GENERATORS[method_name]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            cleaned = getattr(DataCleaning(), method_name)(getattr(synthetic_data, generator_name)(rows))
+        legacy_table, typed_table = f'benchmark_legacy_{table_name}', f'benchmark_typed_{table_name}'
+
+        def load_and_alter():
+            connector.upload_to_db(cleaned, legacy_table)
+            # Through the DBAPI cursor, so that the '%' of LIKE '£%' is not taken for a parameter
+            with engine.begin() as connection:
+                connection.connection.cursor().execute(LEGACY_CASTS[table_name].format(table=legacy_table))
+
+        _, legacy_time = _timed(load_and_alter)
+        _, typed_time = _timed(connector.upload_to_db, cleaned, typed_table, schema=TABLE_SCHEMAS[table_name])
+        with engine.begin() as connection:
+            legacy_types, typed_types = _column_types(connection, legacy_table), _column_types(connection, typed_table)
+            assert legacy_types == typed_types, f"Column types differ for {table_name}: {legacy_types} {typed_types}"
+            columns = ', '.join(f'"{column}"' for column in typed_types)
+            differences = connection.exec_driver_sql(
+                f"SELECT count(*) FROM ((SELECT {columns} FROM {legacy_table} EXCEPT ALL SELECT {columns} FROM "
+                f"{typed_table}) UNION ALL (SELECT {columns} FROM {typed_table} EXCEPT ALL SELECT {columns} FROM "
+                f"{legacy_table})) AS differences").scalar()
+            assert differences == 0, f"{differences} rows differ between the two loads of {table_name}"
+            connection.exec_driver_sql(f"DROP TABLE {legacy_table}, {typed_table}")
+        print(f"  {table_name:<20} {legacy_time:>15.2f} {typed_time:>13.2f} ({legacy_time / typed_time:.1f}x)")
+    connector.close_connection()
+
+
+def _synthetic_star_schema(orders):
+    # Cleaned synthetic tables whose keys match, so that the primary and foreign keys can be created
+    from data_cleaning import DataCleaning
+    import synthetic_data
+
+    cleaner = DataCleaning()
+    rng = np.random.default_rng(0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        tables = {
+            'dim_users': cleaner.clean_user_data(synthetic_data.generate_users(15000)),
+            'dim_card_details': cleaner.clean_card_data(synthetic_data.generate_cards(15000)),
+            'dim_store_details': cleaner.clean_store_data(synthetic_data.generate_stores(450)),
+            'dim_products': cleaner.clean_product_data(synthetic_data.generate_products(1800)),
+            'dim_date_times': cleaner.clean_time(synthetic_data.generate_date_times(orders)),
+            'orders_table': cleaner.clean_orders_data(synthetic_data.generate_orders(orders)),
+        }
+    keys = {'dim_users': 'user_uuid', 'dim_card_details': 'card_number', 'dim_store_details': 'store_code',
+            'dim_products': 'product_code', 'dim_date_times': 'date_uuid'}
+    for table_name, key in keys.items():
+        dimension = tables[table_name].drop_duplicates(subset=[key])
+        tables[table_name] = dimension
+        values = dimension[key].to_numpy(dtype=object)
+        tables['orders_table'][key] = values[rng.integers(0, len(values), len(tables['orders_table']))]
+    return tables
+
+
+def benchmark_keys(orders=1000000, workers=4):
+    from database_utils import DatabaseConnector
+    from instrumentation import instrumentation
+    from sqlalchemy import event
+    from table_schemas import TABLE_SCHEMAS
+
+    instrumentation.enabled = False
+    connector = DatabaseConnector()
+    engine = connector.get_engine('warehouse')
+
+    # Every connection works in the benchmark schema, so the warehouse tables of the same names are left alone
+    @event.listens_for(engine, 'connect')
+    def use_benchmark_schema(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('CREATE SCHEMA IF NOT EXISTS benchmark_keys; SET search_path TO benchmark_keys')
+        dbapi_connection.commit()
+
+    tables = _synthetic_star_schema(orders)
+    for table_name, df in tables.items():
+        connector.drop_keys(table_name)
+        connector.upload_to_db(df, table_name, schema=TABLE_SCHEMAS[table_name])
+        # Keep autovacuum from analyzing the fresh tables before the first measurement
+        with engine.begin() as connection:
+            connection.exec_driver_sql(f'ALTER TABLE "{table_name}" SET (autovacuum_enabled = false)')
+    before = connector.explain_sql_file('mdrc_data_query.sql')
+    _, primary_key_time = _timed(connector.create_primary_keys, TABLE_SCHEMAS, workers)
+    _, index_time = _timed(connector.create_indexes, TABLE_SCHEMAS, workers)
+    _, foreign_key_time = _timed(connector.create_foreign_keys, TABLE_SCHEMAS)
+    _, analyze_time = _timed(connector.analyze, list(TABLE_SCHEMAS), workers)
+    after = connector.explain_sql_file('mdrc_data_query.sql')
+    print(f"keys: {orders} orders, {workers} connections")
+    print(f"  primary keys {primary_key_time:.2f} s, join indexes {index_time:.2f} s, "
+          f"foreign keys {foreign_key_time:.2f} s, ANALYZE {analyze_time:.2f} s")
+    print(f"  {'query':<32} {'before ms':>10} {'after ms':>10}")
+    for number, (plan_before, plan_after) in enumerate(zip(before, after), start=1):
+        print(f"  {number:>2}. {plan_before['label'][:28]:<28} {plan_before['execution_ms']:>10.1f} "
+              f"{plan_after['execution_ms']:>10.1f} ({plan_before['execution_ms'] / plan_after['execution_ms']:.1f}x)")
+        if plan_before['nodes'] != plan_after['nodes']:
+            print(f"      before: {', '.join(plan_before['nodes'])}")
+            print(f"      after:  {', '.join(plan_after['nodes'])}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP SCHEMA benchmark_keys CASCADE')
+    connector.close_connection()
+
+
+def benchmark_parallel_cleaning(rows=1000000, workers=(1, 2, 4)):
+    from data_cleaning import DataCleaning
+    from instrumentation import instrumentation
+    from parallel_cleaning import PartitionedCleaner
+    import synthetic_data
+
+    instrumentation.enabled = False
+    print(f"parallel_cleaning: {rows} rows, {os.cpu_count()} CPUs")
+    print(f"  {'method':<20} {'serial s':>9} " + ' '.join(f"{f'{count} workers':>16}" for count in workers))
+    cleaners = [PartitionedCleaner(workers=count) for count in workers]
+    try:
+        for method_name, generator_name in CLEANING_GENERATORS.items():
+            raw = getattr(synthetic_data, generator_name)(rows)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                serial, serial_time = _timed(getattr(DataCleaning(), method_name), raw.copy())
+                cells = []
+                for cleaner in cleaners:
+                    # A first call starts the worker processes, so that they are not part of the timing
+                    getattr(cleaner, method_name)(raw.head(cleaner.min_partition_rows * 2).copy())
+                    partitioned, partitioned_time = _timed(getattr(cleaner, method_name), raw.copy())
+                    pd.testing.assert_frame_equal(serial, partitioned)
+                    cells.append(f"{partitioned_time:>7.2f} s ({serial_time / partitioned_time:.1f}x)")
+            print(f"  {method_name:<20} {serial_time:>9.2f} " + ' '.join(f"{cell:>16}" for cell in cells))
+    finally:
+        for cleaner in cleaners:
+            cleaner.close()
+
+
+def _run_report_queries(engine, path='mdrc_data_query.sql'):
+    # Result of every query of the script, and how long each one took
+    from database_utils import _split_sql_script
+
+    with open(path) as sql_file:
+        script = sql_file.read()
+    results = []
+    with engine.connect() as connection:
+        cursor = connection.connection.cursor()
+        for _, query in _split_sql_script(script):
+            start = time.perf_counter()
+            cursor.execute(query)
+            result = pd.DataFrame(cursor.fetchall(), columns=[column.name for column in cursor.description])
+            results.append((result, time.perf_counter() - start))
+        connection.connection.rollback()
+    return results
+
+
+def _assert_same_report(expected, actual, label):
+    from analytics import report_differences
+
+    difference = report_differences(expected, actual)
+    assert difference is None, f"{label}: {difference}"
+
+
+def benchmark_rollups(orders=1000000, appended=10000):
+    from database_utils import DatabaseConnector
+    from incremental_load import IncrementalLoader
+    from instrumentation import instrumentation
+    from rollups import REPORT_METHODS, SalesRollups
+    from sqlalchemy import event
+    from table_schemas import TABLE_SCHEMAS
+
+    instrumentation.enabled = False
+    connector = DatabaseConnector()
+    engine = connector.get_engine('warehouse')
+
+    # Every connection works in the benchmark schema, so the warehouse tables of the same names are left alone
+    @event.listens_for(engine, 'connect')
+    def use_benchmark_schema(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('CREATE SCHEMA IF NOT EXISTS benchmark_rollups; SET search_path TO benchmark_rollups')
+        dbapi_connection.commit()
+
+    tables = _synthetic_star_schema(orders + appended)
+    all_orders = tables.pop('orders_table')
+    tables['orders_table'] = all_orders.iloc[:orders]
+    for table_name, df in tables.items():
+        connector.drop_keys(table_name)
+        connector.upload_to_db(df, table_name, schema=TABLE_SCHEMAS[table_name])
+    connector.create_primary_keys(TABLE_SCHEMAS)
+    connector.create_indexes(TABLE_SCHEMAS)
+    connector.create_foreign_keys(TABLE_SCHEMAS)
+    connector.analyze(list(TABLE_SCHEMAS))
+    rollups = SalesRollups(connector)
+
+    def check_parity():
+        for number, ((expected, _), method_name) in enumerate(zip(_run_report_queries(engine), REPORT_METHODS), 1):
+            _assert_same_report(expected, getattr(rollups, method_name)(), f"query {number} ({method_name})")
+
+    mode, build_time = _timed(rollups.refresh)
+    assert mode == 'rebuilt'
+    check_parity()
+    # Append orders past the watermark, their index carrying on from the loaded ones. Some have a product and store
+    # the dimension tables do not have yet, which get placeholder rows as in an append of IncrementalLoader.
+    appended_orders = all_orders.iloc[orders:].copy()
+    unknown = appended_orders.index[::10]
+    for column in ('product_code', 'store_code'):
+        appended_orders.loc[unknown, column] = [f"ZZ-{uuid.uuid4().hex[:9]}" for _ in range(len(unknown))]
+    with engine.begin() as connection:
+        connection.exec_driver_sql('CREATE TEMPORARY TABLE delta (LIKE orders_table) ON COMMIT DROP')
+        connector.copy_rows(TABLE_SCHEMAS['orders_table'].prepare(appended_orders.reset_index()), 'delta', connection)
+        IncrementalLoader(connector, None)._add_missing_dimension_keys(connection, 'orders_table')
+    connector.upload_to_db(appended_orders, 'orders_table', if_exists='append', schema=TABLE_SCHEMAS['orders_table'])
+    mode, refresh_time = _timed(rollups.refresh)
+    assert mode == 'incremental'
+    check_parity()
+    _, rebuild_time = _timed(rollups.rebuild)
+    check_parity()
+    print(f"rollups: {orders} orders, {appended} appended, reports identical to mdrc_data_query.sql")
+    print(f"  first build {build_time:.2f} s, incremental refresh {refresh_time:.3f} s, "
+          f"full rebuild {rebuild_time:.2f} s ({rebuild_time / refresh_time:.0f}x)")
+    print(f"  {'report':<22} {'fact table ms':>14} {'rollups ms':>11}")
+    for (_, query_time), method_name in zip(_run_report_queries(engine), REPORT_METHODS):
+        _, report_time = _timed(getattr(rollups, method_name))
+        print(f"  {method_name:<22} {query_time * 1000:>14.1f} {report_time * 1000:>11.1f} "
+              f"({query_time / report_time:.1f}x)")
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP SCHEMA benchmark_rollups CASCADE')
+    connector.close_connection()
+
+
+def benchmark_analytics(orders=1000000):
+    from analytics import LocalAnalytics
+    from database_utils import DatabaseConnector
+    from instrumentation import instrumentation
+    from sqlalchemy import event
+    from table_schemas import TABLE_SCHEMAS
+
+    instrumentation.enabled = False
+    tables = _synthetic_star_schema(orders)
+    connector = DatabaseConnector()
+    engine = connector.get_engine('warehouse')
+
+    # Every connection works in the benchmark schema, so the warehouse tables of the same names are left alone
+    @event.listens_for(engine, 'connect')
+    def use_benchmark_schema(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('CREATE SCHEMA IF NOT EXISTS benchmark_analytics; SET search_path TO benchmark_analytics')
+        dbapi_connection.commit()
+
+    # Upload then query: the load and star_schema stages of main.py, then the queries
+    start = time.perf_counter()
+    for table_name, df in tables.items():
+        connector.drop_keys(table_name)
+        connector.upload_to_db(df, table_name, schema=TABLE_SCHEMAS[table_name])
+    connector.create_primary_keys(TABLE_SCHEMAS)
+    connector.run_sql_file('star_schema.sql')
+    connector.create_indexes(TABLE_SCHEMAS)
+    connector.create_foreign_keys(TABLE_SCHEMAS)
+    connector.analyze(list(TABLE_SCHEMAS))
+    postgres_load_time = time.perf_counter() - start
+    postgres_results = _run_report_queries(engine)
+    postgres_time = time.perf_counter() - start
+
+    with LocalAnalytics() as analytics:
+        start = time.perf_counter()
+        for table_name, df in tables.items():
+            analytics.register(table_name, df)
+        analytics.run_sql_file('star_schema.sql')
+        local_load_time = time.perf_counter() - start
+        local_results = analytics.run_sql_file('mdrc_data_query.sql')
+        local_time = time.perf_counter() - start
+        for label, difference in analytics.compare_with(connector):
+            assert difference is None, f"{label}: {difference}"
+
+    print(f"analytics: {orders} orders, results match Postgres")
+    print(f"  {'':<32} {'Postgres s':>11} {'DuckDB s':>9}")
+    print(f"  {'load (upload / register)':<32} {postgres_load_time:>11.2f} {local_load_time:>9.2f} "
+          f"({postgres_load_time / local_load_time:.1f}x)")
+    print(f"  {'end to end':<32} {postgres_time:>11.2f} {local_time:>9.2f} ({postgres_time / local_time:.1f}x)")
+    print(f"  {'query':<32} {'Postgres ms':>11} {'DuckDB ms':>9}")
+    for number, ((_, postgres_seconds), (label, _, local_seconds)) in enumerate(
+            zip(postgres_results, local_results), start=1):
+        print(f"  {number:>2}. {label[:28]:<28} {postgres_seconds * 1000:>11.1f} {local_seconds * 1000:>9.1f} "
+              f"({postgres_seconds / local_seconds:.1f}x)")
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP SCHEMA benchmark_analytics CASCADE')
+    connector.close_connection()
+
+
+def benchmark_incremental_orders(orders=1000000, deltas=(1000, 10000, 100000), chunksize=50000):
+    from data_cleaning import DataCleaning
+    from data_extraction import DataExtractor
+    from database_utils import DatabaseConnector
+    from incremental_load import IncrementalLoader, track_high_water_mark
+    from instrumentation import instrumentation
+    from sqlalchemy import event
+    from table_schemas import TABLE_SCHEMAS
+    import synthetic_data
+    import yaml
+
+    instrumentation.enabled = False
+    # The source is a table of the local Postgres too, read through the 'source' engine like the RDS table
+    connector = DatabaseConnector()
+    local_creds = connector.read_db_creds(DatabaseConnector.CREDS_FILES['warehouse'])
+    creds_dir = tempfile.mkdtemp()
+    source_creds_path = os.path.join(creds_dir, 'db_creds.yaml')
+    with open(source_creds_path, 'w') as creds_file:
+        yaml.safe_dump({'RDS_USER': local_creds['user'], 'RDS_PASSWORD': local_creds['password'],
+                        'RDS_HOST': local_creds['host'], 'RDS_PORT': local_creds['port'],
+                        'RDS_DATABASE': local_creds['dbname']}, creds_file)
+    connector.CREDS_FILES = dict(DatabaseConnector.CREDS_FILES, source=source_creds_path)
+    for target in ('source', 'warehouse'):
+        # Every connection works in the benchmark schema, so the tables of the same names are left alone
+        @event.listens_for(connector.get_engine(target), 'connect')
+        def use_benchmark_schema(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('CREATE SCHEMA IF NOT EXISTS benchmark_incremental; SET search_path TO benchmark_incremental')
+            dbapi_connection.commit()
+
+    extractor = DataExtractor(connector)
+    cleaner = DataCleaning()
+    loader = IncrementalLoader(connector, extractor)
+    schema = TABLE_SCHEMAS['orders_table']
+    source = synthetic_data.generate_orders(orders + sum(deltas))
+    connector.upload_to_db(source.iloc[:orders], 'legacy_orders')
+    with connector.get_engine('source').begin() as connection:
+        connection.exec_driver_sql('CREATE INDEX ON legacy_orders (level_0)')
+
+    def full_load():
+        metadata = {}
+        rows = 0
+        chunks = track_high_water_mark(extractor.stream_rds_table(connector, 'legacy_orders', chunksize=chunksize),
+                                       'level_0', metadata)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for chunk in chunks:
+                cleaned = cleaner.clean_orders_data(chunk)
+                cleaned.index += rows
+                connector.upload_to_db(cleaned, 'orders_table', if_exists='replace' if rows == 0 else 'append',
+                                       schema=schema)
+                rows += len(cleaned)
+        loader.save('legacy_orders', 'orders_table', 'level_0', metadata['high_water_mark'])
+        return rows
+
+    _, full_time = _timed(full_load)
+    print(f"incremental_orders: {orders} orders loaded in full in {full_time:.2f} s")
+    print(f"  {'new orders':>10} {'append s':>9} {'vs full load':>13}")
+    start = orders
+    for delta in deltas:
+        connector.upload_to_db(source.iloc[start:start + delta], 'legacy_orders', if_exists='append')
+        start += delta
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            appended, append_time = _timed(loader.append, 'legacy_orders', 'orders_table', 'level_0',
+                                           cleaner.clean_orders_data, schema, chunksize)
+        assert appended == delta, f"{appended} orders appended instead of {delta}"
+        print(f"  {delta:>10} {append_time:>9.3f} {full_time / append_time:>12.0f}x")
+    # Running it again appends nothing, and every source row is in the warehouse exactly once
+    assert loader.append('legacy_orders', 'orders_table', 'level_0', cleaner.clean_orders_data, schema) == 0
+    with connector.get_engine('warehouse').connect() as connection:
+        rows, distinct_index = connection.exec_driver_sql(
+            'SELECT COUNT(*), COUNT(DISTINCT index) FROM orders_table').fetchone()
+    assert rows == distinct_index == start, f"{rows} rows, {distinct_index} distinct, {start} expected"
+    with connector.get_engine('warehouse').begin() as connection:
+        connection.exec_driver_sql('DROP SCHEMA benchmark_incremental CASCADE')
+    connector.close_connection()
+    shutil.rmtree(creds_dir)
+
+
+def benchmark_dimension_upsert(orders=1000000, changed=0.01, inserted=0.01, deleted=0.01):
+    from data_cleaning import DataCleaning
+    from database_utils import DatabaseConnector
+    from dimension_upsert import DimensionUpserter
+    from instrumentation import instrumentation
+    from sqlalchemy import event
+    from table_schemas import TABLE_SCHEMAS
+    import synthetic_data
+
+    instrumentation.enabled = False
+    connector = DatabaseConnector()
+    engine = connector.get_engine('warehouse')
+
+    # Every connection works in the benchmark schema, so the warehouse tables of the same names are left alone
+    @event.listens_for(engine, 'connect')
+    def use_benchmark_schema(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('CREATE SCHEMA IF NOT EXISTS benchmark_upsert; SET search_path TO benchmark_upsert')
+        dbapi_connection.commit()
+
+    tables = _synthetic_star_schema(orders)
+    for table_name, df in tables.items():
+        connector.upload_to_db(df, table_name, schema=TABLE_SCHEMAS[table_name])
+    connector.create_primary_keys(TABLE_SCHEMAS)
+    connector.create_indexes(TABLE_SCHEMAS)
+    connector.create_foreign_keys(TABLE_SCHEMAS)
+    upserter = DimensionUpserter(connector)
+    cleaner = DataCleaning()
+    schema = TABLE_SCHEMAS['dim_date_times']
+    dates = tables['dim_date_times']
+    rows = len(dates)
+
+    # The next extraction: some rows changed, some new, and some gone, of which those orders refer to are kept
+    rng = np.random.default_rng(1)
+    positions = rng.permutation(rows)
+    changed_rows, deleted_rows = positions[:int(rows * changed)], positions[rows - int(rows * deleted):]
+    keep = np.ones(rows, dtype=bool)
+    keep[deleted_rows] = False
+    next_dates = dates.copy()
+    next_dates.iloc[changed_rows, next_dates.columns.get_loc('time_period')] = 'Changed'
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        new_dates = cleaner.clean_time(synthetic_data.generate_date_times(int(rows * inserted), seed=1))
+    new_dates = new_dates.drop_duplicates(subset=['date_uuid'])
+    new_dates = new_dates[~new_dates['date_uuid'].isin(dates['date_uuid'])]
+    next_dates = pd.concat([next_dates[keep], new_dates])
+    # Numbered from 0, as clean_chunks in main.py numbers the cleaned rows, so the rows after a deleted one move up
+    next_dates.index = range(len(next_dates))
+    referenced = dates['date_uuid'].iloc[deleted_rows].isin(tables['orders_table']['date_uuid']).to_numpy()
+    expected = {'inserted': len(new_dates), 'updated': len(changed_rows), 'deleted': int((~referenced).sum()),
+                'kept': int(referenced.sum()), 'unchanged': len(next_dates) - len(new_dates) - len(changed_rows)}
+
+    print(f"dimension_upsert: dim_date_times, {rows} rows, {len(next_dates)} in the next extraction")
+    print(f"  {'step':<34} {'seconds':>8} {'inserted':>9} {'updated':>8} {'unchanged':>10} {'deleted':>8}")
+
+    def report(step, counts, seconds):
+        print(f"  {step:<34} {seconds:>8.3f} {counts['inserted']:>9} {counts['updated']:>8} "
+              f"{counts['unchanged']:>10} {counts['deleted']:>8}")
+
+    # main.py records the fingerprints of a dimension table loaded in full
+    _, seconds = _timed(upserter.record, 'dim_date_times', dates, schema)
+    print(f"  {'fingerprints recorded':<34} {seconds:>8.3f}")
+    counts, seconds = _timed(upserter.upsert, 'dim_date_times', dates, schema)
+    assert counts['unchanged'] == rows, counts
+    report('same rows', counts, seconds)
+    counts, upsert_time = _timed(upserter.upsert, 'dim_date_times', next_dates, schema, delete=True)
+    report('next extraction, with deletes', counts, upsert_time)
+    assert counts == expected, f"{counts} != {expected}"
+
+    # The upserted table holds the rows of a full reload, and the deleted rows orders still refer to, but for the
+    # row numbers, which the upsert keeps from the first load
+    connector.upload_to_db(next_dates, 'expected_date_times', schema=schema)
+    with engine.connect() as connection:
+        columns = ', '.join(f'"{column}"' for column in schema.columns if column != 'index')
+        missing, extra, extra_referenced = connection.exec_driver_sql(f"""
+            SELECT
+                (SELECT COUNT(*) FROM (SELECT {columns} FROM expected_date_times
+                                       EXCEPT ALL SELECT {columns} FROM dim_date_times) AS m),
+                (SELECT COUNT(*) FROM (SELECT {columns} FROM dim_date_times
+                                       EXCEPT ALL SELECT {columns} FROM expected_date_times) AS e),
+                (SELECT COUNT(*) FROM (SELECT {columns} FROM dim_date_times
+                                       EXCEPT ALL SELECT {columns} FROM expected_date_times) AS e
+                 WHERE date_uuid IN (SELECT date_uuid FROM orders_table))""").fetchone()
+    assert missing == 0 and extra == extra_referenced == counts['kept'], (missing, extra, extra_referenced, counts)
+
+    # The same rows loaded in full, with the rows orders refer to that the foreign key needs
+    reloaded_dates = pd.concat([next_dates, dates.iloc[deleted_rows[referenced]]])
+
+    def full_reload():
+        connector.drop_keys('dim_date_times')
+        connector.upload_to_db(reloaded_dates, 'dim_date_times', schema=schema)
+        connector.create_primary_keys(TABLE_SCHEMAS)
+        connector.create_indexes(TABLE_SCHEMAS)
+        connector.create_foreign_keys(TABLE_SCHEMAS)
+
+    _, reload_time = _timed(full_reload)
+    print(f"  full reload with keys: {reload_time:.3f} s, upsert {reload_time / upsert_time:.1f}x faster")
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP SCHEMA benchmark_upsert CASCADE')
+    connector.close_connection()
+
+
+# Formats each date column mixes, as synthetic_data.py generates them, and how the column was parsed before DateParser.
+# join_date and date_of_birth were left for Postgres to parse; the store parsing is their closest pandas equivalent.
+LEGACY_DATE_PARSING = {
+    'opening_date': (('%Y-%m-%d', '%Y %B %d', '%B %Y %d', '%Y/%m/%d'),
+                     lambda values: pd.to_datetime(values, infer_datetime_format=True, errors='coerce')),
+    'join_date': (('%Y-%m-%d', '%Y/%m/%d', '%Y %B %d'),
+                  lambda values: pd.to_datetime(values, infer_datetime_format=True, errors='coerce')),
+    'date_of_birth': (('%Y-%m-%d', '%Y %B %d', '%B %Y %d'),
+                      lambda values: pd.to_datetime(values, infer_datetime_format=True, errors='coerce')),
+    'date_payment_confirmed': (('%Y-%m-%d',),
+                               lambda values: pd.to_datetime(values, format='%Y-%m-%d', errors='coerce')),
+}
+
+
+def _synthetic_dates(rows, formats, seed=0):
+    # A pool of distinct dates in random formats, repeated over the rows, with a few NULL and garbage values
+    rng = np.random.default_rng(seed)
+    days = rng.integers(0, 33 * 365, 5000)
+    dates = pd.Timestamp('1990-01-01') + pd.to_timedelta(days, unit='D')
+    pool = [date.strftime(formats[choice]) for date, choice in zip(dates, rng.integers(0, len(formats), len(dates)))]
+    pool += ['NULL'] + [f'{value:010X}' for value in rng.integers(0, 2 ** 40, 5)]
+    weights = np.full(len(pool), 0.999 / 5000)
+    weights[5000:] = 0.001 / (len(pool) - 5000)
+    return pd.Series(np.asarray(pool, dtype=object)[rng.choice(len(pool), rows, p=weights)])
+
+
+def benchmark_date_parsing(rows=10000000, legacy_rows=1000000):
+    from date_parsing import DateParser
+
+    # The legacy parsing takes minutes per million rows of mixed formats, so it only runs on the first legacy_rows
+    print(f"date_parsing: {rows} rows per column, the legacy parsing on the first {legacy_rows}")
+    print(f"  {'column':<24} {'legacy rows/s':>14} {'parsed':>7} {'DateParser rows/s':>18} {'parsed':>7} "
+          f"{'speedup':>8} {'next chunk s':>13}")
+    for column, (formats, legacy_parse) in LEGACY_DATE_PARSING.items():
+        values = _synthetic_dates(rows, formats)
+        sample = values.iloc[:legacy_rows]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            legacy, legacy_time = _timed(legacy_parse, sample)
+        parser = DateParser()
+        parsed, parser_time = _timed(parser.parse, values)
+        # Every date parsed before is parsed the same
+        both = legacy.notna().to_numpy()
+        assert (legacy[both] == parsed.iloc[:legacy_rows][both]).all(), \
+            f"DateParser disagrees with the legacy parsing of '{column}'"
+        # A next chunk of the same table finds its strings remembered
+        _, next_time = _timed(parser.parse, _synthetic_dates(rows, formats, seed=1))
+        legacy_speed, parser_speed = len(sample) / legacy_time, rows / parser_time
+        print(f"  {column:<24} {legacy_speed:>14,.0f} {both.mean():>7.1%} {parser_speed:>18,.0f} "
+              f"{parsed.notna().mean():>7.1%} {parser_speed / legacy_speed:>7.0f}x {next_time:>13.2f}")
+
+
+# The source libraries main.py imported at startup, through data_extraction.py and source_cache.py
+LEGACY_STARTUP_IMPORTS = 'import boto3, pypdf, requests, requests.adapters, tabula, urllib3.util.retry'
+
+# The source libraries each command's stage imports once it reads its source
+COMMAND_SOURCE_IMPORTS = {
+    'users': '',
+    'orders': '',
+    'cards': 'import pypdf, requests, tabula',
+    'stores': 'import requests, requests.adapters, urllib3.util.retry',
+    'products': 'import boto3',
+    'date_times': 'import boto3, requests',
+}
+
+
+def _fresh_process_time(arguments, repeats):
+    # Best of repeats, so that the imports are timed with the files in the page cache
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + arguments, cwd=os.path.dirname(os.path.abspath(__file__)),
+                       stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_cli_startup(repeats=5):
+    # Everything main.py does before its first stage runs
+    start_run = "import main; main.build_run(main.parse_args({arguments!r}))"
+    legacy_time = _fresh_process_time(['-c', f"{LEGACY_STARTUP_IMPORTS}; {start_run.format(arguments=[])}"],
+                                      repeats)
+    print(f"cli_startup: best of {repeats} fresh interpreters, vs {legacy_time:.3f} s with the legacy imports")
+    print(f"  {'command':<22} {'startup s':>10} {'vs legacy':>10} {'+ source imports s':>19}")
+    for label, arguments in (('--help', ['--help']), ('--dry-run', ['--dry-run']),
+                             ('users --dry-run', ['users', '--dry-run'])):
+        startup_time = _fresh_process_time(['main.py'] + arguments, repeats)
+        print(f"  {label:<22} {startup_time:>10.3f} {startup_time / legacy_time:>10.0%} {'':>19}")
+    for command, source_imports in COMMAND_SOURCE_IMPORTS.items():
+        startup_time = _fresh_process_time(['-c', start_run.format(arguments=[command])], repeats)
+        stage_time = _fresh_process_time(['-c', f"{start_run.format(arguments=[command])}; {source_imports}"],
+                                         repeats) if source_imports else startup_time
+        print(f"  {command:<22} {startup_time:>10.3f} {startup_time / legacy_time:>10.0%} {stage_time:>19.3f}")
+
+
+BENCHMARKS = {
+    'store_fetch': benchmark_store_fetch,
+    'bulk_load': benchmark_bulk_load,
+    'product_weights': benchmark_product_weights,
+    'phone_numbers': benchmark_phone_numbers,
+    'card_pdf': benchmark_card_pdf,
+    'cleaning': benchmark_cleaning,
+    'products_stream': benchmark_products_stream,
+    'date_times_json': benchmark_date_times_json,
+    'compact_dtypes': benchmark_compact_dtypes,
+    'parallel_cleaning': benchmark_parallel_cleaning,
+    'schema_on_load': benchmark_schema_on_load,
+    'keys': benchmark_keys,
+    'rollups': benchmark_rollups,
+    'analytics': benchmark_analytics,
+    'incremental_orders': benchmark_incremental_orders,
+    'dimension_upsert': benchmark_dimension_upsert,
+    'date_parsing': benchmark_date_parsing,
+    'cli_startup': benchmark_cli_startup,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline offline.")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help=f"benchmarks to run, all of them by default: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES,
+                        help="row counts for the cleaning benchmark, from 10k up to 10M")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file for the cleaning benchmark")
+    parser.add_argument("--save-baseline", action="store_true", help="store the cleaning results as the baseline")
+    parser.add_argument("--csv-mb", nargs="+", type=int, default=[256, 1024, 2048],
+                        help="products CSV sizes in MB for the products_stream benchmark")
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    passed = True
+    for name in args.benchmarks or list(BENCHMARKS):
+        if name == 'cleaning':
+            passed = benchmark_cleaning(args.sizes, args.baseline, args.save_baseline)
+        elif name == 'products_stream':
+            benchmark_products_stream(args.csv_mb)
+        else:
+            BENCHMARKS[name]()
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,218 @@
+import io
+import json
+import numpy as np
+import pandas as pd
+import re
+
+
+"""
+Columnar JSON
+
+Incremental reader for column-oriented JSON documents, the layout of the date details feed and of
+DataFrame.to_json() by default:
+
+    {"timestamp": {"0": "22:00:06", "1": "20:12:34", ...}, "month": {"0": "9", ...}, ...}
+
+The document is read in blocks and each column is decoded straight into a typed buffer (integers, categorical codes
+or strings), so the whole payload is never held as text or as a dict of dicts. Only the unconsumed tail of the
+current block is kept between reads.
+"""
+
+_COLUMN_START = re.compile(r'\s*,?\s*("[^"\\]*(?:\\.[^"\\]*)*")\s*:\s*\{')
+_OBJECT_START = re.compile(r'\s*\{')
+_OBJECT_END = re.compile(r'\s*\}')
+_SEPARATOR = re.compile(r'\s*,?')
+# Strings (skipped whole), a quote opening a string the buffer cuts off, and the characters delimiting members
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}\[\],]')
+
+
+def read_columnar_json(json_file, dtypes=None, block_size=1024 ** 2):
+    """
+    Reads a column-oriented JSON document from a text or binary file object into a DataFrame.
+
+    Parameters:
+        - json_file: Object with a read(size) method, e.g. an open file or a streamed HTTP response body.
+        - dtypes (dict): dtype per column. Nullable integer dtypes ('Int8', 'Int16', ...) keep integers, with the
+          values that are not numbers becoming missing. A column holding a number that is not an integer of the
+          dtype (e.g. 2.5, or 300 for Int8) is kept as float64 instead, as pd.to_numeric would. 'category' builds a
+          categorical; other columns keep the decoded Python values (str, numbers, None).
+        - block_size (int): Number of characters read at a time.
+    Returns:
+        - DataFrame: One column per member of the document. The index is a RangeIndex when the row keys are
+          "0", "1", ..., otherwise the row keys themselves.
+    """
+    if not isinstance(json_file.read(0), str):
+        json_file = io.TextIOWrapper(json_file, encoding='utf-8')
+    dtypes = dtypes or {}
+    buffer = ''
+    position = 0
+    at_end = False
+    started = False
+    column = None
+    columns = {}
+    index_keys = None
+
+    while True:
+        if not started:
+            match = _OBJECT_START.match(buffer, position)
+            if match:
+                started = True
+                position = match.end()
+                continue
+        elif column is None:
+            match = _COLUMN_START.match(buffer, position)
+            if match:
+                name = json.loads(match.group(1))
+                column = _ColumnBuilder(name, dtypes.get(name), index_keys)
+                position = match.end()
+                continue
+            match = _OBJECT_END.match(buffer, position)
+            if match:
+                break
+        else:
+            position = _SEPARATOR.match(buffer, position).end()
+            members, cut, closed = _decode_members(buffer, position)
+            if members is not None:
+                column.add(members)
+                position = cut
+            if closed:
+                columns[column.name] = column
+                if index_keys is None:
+                    index_keys = column.keys
+                column = None
+                position += 1
+                continue
+        # Nothing more can be decoded from the buffer, read the next block
+        if at_end:
+            raise ValueError(f"Malformed or truncated JSON near: {buffer[position:position + 80]!r}")
+        block = json_file.read(block_size)
+        at_end = not block
+        buffer = buffer[position:] + block
+        position = 0
+
+    if not columns:
+        return pd.DataFrame()
+    index = _index_from_keys(index_keys)
+    return pd.DataFrame({name: column.finish(index, index_keys) for name, column in columns.items()}, index=index)
+
+
+def _decode_members(buffer, position):
+    """
+    Decodes the members of a column object found in buffer from position, with the C JSON decoder.
+
+    Returns (members, cut, closed): the decoded dict (None if no complete member is available yet), the position
+    up to which the buffer was consumed, and whether the column object ends at that position. Two cuts are tried
+    first: the first '}' when no '{' comes before it (flat members, so it ends the column), then the last ','. A
+    brace or comma inside a string leaves an unterminated string before it, which fails to decode. When both fail,
+    one pass over the tokens finds the closing brace of the column, or else its last member boundary, so a block
+    is never decoded more than three times.
+    """
+    brace = buffer.find('}', position)
+    if brace != -1 and buffer.find('{', position, brace) == -1:
+        members = _try_decode(buffer, position, brace)
+        if members is not None:
+            return members, brace, True
+    comma = buffer.rfind(',', position)
+    if comma != -1:
+        members = _try_decode(buffer, position, comma)
+        if members is not None:
+            return members, comma, False
+    cut, closed = _member_boundary(buffer, position)
+    members = None if cut is None else _try_decode(buffer, position, cut)
+    if members is None:
+        return None, position, False
+    return members, cut, closed
+
+
+def _member_boundary(buffer, position):
+    # The closing brace of the column, or the last comma between its members, skipping strings and nested values
+    depth = 0
+    last_comma = None
+    for token in _TOKEN.finditer(buffer, position):
+        character = token.group()
+        if character == '"':
+            # A string the buffer cuts off: nothing after it is known yet
+            break
+        if character in '{[':
+            depth += 1
+        elif character in '}]':
+            if depth == 0:
+                return token.start(), True
+            depth -= 1
+        elif character == ',' and depth == 0:
+            last_comma = token.start()
+    return last_comma, False
+
+
+def _try_decode(buffer, position, cut):
+    try:
+        return json.loads('{' + buffer[position:cut] + '}')
+    except json.JSONDecodeError:
+        return None
+
+
+def _index_from_keys(keys):
+    if keys == [str(number) for number in range(len(keys))]:
+        return pd.RangeIndex(len(keys))
+    return pd.Index(keys)
+
+
+class _ColumnBuilder:
+    """
+    Typed buffer for one column, filled one batch of decoded members at a time.
+    """
+    def __init__(self, name, dtype, index_keys):
+        self.name = name
+        self.dtype = dtype
+        self.kind = 'int' if dtype is not None and pd.api.types.is_integer_dtype(dtype) else (
+            'category' if dtype == 'category' else 'object')
+        self.index_keys = index_keys
+        # Keys are kept for the first column, and for any later column whose keys differ from the first one
+        self.keys = [] if index_keys is None else None
+        self.aligned = True
+        self.row_count = 0
+        self.parts = []
+        self.categories = {}
+
+    def add(self, members):
+        keys = list(members)
+        if self.keys is not None:
+            self.keys.extend(keys)
+        elif keys != self.index_keys[self.row_count:self.row_count + len(keys)]:
+            # Rows in a different order than the first column, keep the keys to align them at the end
+            self.keys = self.index_keys[:self.row_count] + keys
+            self.aligned = False
+        self.row_count += len(keys)
+        values = list(members.values())
+        if self.kind == 'int':
+            self.parts.append(pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype='float64'))
+        elif self.kind == 'category':
+            codes, uniques = pd.factorize(values)
+            lookup = np.array([self.categories.setdefault(value, len(self.categories)) for value in uniques] + [-1])
+            # factorize() gives missing values the code -1, which picks the trailing -1 of lookup
+            self.parts.append(lookup[codes].astype('int32'))
+        else:
+            self.parts.append(values)
+
+    def finish(self, index, index_keys):
+        if self.kind == 'int':
+            numbers = np.concatenate(self.parts) if self.parts else np.array([], dtype='float64')
+            integer_type = np.dtype(pd.api.types.pandas_dtype(self.dtype).numpy_dtype)
+            limits = np.iinfo(integer_type)
+            missing = np.isnan(numbers)
+            integral = (numbers == np.floor(numbers)) & (numbers >= limits.min) & (numbers <= limits.max)
+            if (~missing & ~integral).any():
+                # Numbers that are not integers of the dtype are kept, as floats
+                values = numbers
+            else:
+                values = pd.arrays.IntegerArray(np.where(missing, 0, numbers).astype(integer_type), missing)
+        elif self.kind == 'category':
+            codes = np.concatenate(self.parts) if self.parts else np.array([], dtype='int32')
+            values = pd.Categorical.from_codes(codes, categories=list(self.categories))
+        else:
+            values = np.empty(self.row_count, dtype=object)
+            values[:] = [value for part in self.parts for value in part]
+        if self.index_keys is None or (self.aligned and self.row_count == len(index_keys)):
+            return pd.Series(values, index=index)
+        keys = self.keys if self.keys is not None else index_keys[:self.row_count]
+        return pd.Series(values, index=pd.Index(keys)).reindex(index_keys).set_axis(index)
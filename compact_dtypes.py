@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+import sys
+import threading
+
+
+"""
+Compact Dtypes
+
+Memory-optimized representations for the pipeline's DataFrames, which otherwise hold every column as Python objects:
+
+- Low-cardinality text (country, country_code, continent, store_type, time_period, card_provider, ...) becomes
+  categorical: one small integer code per row plus one copy of each distinct value.
+- Integer fields (product_quantity, staff_numbers, year, month, day) are downcast to the smallest integer type that
+  holds them, once every value in the column is an integer. Dirty columns are left alone until cleaning has fixed them.
+- Any other text column becomes an Arrow-backed string column, which stores the characters in one contiguous buffer.
+
+Enabled with DataExtractor(..., compact=True) and DataCleaning(compact=True), or `python main.py --compact`.
+"""
+
+# Columns always stored as categoricals in compact mode
+CATEGORICAL_COLUMNS = ('country', 'country_code', 'continent', 'store_type', 'time_period', 'card_provider',
+                       'locality', 'category', 'removed')
+# Columns downcast to the smallest integer type once all their values are integers
+INTEGER_COLUMNS = ('product_quantity', 'staff_numbers', 'year', 'month', 'day')
+# Other text columns become categoricals when they have fewer distinct values than this share of their rows
+CATEGORY_RATIO = 0.5
+STRING_DTYPE = 'string[pyarrow]'
+
+
+def compact_frame(df, categorical_columns=CATEGORICAL_COLUMNS, integer_columns=INTEGER_COLUMNS):
+    """
+    Returns a copy of df with categorical, downcast integer and Arrow string columns where the values allow it.
+    Values are unchanged: a column that cannot be converted without losing or altering a value keeps its dtype.
+    """
+    compact = {}
+    for column in df.columns:
+        series = df[column]
+        if column in integer_columns:
+            series = _downcast_integers(series)
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.cat.remove_unused_categories()
+        elif series.dtype == object and _is_text(series):
+            if column in categorical_columns or series.nunique() < CATEGORY_RATIO * len(series):
+                series = series.astype('category')
+            else:
+                series = series.astype(STRING_DTYPE)
+        compact[column] = series
+    return pd.DataFrame(compact, index=df.index)
+
+
+def _is_text(series):
+    # Only columns holding nothing but strings and missing values, so dates and mixed columns stay as they are
+    values = series.dropna()
+    return len(values) > 0 and pd.api.types.infer_dtype(values, skipna=True) == 'string'
+
+
+def _downcast_integers(series):
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return pd.to_numeric(series, downcast='integer')
+    if pd.api.types.is_float_dtype(series.dtype):
+        if series.isna().any() or not (series == np.floor(series)).all():
+            return series
+        return pd.to_numeric(series.astype('int64'), downcast='integer')
+    # Text is converted only if every value is a plain integer, so '007', '1e3' or a missing value keep it as text
+    as_text = series.astype(str)
+    if len(series) and as_text.str.fullmatch(r'-?(?:0|[1-9]\d*)').all():
+        return pd.to_numeric(as_text, downcast='integer')
+    return series
+
+
+def memory_bytes(df):
+    return int(df.memory_usage(deep=True, index=False).sum())
+
+
+def object_equivalent_bytes(df):
+    """
+    Estimates the memory df would take with every column stored the default way (object strings, 64-bit numbers),
+    without building that frame.
+    """
+    pointer = np.dtype(object).itemsize
+    total = 0
+    for column in df.columns:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            counts = np.bincount(series.cat.codes[series.cat.codes >= 0], minlength=len(series.cat.categories))
+            sizes = np.array([sys.getsizeof(value) for value in series.cat.categories], dtype='int64')
+            total += int(counts @ sizes) + pointer * len(series)
+        elif isinstance(series.dtype, pd.StringDtype):
+            # An ASCII str object takes its length plus a fixed header
+            header = sys.getsizeof('')
+            lengths = series.str.len()
+            total += int(lengths.sum() + header * lengths.notna().sum()) + pointer * len(series)
+        elif pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+            total += 8 * len(series)
+        else:
+            total += int(series.memory_usage(deep=True, index=False))
+    return total
+
+
+class MemoryReport:
+    """
+    Collects the memory taken by each table in compact mode against its default object-dtype footprint.
+
+    Methods:
+        1. record(table_name, df)
+            - Adds a frame (or one chunk of a streamed table) to the table's totals.
+
+        2. report()
+            - Prints, per table, the default and compact sizes, the memory saved and the reduction factor.
+    """
+    def __init__(self):
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def record(self, table_name, df):
+        baseline = object_equivalent_bytes(df)
+        compact = memory_bytes(df)
+        with self._lock:
+            before, after = self.tables.get(table_name, (0, 0))
+            self.tables[table_name] = (before + baseline, after + compact)
+
+    def report(self):
+        for table_name, (before, after) in self.tables.items():
+            ratio = before / after if after else float('inf')
+            print(f"  {table_name:<22} {before / 1024 ** 2:10.1f} MB -> {after / 1024 ** 2:8.1f} MB "
+                  f"(saved {(before - after) / 1024 ** 2:.1f} MB, {ratio:.1f}x smaller)")
+
+
+memory_report = MemoryReport()
@@ -1,14 +1,29 @@
+from compact_dtypes import compact_frame
+from date_parsing import DateParser
+from instrumentation import instrumented
+import numpy as np
 import pandas as pd
 import re
+import threading
 
 
 class DataCleaning:
-    def __init__(self):
-        pass
+    def __init__(self, compact=False):
+        self.compact = compact
+        # Shared by the store, card and user dates, so that each distinct date string is parsed once
+        self.date_parser = DateParser()
+        self.unparsed_dates = {}
+        # The stages of main.py clean their tables on threads sharing this cleaner
+        self._unparsed_lock = threading.Lock()
+        # Copied, so that units registered on one cleaner do not leak into the others
+        self.weight_units = dict(self.WEIGHT_UNITS)
     """
     This class provides methods for cleaning data, handling NULL values, date errors, and incorrect data types in datasets.
     It can be used to clean user data, card data, store data, product data, orders data, and JSON data.
 
+    With compact=True the public methods return categorical, downcast integer and Arrow string columns (see
+    compact_dtypes.py), and the cleaning steps keep those dtypes instead of converting them back to object.
+
     Public Methods for User Data:
     1. clean_user_data(user_data)
         - Cleans user data by dropping rows with NULL values, handling date errors, and filtering incorrect rows.
@@ -16,6 +31,9 @@ class DataCleaning:
             - user_data (DataFrame): The user data to be cleaned.
         - Returns:
             - DataFrame: The cleaned user data.
+        - Dates are parsed with the DateParser of date_parsing.py, whatever their format, here and for the card and
+          store data. Dates that cannot be parsed become NaT and are kept in `unparsed_dates`, by column, for
+          inspection.
 
     Public Methods for Card Data:
     2. clean_card_data(card_data)
@@ -40,6 +58,12 @@ class DataCleaning:
             - product_df (DataFrame): The product data to be cleaned.
         - Returns:
             - DataFrame: The cleaned product data.
+        - Weights that cannot be parsed become NaN and are kept in `unparsed_weights` for inspection.
+
+    register_weight_unit(unit, kilograms_per_unit=1.0, units_per_kilogram=1)
+        - Teaches this cleaner's weight parser a new unit, e.g. register_weight_unit('lb', 0.4536) or
+          register_weight_unit('mg', units_per_kilogram=1000000). A weight is converted as
+          value * kilograms_per_unit / units_per_kilogram.
 
     Public Methods for Orders Data:
     5. clean_orders_data(orders_data)
@@ -58,43 +82,107 @@ class DataCleaning:
             - DataFrame: The cleaned datetime data.
     """
         
-    # Common private method
+    # Common private methods
+    def __getstate__(self):
+        # Locks cannot be pickled, e.g. to the processes of parallel_cleaning.py
+        state = dict(self.__dict__)
+        del state['_unparsed_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._unparsed_lock = threading.Lock()
+
+    def _record_unparsed_dates(self, unparsed_by_column):
+        # Replaced rather than updated in place, so a thread reading the diagnostics never sees them change
+        with self._unparsed_lock:
+            self.unparsed_dates = {**self.unparsed_dates, **unparsed_by_column}
+
+    def _finish(self, df):
+        return compact_frame(df) if self.compact else df
+
+    @instrumented
     def _remove_duplicate_rows(self, df, column):
         return df.drop_duplicates(subset=column)
+
+    @instrumented
+    def _parse_dates(self, df, columns):
+        for column in columns:
+            parsed = self.date_parser.parse(df[column])
+            # Report the rows that could not be parsed instead of failing on the first one
+            unparsed = parsed.isna() & df[column].notna()
+            unparsed_values = df.loc[unparsed, column]
+            self._record_unparsed_dates({column: unparsed_values})
+            if unparsed.any():
+                print(f"{unparsed.sum()} values of '{column}' could not be parsed as dates, "
+                      f"e.g. {unparsed_values.unique()[:5].tolist()}")
+            df[column] = parsed.dt.date
+        return df
     
 # 1. Public methods for user data
+    @instrumented
     def clean_user_data(self, user_data):
         clean_user_data = user_data.copy()
         clean_user_data = self._drop_rows_with_null_values(clean_user_data)
         clean_user_data = self._filter_valid_countries(clean_user_data)
         clean_user_data = self._correct_country_codes(clean_user_data)
+        clean_user_data = self._parse_dates(clean_user_data, ['date_of_birth', 'join_date'])
         clean_user_data = self._standardize_phone_numbers(clean_user_data)
         clean_user_data.reset_index(drop=True, inplace=True)
-        return clean_user_data
+        return self._finish(clean_user_data)
 
     # Private methods for user data
+    @instrumented
     def _drop_rows_with_null_values(self, df):
         return df.dropna()
 
+    @instrumented
     def _filter_valid_countries(self, df):
         valid_countries = ['Germany', 'United Kingdom', 'United States']
         return df[df['country'].isin(valid_countries)]
 
+    @instrumented
     def _correct_country_codes(self, df):
         corrections = {'GGB': 'GB'}
-        df['country_code'] = df['country_code'].map(corrections).fillna(df['country_code'])
+        # replace() keeps a categorical column categorical, where map() and fillna() would not
+        df['country_code'] = df['country_code'].replace(corrections)
         return df
 
+    # Country calling codes stripped from every phone number, whatever its country_code
+    PHONE_PREFIXES = [r'\+44', r'\+49']
+    _phone_patterns = {}
+
+    def _phone_pattern(self, country_code):
+        # One precompiled pattern per country: its prefixes at the start of the number, or any non-digit character
+        pattern = self._phone_patterns.get(country_code)
+        if pattern is None:
+            prefixes = '|'.join(self.PHONE_PREFIXES + [re.escape(str(country_code))])
+            pattern = re.compile(fr'^(?:{prefixes})|\D')
+            self._phone_patterns[country_code] = pattern
+        return pattern
+
+    @instrumented
     def _standardize_phone_numbers(self, df):
-        # Remove the two-digit country code if it is present
-        df['phone_number'] = df.apply(lambda row: re.sub(fr'^\+44|^\+49|^{row["country_code"]}', '', row['phone_number']), axis=1)
-        # Remove non-digit characters from the phone number
-        df['phone_number'] = df['phone_number'].apply(lambda phone: re.sub(r'\D', '', phone))
+        # Remove the country prefix and every non-digit character in one pass per country_code group
+        phone_numbers = df['phone_number'].to_numpy(dtype=object)
+        standardized = np.empty(len(df), dtype=object)
+        groups = df.groupby('country_code', sort=False, dropna=False, observed=True).indices
+        for country_code, positions in groups.items():
+            group = pd.Series(phone_numbers[positions], dtype=object)
+            standardized[positions] = group.str.replace(self._phone_pattern(country_code), '', regex=True).to_numpy()
+        standardized = pd.Series(standardized, index=df.index, dtype=object)
         # Add a leading '0' if the number doesn't start with '0'
-        df['phone_number'] = df['phone_number'].apply(lambda phone: '0' + phone if not phone.startswith('0') else phone)
+        standardized = standardized.where(standardized.str.startswith('0'), '0' + standardized)
+        # Keep the column's dtype; a categorical gets new categories, as the old ones are the unformatted numbers
+        if isinstance(df['phone_number'].dtype, pd.CategoricalDtype):
+            standardized = standardized.astype('category')
+        elif df['phone_number'].dtype != object:
+            standardized = standardized.astype(df['phone_number'].dtype)
+        df['phone_number'] = standardized
         return df
 
 # 2. Public methods for card data
+    @instrumented
     def clean_card_data(self, card_data):
         clean_card_data = card_data.copy()
         clean_card_data = self._parse_date_format(clean_card_data)
@@ -104,33 +192,39 @@ class DataCleaning:
         clean_card_data = self._remove_non_numeric_symbols(clean_card_data, 'card_number')
         clean_card_data = self._drop_null_values(clean_card_data)
         clean_card_data.reset_index(drop=True, inplace=True)
-        return clean_card_data
+        return self._finish(clean_card_data)
 
     # Private methods for card data
+    @instrumented
     def _drop_null_values(self, df):
         return df.dropna()
     
+    @instrumented
     def _remove_short_card_numbers(self, df):
         # Remove rows with 'card_number' shorter than 8 digits
-        df = df[df['card_number'].str.len() >= 8]
+        # Arrow strings give missing values a missing length, which counts as too short
+        df = df[(df['card_number'].str.len() >= 8).fillna(False)]
         return df
     
+    @instrumented
     def _remove_long_expiry_dates(self, df):
         # Remove rows with 'expiry_date' longer than 5 characters
-        df = df[df['expiry_date'].str.len() <= 5]
+        df = df[(df['expiry_date'].str.len() <= 5).fillna(False)]
         return df
 
+    @instrumented
     def _parse_date_format(self, df):
-        # Assuming 'expiry_date' is in 'MM/YY' format and 'date_payment_confirmed' is in 'YYYY-MM-DD' format
-        df['date_payment_confirmed'] = pd.to_datetime(df['date_payment_confirmed'], format='%Y-%m-%d', errors='coerce').dt.date
-        return df
+        # 'expiry_date' stays in 'MM/YY' format; 'date_payment_confirmed' is mostly 'YYYY-MM-DD', with other formats
+        return self._parse_dates(df, ['date_payment_confirmed'])
     
+    @instrumented
     def _remove_non_numeric_symbols(self, df, column_name):
         # Use regular expressions to replace non-numeric characters with an empty string
         df[column_name] = df[column_name].str.replace(r'[^0-9]', '', regex=True)
         return df
 
 # 3. Public methods for store data
+    @instrumented
     def clean_store_data(self, stores_data):
         cleaned_store_data = stores_data.copy()
         cleaned_store_data = self._clean_date_columns(cleaned_store_data)
@@ -144,30 +238,29 @@ class DataCleaning:
             # Reset index
             cleaned_store_data.reset_index(drop=True, inplace=True)
         else:
-            print("'level_0' column not found in DataFrame. Exiting function.")
-            return cleaned_store_data 
+            print("'level_0' column not found in DataFrame.")
+        return self._finish(cleaned_store_data)
     
     # Private methods for card data
+    @instrumented
     def _clean_date_columns(self, df):
         date_columns = ['opening_date']
-        for column in date_columns:
-            df[column] = pd.to_datetime(df[column], infer_datetime_format=True, errors='coerce').dt.date
-        return df
+        return self._parse_dates(df, date_columns)
 
+    @instrumented
     def _remove_invalid_dates(self, df):
         pattern = r'^[a-zA-Z0-9]*$'
         mask = (df['opening_date'].isna()) | (df['opening_date'].astype(str).str.contains(pattern))
         df = df[~mask]
         return df
 
-    def _remove_non_numeric(self, value):
-        return re.sub(r'[^0-9]', '', str(value))
-    
+    @instrumented
     def _remove_non_numeric_staff(self, df):
         df = df.dropna(subset=['staff_numbers'], how='any')
-        df.loc[:, 'staff_numbers'] = df['staff_numbers'].apply(self._remove_non_numeric)
+        df['staff_numbers'] = df['staff_numbers'].astype(str).str.replace(r'[^0-9]', '', regex=True)
         return df
     
+    @instrumented
     def _correct_continent_names(self, df):
         continent_mapping = {
             "eeEurope": "Europe",
@@ -177,36 +270,58 @@ class DataCleaning:
         return df
 
 # 4. Public methods for product data
+    @instrumented
     def clean_product_data(self, product_df):
         cleaned_product_data = product_df.copy()
         cleaned_product_data = self._missing_and_random(cleaned_product_data, column='product_price')
         cleaned_product_data = self._convert_product_weights(cleaned_product_data)
         cleaned_product_data.reset_index(drop=True, inplace=True)
-        return cleaned_product_data
+        return self._finish(cleaned_product_data)
     
     # Private methods for product data
+    # Kilograms per unit used by _convert_product_weights. ml is converted 1:1 to g.
+    # (kilograms_per_unit, units_per_kilogram) of each unit. Weights are converted as
+    # count * value * kilograms_per_unit / units_per_kilogram, the operations of the original row-by-row parser in
+    # the same order, so that the kilograms are the same to the last bit ('500g' is 500 / 1000, not 500 * 0.001).
+    WEIGHT_UNITS = {
+        '': (1.0, 1),
+        'kg': (1.0, 1),
+        'g': (1.0, 1000),
+        'l': (1.0, 1),
+        'ml': (1.0, 1000),
+        'oz': (0.0283, 1),
+    }
+    WEIGHT_PATTERN = re.compile(r'^(?:(?P<count>\d+(?:\.\d*)?|\.\d+)\s*x\s*)?'
+                                r'(?P<value>\d+(?:\.\d*)?|\.\d+)\s*(?P<unit>[a-z]*)$')
+
+    def register_weight_unit(self, unit, kilograms_per_unit=1.0, units_per_kilogram=1):
+        self.weight_units[unit.lower()] = (kilograms_per_unit, units_per_kilogram)
+
+    @instrumented
     def _convert_product_weights(self, df):
-        decimal_of_kg = []
-        for index, row in df.iterrows():
-            weight = str(row['weight']).strip('.')
-            weight = str(weight).strip('l')
-            weight = str(weight).strip()  # remove any leading/trailing spaces
-            if weight.endswith('kg'):
-                decimal_of_kg.append(float(weight[:-2]))
-            elif 'x' in weight:
-                num, unit = weight.split('x')
-                decimal_of_kg.append(float(num) * float(unit.rstrip('g')) / 1000)
-            elif weight.endswith('g'):
-                decimal_of_kg.append(float(weight[:-1]) / 1000)
-            elif weight.endswith('oz'):
-                decimal_of_kg.append(float(weight[:-2]) * 0.0283)
-            elif weight.endswith('m'):
-                decimal_of_kg.append(float(weight[:-1]) / 1000)
-            else:
-                decimal_of_kg.append(float(weight))
+        # Weight strings repeat a lot, so parse each distinct string once and broadcast the result
+        codes, distinct_weights = pd.factorize(df['weight'])
+        weights = pd.Series(distinct_weights).astype(str).str.strip('.').str.strip().str.lower()
+        parts = weights.str.extract(self.WEIGHT_PATTERN)
+        # float() rather than pd.to_numeric, whose faster parser can round the last bit differently
+        count = parts['count'].map(float, na_action='ignore').astype(float)
+        value = parts['value'].map(float, na_action='ignore').astype(float)
+        # Multipacks such as '12 x 100' without a unit are weighed in grams
+        unit = parts['unit'].mask(count.notna() & (parts['unit'] == ''), 'g')
+        kilograms_per_unit = unit.map({name: factors[0] for name, factors in self.weight_units.items()})
+        units_per_kilogram = unit.map({name: factors[1] for name, factors in self.weight_units.items()})
+        distinct_kg = (count.fillna(1) * value * kilograms_per_unit / units_per_kilogram).to_numpy()
+        # factorize() gives missing weights the code -1
+        decimal_of_kg = pd.Series(np.where(codes >= 0, distinct_kg[codes], np.nan), index=df.index)
+        # Report the rows that could not be parsed instead of failing on the first one
+        unparsed = decimal_of_kg.isna() & df['weight'].notna()
+        self.unparsed_weights = df.loc[unparsed, 'weight']
+        if unparsed.any():
+            print(f"{unparsed.sum()} product weights could not be parsed, e.g. {self.unparsed_weights.unique()[:5].tolist()}")
         df.loc[:, 'weight'] = decimal_of_kg
         return df
     
+    @instrumented
     def _missing_and_random(self, df, column):      
         # Define a regular expression pattern to match rows with random symbols
         pattern = r'^[a-zA-Z0-9]*$'
@@ -217,6 +332,7 @@ class DataCleaning:
         return df
     
 # 5. Public methods for orders data
+    @instrumented
     def clean_orders_data(self, orders_data):
         cleaned_orders_data = orders_data.copy()
         cleaned_orders_data = self._remove_specific_columns(cleaned_orders_data)
@@ -227,9 +343,10 @@ class DataCleaning:
             cleaned_orders_data.reset_index(drop=True, inplace=True)
         else:
             print("'level_0' column not found in DataFrame.")
-        return cleaned_orders_data
+        return self._finish(cleaned_orders_data)
     
     # Private methods for card data
+    @instrumented
     def _remove_specific_columns(self, df):
         # Define columns to remove
         columns_to_remove = ['first_name', 'last_name', '1']
@@ -238,30 +355,37 @@ class DataCleaning:
         return df
     
 # 6. Public methods for datetime
+    @instrumented
     def clean_time(self, time_data):
         clean_time = time_data.copy()
         clean_time.dropna(how='all', inplace=True)
-        clean_time = self._convert_json_columns(clean_time)
+        # extract_s3_json already decodes month, day and year as integers, other sources still need converting
+        if not all(pd.api.types.is_numeric_dtype(clean_time[column]) for column in ['month', 'day', 'year']):
+            clean_time = self._convert_json_columns(clean_time)
         clean_time = self._filter_invalid_dates(clean_time)
         clean_time = self._filter_valid_time_periods(clean_time)
         clean_time.reset_index(drop=True, inplace=True)
-        return clean_time
+        return self._finish(clean_time)
     
     # Private methods for datetime
+    @instrumented
     def _filter_valid_time_periods(self, df):
         valid_time_periods = ['Evening', 'Morning', 'Midday', 'Late_Hours']
         return df[df['time_period'].isin(valid_time_periods)]
 
+    @instrumented
     def _filter_invalid_dates(self, df):
-        year_mask = ~df['year'].between(1992, 2022)
-        month_mask = ~df['month'].between(1, 12)
-        day_mask = ~df['day'].between(1, 31)
+        # Missing values of the nullable integer columns compare as missing, count them as invalid
+        year_mask = ~df['year'].between(1992, 2022).fillna(False).astype(bool)
+        month_mask = ~df['month'].between(1, 12).fillna(False).astype(bool)
+        day_mask = ~df['day'].between(1, 31).fillna(False).astype(bool)
         random_symbols = r'^[a-zA-Z0-9]*$'
         timest_mask = (df['timestamp'].isna()) | df['timestamp'].astype(str).str.contains(random_symbols)
         # Combine the masks for 'month' and 'day' columns using a logical OR
         combined_mask = year_mask | month_mask | day_mask | timest_mask
         return df[~combined_mask]
     
+    @instrumented
     def _convert_json_columns(self, df):
         df['month'] = pd.to_numeric(df['month'], errors='coerce')
         df['day'] = pd.to_numeric(df['day'], errors='coerce')
@@ -1,62 +1,174 @@
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import instrumentation, instrumented
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import QueuePool
+import io
+import logging
+import pandas as pd
+import re
+import threading
+import time
 import yaml
-from sqlalchemy import create_engine, text
+
+logger = logging.getLogger(__name__)
 
 
 class DatabaseConnector:
     """
     This class provides methods for connecting to a PostgreSQL database and performing database-related tasks.
 
+    One pooled engine is kept per credentials target and created lazily on first use:
+        - 'source': the AWS RDS database described in 'db_creds.yaml'.
+        - 'warehouse': the local sales_data database described in 'db_creds_local.yaml'.
+
     Attributes:
-        db_creds (dict): A dictionary containing the database credentials.
-        engine (sqlalchemy.engine.base.Engine): A SQLAlchemy database engine used for database connections.
+        pool_size (int): Number of connections kept open in each engine's pool.
+        max_overflow (int): Number of extra connections each pool may open under load.
+        engine (sqlalchemy.engine.base.Engine): The pooled engine for the source database.
 
     Methods:
-        1. read_db_creds()
-            - Reads the database credentials from a 'db_creds.yaml' file.
+        1. read_db_creds(path='db_creds.yaml')
+            - Reads the database credentials from a YAML file.
             - Returns:
                 - dict: A dictionary containing the database credentials.
 
         2. init_db_engine()
-            - Initializes a SQLAlchemy database engine using the database credentials.
+            - Returns the pooled SQLAlchemy engine for the source database, creating it on first use.
+            - Returns:
+                - sqlalchemy.engine.base.Engine: A SQLAlchemy database engine.
+
+        3. get_engine(target='source')
+            - Returns the pooled SQLAlchemy engine for 'source' or 'warehouse', creating it on first use.
             - Returns:
                 - sqlalchemy.engine.base.Engine: A SQLAlchemy database engine.
 
-        3. list_db_tables()
+        4. list_db_tables()
             - Lists all tables in the connected PostgreSQL database.
             - Returns:
                 - list: A list of table names in the 'public' schema of the database.
 
-        4. upload_to_db(data_df, table_name)
+        5. upload_to_db(data_df, table_name, method='copy', chunksize=100000, if_exists='replace', schema=None)
             - Uploads data from a Pandas DataFrame to a specified database table.
             - Parameters:
                 - data_df (DataFrame): The data to be uploaded.
                 - table_name (str): The name of the table in the database.
+                - method (str): 'copy' streams the rows with COPY ... FROM STDIN in a single transaction,
+                  'insert' uses DataFrame.to_sql. The COPY path falls back to to_sql only when the driver has no
+                  COPY support (anything but psycopg2); a failing COPY raises.
+                - chunksize (int): Number of rows buffered in memory per COPY call.
+                - if_exists (str): 'replace' recreates the table, 'append' adds the rows to it.
+                - schema (TableSchema): Final column types and derived columns of the table (see table_schemas.py).
+                  None creates the table with the types pandas infers.
+
+        6. copy_rows(frame, table_name, connection, chunksize=100000)
+            - Streams the rows of a DataFrame, already in the table's final shape, into an existing table with
+              COPY ... FROM STDIN on an open connection, as part of the caller's transaction.
+
+        7. run_sql_file(path, target='warehouse')
+            - Executes every statement of a SQL script in one transaction.
+            - Parameters:
+                - path (str): Path of the SQL script, e.g. 'star_schema.sql'.
+                - target (str): 'source' or 'warehouse'.
+
+        8. pool_statistics()
+            - Reports connection pool usage for every engine created so far.
+            - Returns:
+                - dict: Per target, the number of checkouts, new connections, total and maximum checkout wait time
+                  in seconds, and the connections currently checked out.
+
+        9. drop_keys(table_name)
+            - Drops the primary key and indexes of a warehouse table, and the foreign keys on it or referencing it,
+              so that it can be replaced or bulk loaded without maintaining them row by row.
+
+        10. create_primary_keys(schemas, workers=4), create_indexes(schemas, workers=4), create_foreign_keys(schemas)
+            - Create the primary keys, join indexes and foreign keys declared by the TableSchema of each table (see
+              table_schemas.py), skipping those that already exist and the tables that do not. Primary keys and
+              indexes are built on `workers` connections at once. Foreign keys are added one at a time: adding one
+              locks out any other change to the referencing table.
+            - Parameters:
+                - schemas (dict): TableSchema per table name, e.g. TABLE_SCHEMAS.
+
+        11. analyze(table_names, workers=4)
+            - Refreshes the planner statistics of the tables, several tables at once.
+
+        12. explain_sql_file(path, target='warehouse')
+            - Runs EXPLAIN (ANALYZE, FORMAT JSON) on every query of a SQL script, e.g. 'mdrc_data_query.sql'.
+            - Returns:
+                - list: Per query, its label (the comment above it), the planner's total cost, the execution time in
+                  milliseconds and the scan and join nodes of the plan.
 
-        5. close_connection()
-            - Closes the database connection if it's open.
+        13. close_connection()
+            - Disposes every pooled engine, closing their connections.
+
+        14. replace_table(table_name, frames, schema=None, chunksize=100000)
+            - Replaces a warehouse table with the rows of an iterable of DataFrames (e.g. the staged partitions of
+              the table), dropping, creating and loading it with COPY in a single transaction. The new table is only
+              seen once every frame is loaded: if one fails, or there are no rows, the previous table is kept as it
+              was.
+            - Returns:
+                - int: Number of rows loaded.
 
     Usage:
-        Example usage of this class can be found in the '__main__' block of this script.
+        Example usage of this class can be found in main.py.
     """
-    def __init__(self):
+    CREDS_FILES = {
+        'source': 'db_creds.yaml',
+        'warehouse': 'db_creds_local.yaml',
+    }
 
-        self.db_creds = self.read_db_creds()
-        self.engine = self.init_db_engine()
-        
-    def read_db_creds(self):
+    def __init__(self, pool_size=5, max_overflow=10):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self._engines = {}
+        self._pool_stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        return self.get_engine('source')
+
+    def read_db_creds(self, path='db_creds.yaml'):
         try:
-            with open('db_creds.yaml', 'r') as yaml_file:
+            with open(path, 'r') as yaml_file:
                 db_creds = yaml.safe_load(yaml_file)
                 return db_creds
         except FileNotFoundError:
-            print("db_creds.yaml file not found. Make sure to create it with the correct credentials.")
+            print(f"{path} file not found. Make sure to create it with the correct credentials.")
             return {}
         
     def init_db_engine(self):
-        db_url = f"postgresql://{self.db_creds['RDS_USER']}:{self.db_creds['RDS_PASSWORD']}@{self.db_creds['RDS_HOST']}:{self.db_creds['RDS_PORT']}/{self.db_creds['RDS_DATABASE']}"
-        engine = create_engine(db_url)
+        return self.get_engine('source')
+
+    def get_engine(self, target='source'):
+        with self._lock:
+            if target not in self._engines:
+                self._engines[target] = self._create_engine(target)
+            return self._engines[target]
+
+    def _create_engine(self, target):
+        creds = self.read_db_creds(self.CREDS_FILES[target])
+        if target == 'source':
+            db_url = f"postgresql://{creds['RDS_USER']}:{creds['RDS_PASSWORD']}@{creds['RDS_HOST']}:{creds['RDS_PORT']}/{creds['RDS_DATABASE']}"
+        else:
+            db_url = f"{'postgresql'}+{'psycopg2'}://{creds['user']}:{creds['password']}@{creds['host']}:{creds['port']}/{creds['dbname']}"
+        engine = create_engine(db_url, poolclass=_TimedQueuePool, pool_size=self.pool_size,
+                               max_overflow=self.max_overflow, pool_pre_ping=True)
+        stats = _PoolStats()
+        engine.pool.stats = stats
+        event.listen(engine, 'connect', lambda dbapi_connection, connection_record: stats.record_connect())
+        self._pool_stats[target] = stats
         return engine
 
+    def pool_statistics(self):
+        # Copied under the lock, as get_engine may add an engine while the statistics are read
+        with self._lock:
+            engines = dict(self._engines)
+        statistics = {}
+        for target, engine in engines.items():
+            statistics[target] = dict(self._pool_stats[target].as_dict(), checked_out=engine.pool.checkedout())
+        return statistics
+
+    @instrumented
     def list_db_tables(self):
         with self.engine.connect() as connection:
             query = text("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
@@ -65,14 +177,269 @@ class DatabaseConnector:
             # print(table_names)  
         return table_names
 
-    def upload_to_db(self, data_df, table_name):
-        with open('db_creds_local.yaml') as db_creds_local:
-            creds = yaml.safe_load(db_creds_local) 
-        engine = create_engine(f"{'postgresql'}+{'psycopg2'}://{creds['user']}:{creds['password']}@{creds['host']}:{creds['port']}/{creds['dbname']}")
-        engine.connect()
-        data_df.to_sql(table_name, engine, if_exists='replace')
+    @instrumented
+    def upload_to_db(self, data_df, table_name, method='copy', chunksize=100000, if_exists='replace', schema=None):
+        engine = self.get_engine('warehouse')
+        # to_sql writes the index as a column as well, so do the same to keep the table layout
+        frame = data_df.reset_index()
+        if schema is not None:
+            frame = schema.prepare(frame)
+        if method == 'copy':
+            # A failing COPY means bad rows or a bad table (DataError, IntegrityError, ProgrammingError), which
+            # to_sql would only hit again more slowly, so it is raised; only a driver without COPY falls back
+            if engine.dialect.driver == 'psycopg2':
+                self._copy_to_db(frame, table_name, engine, chunksize, if_exists, schema)
+                return
+            logger.warning("The %s driver has no COPY support, uploading '%s' with to_sql",
+                           engine.dialect.driver, table_name)
+        frame.to_sql(table_name, engine, if_exists=if_exists, index=False,
+                     dtype=schema.columns if schema is not None else None)
+
+    def _copy_to_db(self, frame, table_name, engine, chunksize, if_exists, schema):
+        # engine.begin() wraps the DROP, CREATE and every COPY chunk in one transaction
+        with engine.begin() as connection:
+            if if_exists == 'replace':
+                connection.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+            if if_exists == 'replace' or not engine.dialect.has_table(connection, table_name):
+                create_sql = (schema.create_table_sql(table_name) if schema is not None
+                              else pd.io.sql.get_schema(frame, table_name, con=connection))
+                connection.execute(text(create_sql))
+            self.copy_rows(frame, table_name, connection, chunksize)
+
+    @instrumented
+    def replace_table(self, table_name, frames, schema=None, chunksize=100000):
+        rows = 0
+        with self.get_engine('warehouse').connect() as connection:
+            with connection.begin() as transaction:
+                connection.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+                created = False
+                for data_df in frames:
+                    # The same frame upload_to_db writes: the index as a column, in the table's final shape
+                    frame = data_df.reset_index()
+                    if schema is not None:
+                        frame = schema.prepare(frame)
+                    if not created:
+                        create_sql = (schema.create_table_sql(table_name) if schema is not None
+                                      else pd.io.sql.get_schema(frame, table_name, con=connection))
+                        connection.execute(text(create_sql))
+                        created = True
+                    self.copy_rows(frame, table_name, connection, chunksize)
+                    rows += len(frame)
+                if not rows:
+                    transaction.rollback()
+        return rows
+
+    def copy_rows(self, frame, table_name, connection, chunksize=100000):
+        columns = ', '.join(f'"{column}"' for column in frame.columns)
+        copy_sql = f"""COPY "{table_name}" ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"""
+        with connection.connection.cursor() as cursor:
+            for start in range(0, len(frame), chunksize):
+                buffer = io.StringIO()
+                frame.iloc[start:start + chunksize].to_csv(buffer, index=False, header=False, na_rep='\\N')
+                instrumentation.record_bytes(buffer.tell())
+                buffer.seek(0)
+                cursor.copy_expert(copy_sql, buffer)
+
+    @instrumented
+    def run_sql_file(self, path, target='warehouse'):
+        with open(path) as sql_file:
+            script = sql_file.read()
+        # exec_driver_sql passes the script straight to psycopg2, which runs multiple statements in one call
+        with self.get_engine(target).begin() as connection:
+            connection.exec_driver_sql(script)
+
+    # Drop the keys and indexes of a table before it is reloaded, starting with the foreign keys referencing it
+    @instrumented
+    def drop_keys(self, table_name):
+        constraints_query = text("""
+            SELECT conrelid::regclass::text, conname FROM pg_constraint
+            WHERE contype IN ('p', 'f', 'u')
+              AND to_regclass(quote_ident(:table_name)) IN (conrelid, confrelid)
+            ORDER BY contype = 'f' DESC""")
+        indexes_query = text("SELECT indexrelid::regclass::text FROM pg_index "
+                             "WHERE indrelid = to_regclass(quote_ident(:table_name))")
+        # Each statement commits on its own, so that no lock is held on one table while waiting for another
+        with self.get_engine('warehouse').connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            for table, constraint in connection.execute(constraints_query, {'table_name': table_name}).fetchall():
+                connection.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS "{constraint}"'))
+            for index in connection.execute(indexes_query, {'table_name': table_name}).fetchall():
+                connection.execute(text(f'DROP INDEX IF EXISTS {index[0]}'))
+
+    @instrumented
+    def create_primary_keys(self, schemas, workers=4):
+        tables, constraints, _ = self._catalog()
+        statements = [f'ALTER TABLE "{table_name}" ADD CONSTRAINT "{table_name}_pkey" '
+                      f'PRIMARY KEY ("{schema.primary_key}")'
+                      for table_name, schema in schemas.items()
+                      if schema.primary_key and table_name in tables and f'{table_name}_pkey' not in constraints]
+        self._execute_in_parallel(statements, workers)
+
+    @instrumented
+    def create_indexes(self, schemas, workers=4):
+        tables, _, indexes = self._catalog()
+        # CREATE INDEX only blocks writes, so several indexes of the same table can be built at once
+        statements = [f'CREATE INDEX "ix_{table_name}_{column}" ON "{table_name}" ("{column}")'
+                      for table_name, schema in schemas.items() if table_name in tables
+                      for column in schema.indexes if f'ix_{table_name}_{column}' not in indexes]
+        self._execute_in_parallel(statements, workers)
+
+    @instrumented
+    def create_foreign_keys(self, schemas):
+        tables, constraints, _ = self._catalog()
+        statements = [f'ALTER TABLE "{table_name}" ADD CONSTRAINT "{table_name}_{column}_fkey" '
+                      f'FOREIGN KEY ("{column}") REFERENCES "{referenced_table}" '
+                      f'("{schemas[referenced_table].primary_key}")'
+                      for table_name, schema in schemas.items() if table_name in tables
+                      for column, referenced_table in schema.foreign_keys.items()
+                      if referenced_table in tables and f'{table_name}_{column}_fkey' not in constraints]
+        self._execute_in_parallel(statements, workers=1)
+
+    @instrumented
+    def analyze(self, table_names, workers=4):
+        tables, _, _ = self._catalog()
+        self._execute_in_parallel([f'ANALYZE "{table_name}"' for table_name in table_names if table_name in tables],
+                                  workers)
+
+    def _catalog(self):
+        # Tables, constraints and indexes of the warehouse schema the connections use
+        with self.get_engine('warehouse').connect() as connection:
+            tables = {row[0] for row in connection.execute(text(
+                "SELECT tablename FROM pg_tables WHERE schemaname = current_schema()"))}
+            constraints = {row[0] for row in connection.execute(text(
+                "SELECT conname FROM pg_constraint WHERE connamespace = current_schema()::regnamespace"))}
+            indexes = {row[0] for row in connection.execute(text(
+                "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()"))}
+        return tables, constraints, indexes
+
+    def _execute_in_parallel(self, statements, workers):
+        engine = self.get_engine('warehouse')
+
+        def execute(statement):
+            with engine.begin() as connection:
+                connection.execute(text(statement))
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(statements) or 1))) as executor:
+            # list() re-raises the first failure
+            list(executor.map(execute, statements))
+
+    @instrumented
+    def explain_sql_file(self, path, target='warehouse'):
+        with open(path) as sql_file:
+            script = sql_file.read()
+        plans = []
+        with self.get_engine(target).connect() as connection:
+            for label, query in _split_sql_script(script):
+                # Through the DBAPI cursor, so that a '%' in the query is not taken for a parameter
+                with connection.connection.cursor() as cursor:
+                    cursor.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}")
+                    plan = cursor.fetchone()[0][0]
+                plans.append({'label': label, 'total_cost': plan['Plan']['Total Cost'],
+                              'execution_ms': plan['Execution Time'], 'nodes': _plan_nodes(plan['Plan'])})
+            connection.connection.rollback()
+        return plans
 
     def close_connection(self):
-        if hasattr(self, 'conn'):
-            self.engine.dispose()
-            print("Database connection closed")
\ No newline at end of file
+        if not self._engines:
+            return
+        for target, stats in self.pool_statistics().items():
+            print(f"Connection pool '{target}': {stats['checkouts']} checkouts, {stats['connects']} new connections, "
+                  f"{stats['wait_time']:.3f} s waiting")
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+        print("Database connection closed")
+
+
+# Opening tag of a dollar-quoted string, e.g. $$ or $body$
+_DOLLAR_QUOTE = re.compile(r'\$[A-Za-z_]*\$')
+
+
+def _split_sql_script(script):
+    # Yields (label, query) for every statement of a script, the label being the comment lines above the statement
+    for statement in _split_statements(script):
+        lines = statement.strip().splitlines()
+        comments = [line.strip(' -\t') for line in lines if line.strip().startswith('--')]
+        query = '\n'.join(line for line in lines if not line.strip().startswith('--')).strip()
+        if query:
+            yield ' '.join(comment for comment in comments if comment), query
+
+
+def _split_statements(script):
+    # Splits on the semicolons ending statements, skipping those in quoted strings and identifiers, comments and
+    # dollar-quoted bodies. A doubled quote inside a string is read as the end of one string and the start of the next.
+    start = position = 0
+    while position < len(script):
+        char = script[position]
+        dollar_quote = _DOLLAR_QUOTE.match(script, position) if char == '$' else None
+        if char in ("'", '"'):
+            end = script.find(char, position + 1)
+            position = len(script) if end < 0 else end + 1
+        elif script.startswith('--', position):
+            end = script.find('\n', position)
+            position = len(script) if end < 0 else end + 1
+        elif script.startswith('/*', position):
+            end = script.find('*/', position + 2)
+            position = len(script) if end < 0 else end + 2
+        elif dollar_quote and (position == 0 or not (script[position - 1].isalnum() or script[position - 1] == '_')):
+            end = script.find(dollar_quote.group(), dollar_quote.end())
+            position = len(script) if end < 0 else end + len(dollar_quote.group())
+        elif char == ';':
+            yield script[start:position]
+            start = position = position + 1
+        else:
+            position += 1
+    yield script[start:]
+
+
+def _plan_nodes(plan):
+    # Scan and join nodes of a JSON plan, e.g. ['Hash Join', 'Seq Scan on orders_table']
+    nodes = []
+    if 'Scan' in plan['Node Type'] or 'Join' in plan['Node Type'] or plan['Node Type'] == 'Nested Loop':
+        relation = plan.get('Relation Name')
+        nodes.append(f"{plan['Node Type']} on {relation}" if relation else plan['Node Type'])
+    for child in plan.get('Plans', []):
+        nodes.extend(_plan_nodes(child))
+    return nodes
+
+
+class _TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waits for a free connection.
+    """
+    stats = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.stats is not None:
+                self.stats.record_checkout(time.perf_counter() - start)
+
+
+class _PoolStats:
+    """
+    Thread-safe counters for one connection pool.
+    """
+    def __init__(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._lock = threading.Lock()
+
+    def record_checkout(self, wait_time):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {'checkouts': self.checkouts, 'connects': self.connects,
+                    'wait_time': self.wait_time, 'max_wait_time': self.max_wait_time}
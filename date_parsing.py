@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import threading
+
+
+class DateParser:
+    """
+    This class parses columns of dates written in a mix of formats ('2010 October 04', '1994/11/24', 'May 2003 27'),
+    as the store, card and user sources have them.
+
+    pd.to_datetime(infer_datetime_format=True) infers a single format from the first value. Depending on that format,
+    the values in other formats are either parsed one at a time with dateutil, repeating the work for every copy of a
+    string, or, with errors='coerce', turned into NaT, so which dates survived depended on the first row. Here the
+    column is factorized first, so each distinct string is parsed once and the result broadcast to its rows, and the
+    distinct strings go through tiers of formats, each parsed for all the remaining strings at once:
+        1. The fixed ISO format most of the values are in.
+        2. The other formats the sources are known to mix in.
+        3. Whatever is left, with the per-value parsing pd.to_datetime does without a format, so that every value
+           parsed before is still parsed the same way. Values that do not parse there either become NaT.
+    Parsed strings are remembered across calls, so a table cleaned chunk by chunk parses each distinct string once.
+    A parser can be shared by threads: each call reads the memory as it was when the call started, and the strings
+    it parsed are added under a lock, skipping those another thread added in the meantime.
+
+    Attributes:
+        format_tiers (tuple): Tuples of strptime formats, tried in order.
+        fallback (bool): Whether the strings no format matches are parsed one at a time (tier 3).
+        max_cache_size (int): Distinct strings remembered; the memory is emptied when it would grow past this.
+
+    Methods:
+        1. parse(values)
+            - Parses a Series of dates in any of the formats.
+            - Returns:
+                - Series: datetime64 values, with the index of values, and NaT for the values that could not be parsed.
+    """
+    FORMAT_TIERS = (
+        ('%Y-%m-%d',),
+        ('%Y/%m/%d', '%Y %B %d', '%B %Y %d'),
+    )
+
+    def __init__(self, format_tiers=None, fallback=True, max_cache_size=1000000):
+        self.format_tiers = format_tiers or self.FORMAT_TIERS
+        self.fallback = fallback
+        self.max_cache_size = max_cache_size
+        self._cache = pd.Series([], dtype='datetime64[ns]')
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks cannot be pickled, e.g. to the processes of parallel_cleaning.py
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def parse(self, values):
+        if not isinstance(values, pd.Series):
+            values = pd.Series(values)
+        # factorize() gives missing values the code -1
+        codes, uniques = pd.factorize(values)
+        uniques = pd.Index(pd.Series(uniques).astype(object))
+        # The memory is replaced, never changed in place, so this call can read it without the lock
+        with self._lock:
+            cache = self._cache
+        positions = cache.index.get_indexer(uniques)
+        known = positions >= 0
+        distinct = np.full(len(uniques), np.datetime64('NaT'), dtype='datetime64[ns]')
+        distinct[known] = cache.to_numpy()[positions[known]]
+        distinct[~known] = self._parse_distinct(uniques[~known])
+        self._remember(uniques[~known], distinct[~known])
+        parsed = np.where(codes >= 0, distinct[codes], np.datetime64('NaT'))
+        return pd.Series(parsed, index=values.index, name=values.name, dtype='datetime64[ns]')
+
+    def _parse_distinct(self, uniques):
+        parsed = pd.Series(np.datetime64('NaT'), index=range(len(uniques)), dtype='datetime64[ns]')
+        # Dates that are not strings (datetime.date, Timestamp) skip the formats
+        is_text = np.fromiter((isinstance(value, str) for value in uniques), dtype=bool, count=len(uniques))
+        strings = pd.Series(uniques, dtype=object)
+        remaining = is_text.copy()
+        for formats in self.format_tiers:
+            for date_format in formats:
+                if not remaining.any():
+                    break
+                attempt = pd.to_datetime(strings[remaining], format=date_format, errors='coerce')
+                parsed[attempt.index] = attempt
+                remaining[attempt.index[attempt.notna()]] = False
+        remaining |= ~is_text
+        if self.fallback and remaining.any():
+            parsed[remaining] = pd.to_datetime(strings[remaining], errors='coerce')
+        return parsed.to_numpy()
+
+    def _remember(self, uniques, parsed):
+        if not len(uniques):
+            return
+        remembered = pd.Series(parsed, index=uniques, dtype='datetime64[ns]')
+        with self._lock:
+            # Another thread may have parsed some of the same strings since, the memory keeps one of each
+            remembered = remembered[~remembered.index.isin(self._cache.index)]
+            if len(self._cache) + len(remembered) > self.max_cache_size:
+                self._cache = remembered.iloc[max(len(remembered) - self.max_cache_size, 0):]
+            else:
+                self._cache = pd.concat([self._cache, remembered])
@@ -0,0 +1,264 @@
+from instrumentation import instrumented
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+import io
+import numpy as np
+import pandas as pd
+
+
+# Odd 64-bit constant the running row hash is multiplied by before each column hash is mixed in
+FINGERPRINT_MULTIPLIER = np.uint64(0x100000001B3)
+# Hash of a missing value, whatever the dtype of the column
+MISSING_HASH = np.uint64(0x9E3779B97F4A7C15)
+
+
+class DimensionUpserter:
+    """
+    This class updates a dimension table in place with the rows of a new extraction that are new or changed, instead
+    of dropping and rewriting the whole table.
+
+    Every row gets a fingerprint: a 64-bit hash of all its values, in the table's final shape, computed for a whole
+    frame at once from one pd.util.hash_array per column. The columns written from the frame's index ('index', or
+    'level_0' next to an 'index' from the source) are left out: they only number the rows of an extraction, and a
+    row removed upstream renumbers every row after it. They are written for new rows but never compared or updated.
+    The fingerprint of every row written is kept in the warehouse, by primary key, in a table named after the
+    dimension table (e.g. 'dim_users_fingerprints'). An upsert, in one transaction:
+        1. Reads the stored fingerprints of the table. They are only trusted while the table is the one they were
+           written for (same relation OID, recorded in 'fingerprint_tables'): after a full load that did not record
+           them they are discarded, and every row is compared in the database once.
+        2. Fingerprints the new rows one frame at a time and copies the rows whose fingerprint differs, or is not
+           stored, into a temporary table.
+        3. Writes them with INSERT ... ON CONFLICT (primary key) DO UPDATE, counting inserted and updated rows, and
+           stores their fingerprints. A row whose values turn out to be those already in the table is not rewritten,
+           and counts as unchanged.
+        4. Optionally deletes the rows written by earlier loads whose key is no longer extracted. Rows still
+           referenced by a foreign key (e.g. from orders_table) are kept, as are the placeholder rows added by
+           star_schema.sql, which have no fingerprint.
+    Every upsert that writes or deletes a row also increments the table's change counter in 'fingerprint_tables', so
+    that anything derived from the table (see rollups.py) can tell it changed.
+
+    Attributes:
+        db_connector (DatabaseConnector): Connector to the warehouse.
+
+    Methods:
+        1. record(table_name, frames, schema)
+            - Stores the fingerprints of the rows of a table just loaded in full, so that the next upsert only
+              writes what changed since.
+            - Returns:
+                - bool: True, or False if the rows repeat a key and cannot be upserted.
+
+        2. upsert(table_name, frames, schema, delete=False)
+            - Upserts the rows of a DataFrame, or an iterable of DataFrames, cleaned for the table.
+            - Returns:
+                - dict: Number of rows 'unchanged', 'updated', 'inserted', 'deleted' and 'kept' (not deleted as
+                  still referenced), or None when the table cannot be upserted (it does not exist, has no primary
+                  key in the warehouse, or the new rows repeat a key) and needs a full load instead.
+    """
+    def __init__(self, db_connector):
+        self.db_connector = db_connector
+
+    @instrumented
+    def record(self, table_name, frames, schema):
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+        fingerprint_table = _fingerprint_table(table_name)
+        try:
+            with self.db_connector.get_engine('warehouse').begin() as connection:
+                self._create_registry(connection)
+                # Written whole, with the primary key built once the rows are in
+                connection.execute(text(f'DROP TABLE IF EXISTS "{fingerprint_table}"'))
+                connection.execute(text(f'CREATE TABLE "{fingerprint_table}" (key TEXT, fingerprint BIGINT NOT NULL)'))
+                for df in frames:
+                    if df.empty:
+                        continue
+                    prepared = schema.prepare(df.reset_index())
+                    fingerprints = _fingerprints(prepared.drop(columns=_positional_columns(df)))
+                    self.db_connector.copy_rows(pd.DataFrame({'key': _key_text(prepared[schema.primary_key]),
+                                                              'fingerprint': fingerprints}),
+                                                fingerprint_table, connection)
+                try:
+                    connection.execute(text(f'ALTER TABLE "{fingerprint_table}" ADD PRIMARY KEY (key)'))
+                except IntegrityError:
+                    raise _RepeatedKeys() from None
+                self._register(connection, table_name, changed=False)
+        except _RepeatedKeys:
+            print(f"'{table_name}' repeats {schema.primary_key} values, which cannot be upserted.")
+            return False
+        return True
+
+    @instrumented
+    def upsert(self, table_name, frames, schema, delete=False):
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+        try:
+            return self._upsert(table_name, frames, schema, delete)
+        except _RepeatedKeys:
+            print(f"'{table_name}' repeats {schema.primary_key} values, which cannot be upserted.")
+            return None
+
+    def _upsert(self, table_name, frames, schema, delete):
+        key = schema.primary_key
+        fingerprint_table = _fingerprint_table(table_name)
+        with self.db_connector.get_engine('warehouse').begin() as connection:
+            if key is None or not self._has_unique_key(connection, table_name, key):
+                return None
+            self._create_registry(connection)
+            connection.execute(text(f'CREATE TABLE IF NOT EXISTS "{fingerprint_table}" '
+                                    '(key TEXT PRIMARY KEY, fingerprint BIGINT NOT NULL)'))
+            stored = self._stored_fingerprints(connection, table_name)
+            connection.execute(text(f'CREATE TEMPORARY TABLE upsert_rows (LIKE "{table_name}") ON COMMIT DROP'))
+            connection.execute(text('CREATE TEMPORARY TABLE upsert_fingerprints (key TEXT, fingerprint BIGINT) '
+                                    'ON COMMIT DROP'))
+            counts = {'unchanged': 0, 'updated': 0, 'inserted': 0, 'deleted': 0, 'kept': 0}
+            seen_keys = []
+            positional = []
+            for df in frames:
+                if df.empty:
+                    continue
+                prepared = schema.prepare(df.reset_index())
+                positional += [column for column in _positional_columns(df) if column not in positional]
+                keys = _key_text(prepared[key])
+                fingerprints = _fingerprints(prepared.drop(columns=positional))
+                unchanged = (stored.reindex(keys).reset_index(drop=True) == fingerprints).fillna(False).to_numpy(
+                    dtype=bool)
+                seen_keys.append(keys)
+                self.db_connector.copy_rows(prepared[~unchanged], 'upsert_rows', connection)
+                self.db_connector.copy_rows(pd.DataFrame({'key': keys[~unchanged],
+                                                          'fingerprint': fingerprints[~unchanged]}),
+                                            'upsert_fingerprints', connection)
+            seen_keys = pd.concat(seen_keys) if seen_keys else pd.Series([], dtype=object)
+            if seen_keys.duplicated().any():
+                # Leaves the transaction, rolling it back
+                raise _RepeatedKeys()
+            columns = ', '.join(f'"{column}"' for column in schema.columns)
+            # A row renumbered by the extraction keeps the number it was first written with
+            values = [column for column in schema.columns if column != key and column not in positional]
+            updates = ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in values)
+            current = ', '.join(f't."{column}"' for column in values)
+            new = ', '.join(f'EXCLUDED."{column}"' for column in values)
+            # Rows equal to the stored ones (all of them, the first time, when no fingerprint is stored yet) are
+            # left as they are
+            written = [row[0] for row in connection.execute(text(f"""
+                INSERT INTO "{table_name}" AS t ({columns}) SELECT {columns} FROM upsert_rows
+                ON CONFLICT ("{key}") DO UPDATE SET {updates}
+                WHERE ({current}) IS DISTINCT FROM ({new})
+                RETURNING (xmax = 0)"""))]
+            counts['inserted'] = sum(written)
+            counts['updated'] = len(written) - counts['inserted']
+            counts['unchanged'] = len(seen_keys) - len(written)
+            connection.execute(text(f"""
+                INSERT INTO "{fingerprint_table}" (key, fingerprint)
+                SELECT key, fingerprint FROM upsert_fingerprints ORDER BY key
+                ON CONFLICT (key) DO UPDATE SET fingerprint = EXCLUDED.fingerprint"""))
+            if delete:
+                missing_keys = stored.index.difference(pd.Index(seen_keys))
+                counts['deleted'], counts['kept'] = self._delete(connection, table_name, schema, missing_keys)
+            self._register(connection, table_name, changed=bool(written or counts['deleted']))
+        return counts
+
+    def _has_unique_key(self, connection, table_name, key):
+        # ON CONFLICT needs a unique index on the key; there is none after a full load until the primary key is built
+        return connection.execute(text("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_index i
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                WHERE i.indrelid = to_regclass(quote_ident(:table_name)) AND i.indisunique AND i.indnatts = 1
+                  AND a.attname = :key)"""), {'table_name': table_name, 'key': key}).scalar()
+
+    def _create_registry(self, connection):
+        connection.execute(text("""
+            CREATE TABLE IF NOT EXISTS fingerprint_tables (
+                table_name TEXT PRIMARY KEY, table_oid OID NOT NULL, changes BIGINT NOT NULL DEFAULT 0)"""))
+
+    def _register(self, connection, table_name, changed):
+        connection.execute(text("""
+            INSERT INTO fingerprint_tables (table_name, table_oid, changes)
+            VALUES (:table_name, to_regclass(quote_ident(:table_name))::oid, CAST(:changed AS int))
+            ON CONFLICT (table_name) DO UPDATE
+            SET table_oid = EXCLUDED.table_oid, changes = fingerprint_tables.changes + EXCLUDED.changes"""),
+            {'table_name': table_name, 'changed': int(changed)})
+
+    def _stored_fingerprints(self, connection, table_name):
+        fingerprint_table = _fingerprint_table(table_name)
+        current = connection.execute(text("""
+            SELECT table_oid = to_regclass(quote_ident(:table_name))::oid FROM fingerprint_tables
+            WHERE table_name = :table_name"""), {'table_name': table_name}).scalar()
+        if not current:
+            # The table was replaced since its fingerprints were written
+            connection.execute(text(f'TRUNCATE "{fingerprint_table}"'))
+            return pd.Series([], dtype='Int64')
+        # COPY is read much faster than rows fetched one by one
+        buffer = io.StringIO()
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f'COPY "{fingerprint_table}" (key, fingerprint) TO STDOUT WITH (FORMAT csv)', buffer)
+        buffer.seek(0)
+        stored = pd.read_csv(buffer, header=None, names=['key', 'fingerprint'], index_col='key',
+                             dtype={'key': str, 'fingerprint': 'int64'}, keep_default_na=False)
+        return stored['fingerprint'].astype('Int64')
+
+    def _delete(self, connection, table_name, schema, missing_keys):
+        if missing_keys.empty:
+            return 0, 0
+        key = schema.primary_key
+        key_type = schema.columns[key].compile(dialect=postgresql.dialect())
+        connection.execute(text('CREATE TEMPORARY TABLE upsert_deleted (key TEXT) ON COMMIT DROP'))
+        self.db_connector.copy_rows(pd.DataFrame({'key': missing_keys}), 'upsert_deleted', connection)
+        referencing = connection.execute(text("""
+            SELECT c.conrelid::regclass::text, a.attname
+            FROM pg_constraint c
+            JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+            WHERE c.contype = 'f' AND c.confrelid = to_regclass(quote_ident(:table_name))"""),
+            {'table_name': table_name}).fetchall()
+        still_referenced = ''.join(f' AND NOT EXISTS (SELECT 1 FROM {referencing_table} r '
+                                   f'WHERE r."{column}" = d."{key}")' for referencing_table, column in referencing)
+        deleted = connection.execute(text(f"""
+            DELETE FROM "{table_name}" d USING upsert_deleted x
+            WHERE d."{key}" = CAST(x.key AS {key_type}){still_referenced}
+            RETURNING x.key""")).fetchall()
+        connection.execute(text(f'DELETE FROM "{_fingerprint_table(table_name)}" WHERE key = ANY(:keys)'),
+                           {'keys': [row[0] for row in deleted]})
+        return len(deleted), len(missing_keys) - len(deleted)
+
+
+class _RepeatedKeys(Exception):
+    pass
+
+
+def _fingerprint_table(table_name):
+    return f'{table_name}_fingerprints'
+
+
+def _key_text(keys):
+    # The text of a key as stored with its fingerprint, the same for every dtype the key may be cleaned into
+    return keys.astype(object).where(keys.notna(), None).astype(str).reset_index(drop=True)
+
+
+def _positional_columns(df):
+    # The columns reset_index() adds for the index of the frame
+    return [column for column in df.iloc[:0].reset_index().columns if column not in df.columns]
+
+
+def _fingerprints(frame):
+    # One hash per column, mixed into one per row
+    combined = np.zeros(len(frame), dtype='uint64')
+    for column in frame.columns:
+        combined = (combined * FINGERPRINT_MULTIPLIER) ^ _column_hashes(frame[column])
+    return pd.Series(combined.view('int64'))
+
+
+def _column_hashes(values):
+    # Integers are hashed as int64 and everything but numbers and dates as text, so that the dtypes a column happens
+    # to be cleaned into (object, categorical, Arrow strings, downcast or nullable integers) do not change the hash
+    missing = values.isna().to_numpy()
+    if pd.api.types.is_integer_dtype(values.dtype) or pd.api.types.is_bool_dtype(values.dtype):
+        hashes = pd.util.hash_array(values.astype('Int64').fillna(0).to_numpy(dtype='int64'))
+    elif pd.api.types.is_float_dtype(values.dtype) or pd.api.types.is_datetime64_any_dtype(values.dtype):
+        hashes = pd.util.hash_array(values.to_numpy())
+    else:
+        text = values.astype(object).where(~missing, '')
+        if pd.api.types.infer_dtype(text, skipna=False) != 'string':
+            text = text.astype(str)
+        hashes = pd.util.hash_array(text.to_numpy(), categorize=False)
+    hashes[missing] = MISSING_HASH
+    return hashes
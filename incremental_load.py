@@ -0,0 +1,173 @@
+from instrumentation import instrumented
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError, OperationalError
+import time
+
+
+class IncrementalLoader:
+    """
+    This class appends the rows added to a source RDS table since it was last loaded to its warehouse table, instead
+    of extracting, cleaning and rewriting the whole table on every run.
+
+    A high-water mark is kept per source table in the warehouse table 'load_watermarks': the highest value already
+    loaded of an increasing integer key of the source (e.g. 'level_0'), and the highest 'index' of the warehouse
+    table. An append:
+        1. Locks the watermark row in a warehouse transaction.
+        2. Streams the source rows past the mark in key order, cleans each chunk, numbers its rows on from the
+           highest 'index' of the warehouse table, and copies it into a temporary table.
+        3. Adds a placeholder row (the key alone) to dim_card_details, dim_store_details and dim_products for any key
+           of the new rows that a foreign key of the warehouse table would reject, as star_schema.sql does after a
+           full load. No other table gets placeholders, as after a full load: dim_date_times in particular, whose
+           rows the reports of mdrc_data_query.sql and SalesRollups (rollups.py) read the year and time of. New rows
+           with a key missing from another dimension table fail the append, which is then rolled back.
+        4. Appends the new rows to the warehouse table and moves the mark to the highest key extracted.
+    The rows and the mark are committed together, so an append that fails or is interrupted leaves both as they
+    were, and running it again extracts the same rows again. As the rows are extracted in key order, an extraction
+    that stops early still leaves a mark below which every row is loaded. Only the delta is read, cleaned and
+    written; with an index on the key column of the source, the extraction does not scan the earlier rows either.
+
+    Only rows added with a higher key are picked up. Updated or deleted source rows need a full load, which forgets
+    the mark while the table is replaced and saves the mark of the rows it loaded at the end.
+
+    Attributes:
+        db_connector (DatabaseConnector): Connector to the source and warehouse databases.
+        data_extractor (DataExtractor): Extractor streaming the source rows.
+        retries (int): Attempts at an append failing on a lost database connection.
+
+    Methods:
+        1. high_water_mark(source_table)
+            - Returns:
+                - int: The highest key of the source table loaded, or None if the table has no mark.
+
+        2. save(source_table, target_table, key_column, high_water_mark)
+            - Records the mark after a full load of target_table, with the highest 'index' of the loaded table.
+
+        3. forget(source_table)
+            - Removes the mark of a table, so that it is fully loaded before it can be appended to.
+
+        4. append(source_table, target_table, key_column, clean, schema, chunksize=50000)
+            - Appends the source rows past the mark, cleaned by clean, in the final shape of schema.
+            - Returns:
+                - int: Number of rows appended, or None if the table has no mark and needs a full load.
+    """
+    # Dimension tables star_schema.sql adds placeholder rows to after a full load
+    PLACEHOLDER_TABLES = ('dim_card_details', 'dim_store_details', 'dim_products')
+
+    def __init__(self, db_connector, data_extractor, retries=3):
+        self.db_connector = db_connector
+        self.data_extractor = data_extractor
+        self.retries = retries
+
+    def _create_table(self, connection):
+        connection.execute(text("""
+            CREATE TABLE IF NOT EXISTS load_watermarks (
+                source_table TEXT PRIMARY KEY,
+                target_table TEXT NOT NULL,
+                key_column TEXT NOT NULL,
+                high_water_mark BIGINT NOT NULL,
+                target_index BIGINT NOT NULL,
+                loaded_at TIMESTAMP NOT NULL)"""))
+
+    def high_water_mark(self, source_table):
+        with self.db_connector.get_engine('warehouse').begin() as connection:
+            self._create_table(connection)
+            return connection.execute(text("SELECT high_water_mark FROM load_watermarks WHERE source_table = :source"),
+                                      {'source': source_table}).scalar()
+
+    @instrumented
+    def save(self, source_table, target_table, key_column, high_water_mark):
+        with self.db_connector.get_engine('warehouse').begin() as connection:
+            self._create_table(connection)
+            target_index = connection.execute(text(f'SELECT COALESCE(MAX(index), -1) FROM "{target_table}"')).scalar()
+            connection.execute(text("""
+                INSERT INTO load_watermarks VALUES (:source, :target, :key_column, :mark, :target_index, now())
+                ON CONFLICT (source_table) DO UPDATE SET
+                    target_table = EXCLUDED.target_table, key_column = EXCLUDED.key_column,
+                    high_water_mark = EXCLUDED.high_water_mark, target_index = EXCLUDED.target_index,
+                    loaded_at = EXCLUDED.loaded_at"""),
+                {'source': source_table, 'target': target_table, 'key_column': key_column, 'mark': high_water_mark,
+                 'target_index': target_index})
+
+    def forget(self, source_table):
+        with self.db_connector.get_engine('warehouse').begin() as connection:
+            self._create_table(connection)
+            connection.execute(text("DELETE FROM load_watermarks WHERE source_table = :source"),
+                               {'source': source_table})
+
+    @instrumented
+    def append(self, source_table, target_table, key_column, clean, schema, chunksize=50000):
+        for attempt in range(1, self.retries + 1):
+            try:
+                return self._append(source_table, target_table, key_column, clean, schema, chunksize)
+            except OperationalError as e:
+                # Nothing was committed, the same rows are extracted again
+                if attempt == self.retries:
+                    raise
+                print(f"Appending to '{target_table}' failed (attempt {attempt} of {self.retries}), retrying: {e}")
+                time.sleep(attempt)
+            except IntegrityError as e:
+                print(f"New rows of '{source_table}' refer to keys missing from a dimension table, nothing was "
+                      f"appended to '{target_table}': {e}")
+                raise
+
+    def _append(self, source_table, target_table, key_column, clean, schema, chunksize):
+        with self.db_connector.get_engine('warehouse').begin() as connection:
+            self._create_table(connection)
+            # Held until commit: a concurrent append of the same table waits, then starts from the new mark
+            state = connection.execute(text("""
+                SELECT high_water_mark, target_index FROM load_watermarks
+                WHERE source_table = :source AND target_table = :target AND key_column = :key_column
+                FOR UPDATE"""), {'source': source_table, 'target': target_table, 'key_column': key_column}).fetchone()
+            if state is None:
+                return None
+            high_water_mark, target_index = state
+            connection.execute(text(f'CREATE TEMPORARY TABLE delta (LIKE "{target_table}") ON COMMIT DROP'))
+            rows = 0
+            for chunk in self.data_extractor.stream_rds_table(self.db_connector, source_table, chunksize=chunksize,
+                                                              where=f'"{key_column}" > {int(high_water_mark)}',
+                                                              order_by=key_column):
+                if chunk.empty:
+                    continue
+                high_water_mark = max(high_water_mark, int(chunk[key_column].max()))
+                cleaned = clean(chunk)
+                cleaned.index = range(target_index + 1, target_index + 1 + len(cleaned))
+                target_index += len(cleaned)
+                rows += len(cleaned)
+                self.db_connector.copy_rows(schema.prepare(cleaned.reset_index()), 'delta', connection)
+            if rows:
+                self._add_missing_dimension_keys(connection, target_table)
+                connection.execute(text(f'INSERT INTO "{target_table}" SELECT * FROM delta'))
+            connection.execute(text("""
+                UPDATE load_watermarks SET high_water_mark = :mark, target_index = :target_index, loaded_at = now()
+                WHERE source_table = :source"""),
+                {'mark': high_water_mark, 'target_index': target_index, 'source': source_table})
+            return rows
+
+    def _add_missing_dimension_keys(self, connection, target_table):
+        foreign_keys = connection.execute(text("""
+            SELECT a.attname, c.confrelid::regclass::text, ra.attname
+            FROM pg_constraint c
+            JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+            JOIN pg_attribute ra ON ra.attrelid = c.confrelid AND ra.attnum = c.confkey[1]
+            WHERE c.contype = 'f' AND c.conrelid = to_regclass(quote_ident(:target))"""),
+            {'target': target_table}).fetchall()
+        for column, dimension_table, dimension_key in foreign_keys:
+            if dimension_table not in self.PLACEHOLDER_TABLES:
+                continue
+            connection.execute(text(f"""
+                INSERT INTO {dimension_table} ("{dimension_key}")
+                SELECT DISTINCT d."{column}" FROM delta d
+                WHERE d."{column}" IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM {dimension_table} t WHERE t."{dimension_key}" = d."{column}")"""))
+
+
+def track_high_water_mark(chunks, key_column, metadata):
+    """
+    Passes source chunks through, recording the highest key seen in metadata['high_water_mark'], so that a full load
+    can save the mark of the rows it extracted.
+    """
+    for chunk in chunks:
+        # A source without the key column is loaded in full every time
+        if not chunk.empty and key_column in chunk.columns:
+            metadata['high_water_mark'] = max(metadata.get('high_water_mark', -1), int(chunk[key_column].max()))
+        yield chunk
@@ -0,0 +1,231 @@
+import functools
+import inspect
+import json
+import os
+import pandas as pd
+import psutil
+import resource
+import threading
+import time
+
+
+class Instrumentation:
+    """
+    This class collects one record per instrumented call made during a pipeline run: wall time, rows in and out,
+    rows dropped, bytes transferred and memory, so that a slow or lossy step can be traced back to the method (and,
+    for the private cleaning steps, the rule) responsible.
+
+    Methods are instrumented with the `instrumented` decorator, which reports to the module-level `instrumentation`
+    instance. Calls nest: a call's bytes are added to the call that made it, and each record keeps its parent.
+
+    Attributes:
+        enabled (bool): When False the decorators call straight through without recording anything.
+        records (list): One dict per finished call.
+
+    Methods:
+        1. record_bytes(count)
+            - Adds transferred bytes (downloaded, read or uploaded) to the innermost running call of this thread.
+
+        2. summary()
+            - Aggregates the records per step.
+            - Returns:
+                - dict: Per step name, calls, seconds, rows_in, rows_out, rows_dropped, bytes and peak_rss_bytes.
+
+        3. export_json(path)
+            - Writes the run id, the summary and every record to a JSON file.
+
+        4. export_prometheus(path)
+            - Writes the summary in the Prometheus text exposition format, for the node exporter textfile collector.
+
+        5. reset()
+            - Forgets the records and starts a new run.
+
+        6. merge(records)
+            - Adds the records of calls made in another process (e.g. a cleaning worker). Calls made there at the top
+              level become children of the innermost running call of this thread.
+    """
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._process = psutil.Process()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+            self.run_id = time.strftime('%Y%m%dT%H%M%S')
+            self.started_at = time.time()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def record_bytes(self, count):
+        stack = self._stack()
+        if stack:
+            stack[-1]['bytes'] += count
+
+    def start(self, name, rows_in, nested=True):
+        stack = self._stack()
+        call = {
+            'step': name,
+            'parent': stack[-1]['step'] if stack else None,
+            'thread': threading.current_thread().name,
+            'started_at': time.time(),
+            'rows_in': rows_in,
+            'rows_out': None,
+            'rows_dropped': None,
+            'bytes': 0,
+            'rss_before_bytes': self._process.memory_info().rss,
+            '_start': time.perf_counter(),
+        }
+        if nested:
+            stack.append(call)
+        return call
+
+    def finish(self, call, rows_out, error=None):
+        stack = self._stack()
+        nested = any(entry is call for entry in stack)
+        if nested:
+            stack.pop(next(position for position, entry in enumerate(stack) if entry is call))
+        call['seconds'] = time.perf_counter() - call.pop('_start')
+        call['rows_out'] = rows_out
+        if call['rows_in'] is not None and rows_out is not None:
+            call['rows_dropped'] = call['rows_in'] - rows_out
+        call['rss_after_bytes'] = self._process.memory_info().rss
+        # ru_maxrss is the process high-water mark, in kilobytes on Linux
+        call['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        call['error'] = repr(error) if error is not None else None
+        if nested and stack:
+            stack[-1]['bytes'] += call['bytes']
+        with self._lock:
+            self.records.append(call)
+
+    def merge(self, records):
+        stack = self._stack()
+        parent = stack[-1]['step'] if stack else None
+        if stack:
+            # As for a nested call, the bytes of the top-level calls are added to the running call
+            stack[-1]['bytes'] += sum(record['bytes'] for record in records if record['parent'] is None)
+        records = [dict(record, parent=record['parent'] or parent) for record in records]
+        with self._lock:
+            self.records.extend(records)
+
+    def summary(self):
+        steps = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            step = steps.setdefault(record['step'], {'calls': 0, 'errors': 0, 'seconds': 0.0, 'rows_in': 0,
+                                                     'rows_out': 0, 'rows_dropped': 0, 'bytes': 0,
+                                                     'peak_rss_bytes': 0})
+            step['calls'] += 1
+            step['errors'] += record['error'] is not None
+            step['seconds'] += record['seconds']
+            step['rows_in'] += record['rows_in'] or 0
+            step['rows_out'] += record['rows_out'] or 0
+            step['rows_dropped'] += record['rows_dropped'] or 0
+            step['bytes'] += record['bytes']
+            step['peak_rss_bytes'] = max(step['peak_rss_bytes'], record['peak_rss_bytes'])
+        return steps
+
+    def export_json(self, path):
+        with self._lock:
+            records = list(self.records)
+        with open(path, 'w') as json_file:
+            json.dump({'run_id': self.run_id, 'started_at': self.started_at, 'summary': self.summary(),
+                       'records': records}, json_file, indent=2)
+
+    def export_prometheus(self, path):
+        metrics = [
+            ('calls', 'counter', 'Number of calls of each pipeline step'),
+            ('errors', 'counter', 'Number of calls of each pipeline step that raised'),
+            ('seconds', 'counter', 'Wall time spent in each pipeline step'),
+            ('rows_in', 'counter', 'Rows passed into each pipeline step'),
+            ('rows_out', 'counter', 'Rows returned by each pipeline step'),
+            ('rows_dropped', 'counter', 'Rows removed by each pipeline step'),
+            ('bytes', 'counter', 'Bytes downloaded, read or uploaded by each pipeline step'),
+            ('peak_rss_bytes', 'gauge', 'Process peak resident set size when each pipeline step finished'),
+        ]
+        summary = self.summary()
+        lines = []
+        for metric, metric_type, description in metrics:
+            name = f"mrdc_step_{metric}" + ('_total' if metric_type == 'counter' else '')
+            lines.append(f"# HELP {name} {description}.")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for step, values in summary.items():
+                lines.append(f'{name}{{run_id="{self.run_id}",step="{step}"}} {values[metric]}')
+        # Write to a temporary file first, the textfile collector must never read a partial file
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w') as prometheus_file:
+            prometheus_file.write('\n'.join(lines) + '\n')
+        os.replace(temporary_path, path)
+
+
+instrumentation = Instrumentation()
+
+
+def _rows(value):
+    return len(value) if isinstance(value, pd.DataFrame) else None
+
+
+def instrumented(func):
+    """
+    Decorator recording every call of a method in `instrumentation`. Rows in are counted from the first DataFrame
+    argument and rows out from a returned DataFrame. Generator methods are timed over their whole iteration, with
+    the rows of every yielded chunk added up. While a chunk is being produced they are the running call, so the
+    calls and bytes recorded by the generator are credited to it; between chunks they are not, so those of the
+    consumer are not.
+    """
+    name = func.__qualname__
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            if not instrumentation.enabled:
+                yield from func(*args, **kwargs)
+                return
+            call = instrumentation.start(name, None, nested=False)
+            generator = func(*args, **kwargs)
+            rows_out = 0
+            error = None
+            try:
+                while True:
+                    # Only on the stack while producing the next chunk, as the consumer may run on another thread
+                    stack = instrumentation._stack()
+                    stack.append(call)
+                    try:
+                        chunk = next(generator)
+                    except StopIteration:
+                        break
+                    finally:
+                        stack.pop()
+                    rows_out += _rows(chunk) or 0
+                    yield chunk
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                generator.close()
+                instrumentation.finish(call, rows_out, error)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not instrumentation.enabled:
+            return func(*args, **kwargs)
+        rows_in = next((_rows(arg) for arg in list(args) + list(kwargs.values()) if _rows(arg) is not None), None)
+        call = instrumentation.start(name, rows_in)
+        result = None
+        error = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            instrumentation.finish(call, _rows(result), error)
+    return wrapper
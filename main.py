@@ -1,8 +1,8 @@
-from data_extraction import DataExtractor
-from data_cleaning import DataCleaning
-from database_utils import DatabaseConnector
 from dotenv import load_dotenv
+from pipeline import Pipeline
+import argparse
 import os
+import time
 
 
 """
@@ -13,12 +13,46 @@ This script demonstrates the process of extracting, cleaning, and uploading data
 1. It connects to a database using the `DatabaseConnector` class.
 2. Extracts data from the database and external sources using the `DataExtractor` class.
 3. Cleans the extracted data using the `DataCleaning` class.
-4. Uploads the cleaned data to specific tables in the database.
+4. Stages the cleaned data as partitioned Parquet using the `StagingArea` class, skipping steps 2 and 3 for the
+   tables whose sources and cleaning code have not changed since they were staged.
+5. Uploads the staged data to specific tables in the database. With --incremental, orders_table is appended the
+   orders added to the source since the last load instead, using the `IncrementalLoader` class, without staging.
+   With --upsert-dimensions, the dimension tables are updated in place with their new and changed rows only, using
+   the `DimensionUpserter` class, and --delete-missing also deletes the rows no longer extracted. A dimension table
+   that cannot be upserted yet (first run, or no primary key) is loaded in full, and its row fingerprints recorded.
+6. Creates the primary keys, runs star_schema.sql, then creates the join indexes and foreign keys and runs ANALYZE
+   once every table has been uploaded.
+7. Refreshes the sales rollups answering the reports of mdrc_data_query.sql using the `SalesRollups` class:
+   rebuilt after a full load, updated with the new orders only when orders were only appended.
+
+The six extract -> clean -> load chains (users, orders, cards, stores, products, date_times) do not depend on each
+other, so they run concurrently as stages of a `Pipeline`. The star_schema stage depends on all of them, and the
+rollups stage on star_schema.
+
+Without a command every stage runs. Each chain is also a command of its own, running that chain, then star_schema
+(which recreates the keys the load dropped) and rollups. The modules doing the work, and with them pandas, SQLAlchemy
+and pyarrow, are only imported once a run starts, and boto3, tabula (with its JVM bridge), requests and pypdf only by
+the chains reading a source that needs them, so reloading the users or orders table never loads them. No connection
+is opened until a stage needs one. --dry-run prints the stages that would run, with their sources and load modes,
+importing none of the pipeline modules and connecting to nothing. A real run prints how long it took to start.
 
 Dependencies:
 - data_extraction.py: Contains the DataExtractor class for extracting data.
 - data_cleaning.py: Contains the DataCleaning class for cleaning data.
 - database_utils.py: Contains the DatabaseConnector class for database operations.
+- table_schemas.py: Final column types and derived columns of every table, applied as the table is loaded.
+- pipeline.py: Contains the Pipeline class scheduling the stages.
+- compact_dtypes.py: Categorical, downcast integer and Arrow string dtypes used with --compact.
+- staging.py: Contains the StagingArea class keeping the cleaned tables and their manifest in STAGING_DIR
+  (default 'staging'). `--from-staging` reloads the warehouse from there without touching RDS, the PDF, the API or S3.
+- instrumentation.py: Records the time, rows, bytes and memory of every extract, clean and load step.
+- parallel_cleaning.py: Contains the PartitionedCleaner class cleaning the card, store and date details data on
+  --clean-workers processes.
+- rollups.py: Contains the SalesRollups class maintaining the sales rollups and answering the reports from them.
+- incremental_load.py: Contains the IncrementalLoader class appending the orders past the high-water mark of the
+  source table. The mark is taken on ORDERS_KEY_COLUMN (default 'level_0'), an increasing integer key of the source.
+- dimension_upsert.py: Contains the DimensionUpserter class writing only the inserted and changed rows of a
+  dimension table, found by comparing row fingerprints with those stored in the warehouse.
 
 Inputs:
 - URLs for PDF and API endpoints for data extraction.
@@ -27,83 +61,333 @@ Inputs:
 
 Outputs:
 - Success/failure messages for each data extraction, cleaning, and upload operation.
+- Per-step metrics of the run in METRICS_DIR (default 'metrics'): run_metrics.json and, for the Prometheus node
+  exporter textfile collector, run_metrics.prom.
 
 Usage:
+    python main.py [users | orders | cards | stores | products | date_times] [--dry-run] [--skip STAGE ...]
+                   [--workers N] [--clean-workers N] [--from-staging] [--compact] [--incremental]
+                   [--upsert-dimensions [--delete-missing]]
+    python main.py [--only STAGE ...] [options]
 - Make sure to set the appropriate values for URLs, table names, and authentication tokens.
 - Ensure that the required dependencies are available in the environment.
 
 """
-if __name__ == "__main__":
-    # Load environment variables from the .env file
-    load_dotenv()
+# The table each command loads, and the environment variable holding its source (None for the RDS tables)
+TABLE_COMMANDS = {
+    'users': ('dim_users', None),
+    'orders': ('orders_table', None),
+    'cards': ('dim_card_details', 'PDF_URL'),
+    'stores': ('dim_store_details', 'STORE_DETAIL_URL'),
+    'products': ('dim_products', 'S3_CSV'),
+    'date_times': ('dim_date_times', 'S3_JSON'),
+}
+
+# Tables of the RDS database the users and orders are read from
+RDS_TABLES = {'users': 'legacy_users', 'orders': 'orders_table'}
+
+# Every stage of the pipeline, the loads first
+STAGES = list(TABLE_COMMANDS) + ['star_schema', 'rollups']
+
+
+def add_run_options(parser, defaults=True):
+    # The commands take the same options after their name; their defaults are left to the main parser, so that
+    # options given before the command are kept
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
+
+    parser.add_argument("--dry-run", action="store_true", default=default(False),
+                        help="print the stages that would run, without importing the pipeline or connecting")
+    parser.add_argument("--skip", nargs="+", metavar="STAGE", choices=STAGES, default=default([]),
+                        help="do not run these stages")
+    parser.add_argument("--workers", type=int, default=default(6), help="number of stages running at the same time")
+    parser.add_argument("--clean-workers", type=int, default=default(1),
+                        help="number of processes cleaning each of the card, store and date details tables")
+    parser.add_argument("--from-staging", action="store_true", default=default(False),
+                        help="reload the warehouse from the staged tables without reading any source")
+    parser.add_argument("--compact", action="store_true", default=default(False),
+                        help="keep the data in categorical, downcast integer and Arrow string columns")
+    parser.add_argument("--incremental", action="store_true", default=default(False),
+                        help="append only the new orders to orders_table, instead of rebuilding it")
+    parser.add_argument("--upsert-dimensions", action="store_true", default=default(False),
+                        help="write only the new and changed rows of the dimension tables, instead of rebuilding them")
+    parser.add_argument("--delete-missing", action="store_true", default=default(False),
+                        help="with --upsert-dimensions, delete the dimension rows no longer in the sources")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Extract, clean and upload the sales data.")
+    parser.add_argument("--only", nargs="+", metavar="STAGE", choices=STAGES, help="run only these stages")
+    add_run_options(parser)
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND",
+                                     help="load a single table, then recreate the star schema and the rollups")
+    for command, (target_table, _) in TABLE_COMMANDS.items():
+        add_run_options(commands.add_parser(command, help=f"load {target_table}"), defaults=False)
+    args = parser.parse_args(argv)
+    if args.command and args.only:
+        parser.error("--only cannot be combined with a command")
+    return args
+
+
+def create_pipeline(max_workers, stage_functions):
+    pipeline = Pipeline(max_workers=max_workers)
+    for name in TABLE_COMMANDS:
+        pipeline.add_stage(name, stage_functions.get(name))
+    pipeline.add_stage('star_schema', stage_functions.get('star_schema'), depends_on=list(TABLE_COMMANDS))
+    pipeline.add_stage('rollups', stage_functions.get('rollups'), depends_on=['star_schema'])
+    return pipeline
+
+
+def selected_stages(args):
+    if args.command is None:
+        return args.only, args.skip
+    return [args.command, 'star_schema', 'rollups'], args.skip
+
+
+def describe_load(args, command):
+    target_table, source_variable = TABLE_COMMANDS[command]
+    if args.from_staging:
+        source = f"the staged files in '{os.getenv('STAGING_DIR', 'staging')}'"
+    elif source_variable is None:
+        source = f"the RDS table '{RDS_TABLES[command]}'"
+    else:
+        source = os.getenv(source_variable) or f"{source_variable} (not set)"
+    if command == 'orders' and args.incremental and not args.from_staging:
+        mode = f"appending the orders past the high-water mark on {os.getenv('ORDERS_KEY_COLUMN', 'level_0')}"
+    elif target_table.startswith('dim_') and args.upsert_dimensions:
+        mode = "upserting the new and changed rows" + (", deleting the missing ones" if args.delete_missing else "")
+    else:
+        mode = "replacing the table"
+    return f"{target_table} from {source}, {mode}"
+
+
+def dry_run(args):
+    only, skip = selected_stages(args)
+    # The stage functions are never called, so the pipeline is only built to select the stages
+    stages = create_pipeline(args.workers, {}).plan(only=only, skip=skip)
+    descriptions = {
+        'star_schema': "primary keys, star_schema.sql, join indexes, foreign keys and ANALYZE",
+        'rollups': "sales rollups refreshed",
+    }
+    print(f"Dry run: {len(stages)} stages would run, up to {args.workers} at a time.")
+    for stage in stages:
+        description = describe_load(args, stage) if stage in TABLE_COMMANDS else descriptions[stage]
+        print(f"  {stage:<12} {description}")
+
+
+def build_run(args):
+    # Imported here rather than at the top, so that --help and --dry-run start without pandas, SQLAlchemy or pyarrow
+    import_start = time.perf_counter()
+    from compact_dtypes import memory_report
+    from data_extraction import DataExtractor
+    from data_cleaning import DataCleaning
+    from database_utils import DatabaseConnector
+    from dimension_upsert import DimensionUpserter
+    from incremental_load import IncrementalLoader, track_high_water_mark
+    from instrumentation import instrumentation
+    from parallel_cleaning import PartitionedCleaner
+    from rollups import SalesRollups
+    from source_cache import SourceCache
+    from staging import StagingArea
+    from table_schemas import TABLE_SCHEMAS
+    import_time = time.perf_counter() - import_start
+    # The engines are created, and connect, on first use
     db_connector = DatabaseConnector()
-    data_extractor = DataExtractor(db_connector)
-    data_cleaner = DataCleaning()
+    # Cache the PDF, CSV and JSON sources between runs; set SOURCE_CACHE_BYPASS=1 to re-download everything
+    source_cache = SourceCache(cache_dir=os.getenv("SOURCE_CACHE_DIR", ".source_cache"),
+                               max_bytes=int(os.getenv("SOURCE_CACHE_MAX_BYTES", 2 * 1024 ** 3)),
+                               bypass=os.getenv("SOURCE_CACHE_BYPASS") == "1")
+    data_extractor = DataExtractor(db_connector, cache=source_cache, compact=args.compact)
+    data_cleaner = DataCleaning(compact=args.compact)
+    # The tables loaded whole are cleaned in partitions across a process pool; the streamed ones chunk by chunk
+    partitioned_cleaner = PartitionedCleaner(data_cleaner, workers=args.clean_workers)
+    # Cleaned tables are staged as partitioned Parquet, and loaded into the warehouse from there
+    staging = StagingArea(os.getenv("STAGING_DIR", "staging"))
+    # New orders are appended past a high-water mark on an increasing key of the source table
+    incremental_loader = IncrementalLoader(db_connector, data_extractor)
+    # Dimension tables are updated in place with the rows whose fingerprint changed
+    dimension_upserter = DimensionUpserter(db_connector)
     # Access environment variables
     pdf_url = os.getenv("PDF_URL")
     num_stores_url = os.getenv("NUM_STORES_URL")
     store_detail_url = os.getenv("STORE_DETAIL_URL")
     api_key = os.getenv("API_KEY")
+    headers = {'x-api-key': api_key}
     s3_csv = os.getenv("S3_CSV")
     s3_json = os.getenv("S3_JSON")
-    # Get the list of available tables
-    table_names = db_connector.list_db_tables()
-    user_data_table_name = 'legacy_users'
-    order_table_name = "orders_table"
-    # Use read_rds_table to extract the user data and return it as a Pandas DataFrame
-    user_data = data_extractor.read_rds_table(db_connector, user_data_table_name)
-    orders_data = data_extractor.read_rds_table(db_connector, order_table_name)
-    # print(orders_data) # Debugging check
-    if user_data is not None:
-        # the user data in the 'user_data' DataFrame
-        cleaned_user_data = data_cleaner.clean_user_data(user_data)  
-        # print(cleaned_user_data) # Debugging check
-        db_connector.upload_to_db(cleaned_user_data, 'dim_users')
-        print(f"Data uploaded to 'dim_users' table successfully.")
-    else:
-        print(f"Failed to retrieve data from the '{user_data_table_name}' table.")
-    
-    if orders_data is not None:
-        # the orders data in the 'orders_data' DataFrame
-        cleaned_orders_data = data_cleaner.clean_orders_data(orders_data) 
-        # print(cleaned_orders_data) # Debugging check
-        db_connector.upload_to_db(cleaned_orders_data, 'orders_table')
-        print(f"Data uploaded to 'orders_table' table successfully.")
-    else:
-        print(f"Failed to retrieve data from the '{order_table_name}' table.")
-    # Get the card data, clean, and upload
-    extracted_data = data_extractor.retrieve_pdf_data(pdf_url)
-    if extracted_data is not None:
-        cleaned_data = data_cleaner.clean_card_data(extracted_data)
-        db_connector.upload_to_db(cleaned_data, 'dim_card_details')
-        print(f"Data uploaded to 'dim_card_details' table successfully.")
-    else:
-        print("Failed to retrieve data from pdf.")
-    db_connector.close_connection()   
-    # Load, store, clean and upload store data
-    data_extractor = DataExtractor(db_connector)  
-    num_stores = data_extractor.list_number_of_stores(num_stores_url, headers)
-    stores = data_extractor.retrieve_stores_data(store_detail_url, headers, num_stores)
-    if stores is not None:
-        stores = DataCleaning().clean_store_data(stores)
-        db_connector.upload_to_db(stores, 'dim_store_details')
-        print(f"Data uploaded to 'dim_store_details' table successfully.")
-    else:
-        print("Failed to retrieve data using API key.")
-    # Extract products data from S3
-    products_data = data_extractor.extract_from_s3(s3_csv)
-    if products_data is not None:
-        cleaned_products_data = data_cleaner.clean_product_data(products_data)
-        db_connector.upload_to_db(cleaned_products_data, "dim_products")
-        print(f"Data uploaded to 'dim_products' table successfully.")
-    else:
-        print("Failed to retrieve data from the s3 bucket.")
+    user_data_table_name = RDS_TABLES['users']
+    order_table_name = RDS_TABLES['orders']
+    orders_key_column = os.getenv("ORDERS_KEY_COLUMN", "level_0")
+    chunksize = int(os.getenv("RDS_CHUNKSIZE", 50000))
+
+    def clean_chunks(chunks, clean, target_table):
+        # Clean one chunk at a time so memory stays flat as the source grows
+        rows_cleaned = 0
+        for chunk in chunks:
+            cleaned_chunk = clean(chunk)
+            # Keep the index unique across chunks
+            cleaned_chunk.index += rows_cleaned
+            if args.compact:
+                memory_report.record(target_table, cleaned_chunk)
+            rows_cleaned += len(cleaned_chunk)
+            yield cleaned_chunk
+
+    def clean_frame(extracted_data, clean, target_table, failure_message):
+        if extracted_data is None:
+            raise RuntimeError(failure_message)
+        cleaned_data = clean(extracted_data)
+        if args.compact:
+            memory_report.record(target_table, cleaned_data)
+        return cleaned_data
+
+    def stage_and_upload(target_table, source_version, extract_and_clean, failure_message, metadata=None):
+        # Extract and clean into the staging area, unless the staged table was built from the same inputs
+        if not args.from_staging:
+            input_version = staging.input_version(source_version(), compact=args.compact)
+            if staging.is_current(target_table, input_version):
+                print(f"Staged '{target_table}' is up to date, skipping extraction and cleaning.")
+            elif not staging.stage(target_table, extract_and_clean(), input_version, metadata):
+                raise RuntimeError(failure_message)
+        schema = TABLE_SCHEMAS.get(target_table)
+        if args.upsert_dimensions and schema is not None and schema.primary_key:
+            counts = dimension_upserter.upsert(target_table, staging.read_partitions(target_table), schema,
+                                               delete=args.delete_missing)
+            if counts is not None:
+                print(f"Upserted '{target_table}' successfully: {counts['inserted']} inserted, {counts['updated']} "
+                      f"updated, {counts['unchanged']} unchanged, {counts['deleted']} deleted.")
+                return
+            print(f"'{target_table}' cannot be upserted yet, loading it in full.")
+        # The foreign keys of orders_table would stop a dimension table being replaced, and keys and indexes slow
+        # down the bulk load; they are all recreated once every table is loaded
+        db_connector.drop_keys(target_table)
+        # Load the staged files one at a time into the table, created with its final column types, in one
+        # transaction: if a file fails the previous table and its rows are kept, only its keys are recreated later
+        rows_uploaded = db_connector.replace_table(target_table, staging.read_partitions(target_table), schema=schema)
+        if not rows_uploaded:
+            raise RuntimeError(failure_message)
+        if args.upsert_dimensions and schema is not None and schema.primary_key:
+            # So that the next run only writes the rows that change
+            dimension_upserter.record(target_table, staging.read_partitions(target_table), schema)
+        print(f"Data uploaded to '{target_table}' table successfully.")
+
+    # Stream the user and orders data from the RDS tables and clean them chunk by chunk
+    def load_users():
+        stage_and_upload('dim_users', lambda: data_extractor.rds_table_version(db_connector, user_data_table_name),
+                         lambda: clean_chunks(data_extractor.stream_rds_table(db_connector, user_data_table_name,
+                                                                              chunksize=chunksize),
+                                              data_cleaner.clean_user_data, 'dim_users'),
+                         f"Failed to retrieve data from the '{user_data_table_name}' table.")
+
+    def load_orders():
+        if args.incremental and not args.from_staging:
+            rows = incremental_loader.append(order_table_name, 'orders_table', orders_key_column,
+                                             data_cleaner.clean_orders_data, TABLE_SCHEMAS['orders_table'],
+                                             chunksize=chunksize)
+            if rows is not None:
+                print(f"Appended {rows} new orders to 'orders_table' successfully.")
+                return
+            print("No high-water mark for 'orders_table' yet, loading it in full.")
+        # No appends until the replaced table has its mark
+        incremental_loader.forget(order_table_name)
+        extraction = {}
+        stage_and_upload('orders_table', lambda: data_extractor.rds_table_version(db_connector, order_table_name),
+                         lambda: clean_chunks(track_high_water_mark(
+                             data_extractor.stream_rds_table(db_connector, order_table_name, chunksize=chunksize),
+                             orders_key_column, extraction), data_cleaner.clean_orders_data, 'orders_table'),
+                         f"Failed to retrieve data from the '{order_table_name}' table.", metadata=extraction)
+        high_water_mark = staging.manifest()['orders_table'].get('metadata', {}).get('high_water_mark')
+        if high_water_mark is not None:
+            incremental_loader.save(order_table_name, 'orders_table', orders_key_column, high_water_mark)
+
+    # Get the card data, clean, and stage
+    def load_cards():
+        failure_message = "Failed to retrieve data from pdf."
+        stage_and_upload('dim_card_details', lambda: source_cache.validator(pdf_url),
+                         lambda: clean_frame(data_extractor.retrieve_pdf_data(pdf_url),
+                                             partitioned_cleaner.clean_card_data, 'dim_card_details', failure_message),
+                         failure_message)
+
+    # Load, store, clean and stage store data. The API has no version, so the stores are re-fetched on every run.
+    def load_stores():
+        def extract_and_clean():
+            num_stores = data_extractor.list_number_of_stores(num_stores_url, headers)
+            stores = data_extractor.retrieve_stores_data_concurrently(store_detail_url, headers, num_stores)
+            return clean_frame(stores, partitioned_cleaner.clean_store_data, 'dim_store_details', failure_message)
+
+        failure_message = "Failed to retrieve data using API key."
+        stage_and_upload('dim_store_details', lambda: None, extract_and_clean, failure_message)
+
+    # Stream products data from S3, only the columns the cleaning needs, downloading S3_WORKERS byte ranges at once
+    def load_products():
+        stage_and_upload('dim_products', lambda: source_cache.validator(s3_csv),
+                         lambda: clean_chunks(data_extractor.stream_s3_csv(s3_csv, chunksize=chunksize,
+                                                                           workers=int(os.getenv("S3_WORKERS", 4))),
+                                              data_cleaner.clean_product_data, 'dim_products'),
+                         "Failed to retrieve data from the s3 bucket.")
+
     # Extract time and dates data from json S3
-    json_data = data_extractor.extract_s3_json(s3_json)
-    if json_data is not None:
-        cleaned_json_data = data_cleaner.clean_json(json_data)
-        db_connector.upload_to_db(cleaned_json_data, "dim_date_times")
-        print(f"Data uploaded to 'dim_date_time' table successfully.")
-    else:
-        print("Failed to retrieve data from the json file.")
-   
\ No newline at end of file
+    def load_date_times():
+        failure_message = "Failed to retrieve data from the json file."
+        stage_and_upload('dim_date_times', lambda: source_cache.validator(s3_json),
+                         lambda: clean_frame(data_extractor.extract_s3_json(s3_json), partitioned_cleaner.clean_time,
+                                             'dim_date_times', failure_message),
+                         failure_message)
+
+    # Create the keys, join indexes and statistics once every table is loaded
+    def create_star_schema():
+        db_connector.create_primary_keys(TABLE_SCHEMAS)
+        # Add the dimension rows that orders_table refers to but the sources lack
+        db_connector.run_sql_file('star_schema.sql')
+        db_connector.create_indexes(TABLE_SCHEMAS)
+        db_connector.create_foreign_keys(TABLE_SCHEMAS)
+        db_connector.analyze(list(TABLE_SCHEMAS))
+        print("Star schema created successfully.")
+
+    # Bring the sales rollups in line with the tables just loaded
+    def refresh_rollups():
+        mode = SalesRollups(db_connector).refresh()
+        print(f"Sales rollups {mode} successfully.")
+
+    def finish():
+        if args.compact:
+            print("Memory of the cleaned tables, default dtypes -> compact dtypes:")
+            memory_report.report()
+        metrics_dir = os.getenv("METRICS_DIR", "metrics")
+        os.makedirs(metrics_dir, exist_ok=True)
+        instrumentation.export_json(os.path.join(metrics_dir, "run_metrics.json"))
+        instrumentation.export_prometheus(os.path.join(metrics_dir, "run_metrics.prom"))
+        partitioned_cleaner.close()
+        # Dispose the connection pools once every table has been uploaded
+        db_connector.close_connection()
+
+    pipeline = create_pipeline(args.workers, {
+        'users': load_users,
+        'orders': load_orders,
+        'cards': load_cards,
+        'stores': load_stores,
+        'products': load_products,
+        'date_times': load_date_times,
+        'star_schema': create_star_schema,
+        'rollups': refresh_rollups,
+    })
+    return pipeline, finish, import_time
+
+
+def main(argv=None):
+    start = time.perf_counter()
+    args = parse_args(argv)
+    # Load environment variables from the .env file
+    load_dotenv()
+    if args.dry_run:
+        dry_run(args)
+        return
+    only, skip = selected_stages(args)
+    pipeline, finish, import_time = build_run(args)
+    print(f"Started in {time.perf_counter() - start:.2f} s, {import_time:.2f} s of it importing the pipeline modules.")
+    pipeline.run(only=only, skip=skip)
+    pipeline.report()
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+from concurrent.futures import ProcessPoolExecutor
+from data_cleaning import DataCleaning
+from instrumentation import instrumentation
+from multiprocessing import resource_tracker, shared_memory
+import functools
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import pickle
+import threading
+
+
+class PartitionedCleaner:
+    """
+    This class runs the DataCleaning entry points on a process pool, splitting each frame into partitions that are
+    cleaned in parallel and merged back into exactly the frame the serial method returns.
+
+    Partitions are handed to the workers, and the cleaned partitions handed back, through shared memory: each frame
+    is pickled with protocol 5, its numeric buffers out of band, into a single shared memory block that the receiving
+    side copies out and unlinks. Pickle keeps every value and dtype as it was, which Arrow conversion would not
+    (None vs NaN, mixed-type object columns).
+
+    Most cleaning steps only look at one row at a time, so contiguous row ranges are cleaned independently and
+    concatenated in order. Global steps need more care: clean_card_data drops duplicate card numbers, keeping the
+    first occurrence in the whole frame. Its rows are hash-partitioned on card_number, so all the rows of a card
+    number meet in the same partition (in their original order), and the merge restores the original row order.
+    Dates parse the same whatever the rows around them (see date_parsing.py), so they need nothing special.
+
+    Each worker sends back, with the cleaned partition, what the cleaner recorded about it: the values it could not
+    parse (the DIAGNOSTIC_ATTRIBUTES of DataCleaning) and the instrumentation records of its cleaning steps. They
+    are merged into the cleaner and the instrumentation of this process, in row order, so a parallel run reports
+    the same as a serial one.
+
+    Attributes:
+        cleaner (DataCleaning): The cleaner whose methods are run, including its compact setting.
+        workers (int): Number of worker processes.
+        partitions_per_worker (int): Partitions per worker, more than one to even out uneven partitions.
+        min_partition_rows (int): Frames too small to give each partition this many rows are cleaned serially.
+
+    Methods:
+        1. run(method_name, df)
+            - Runs DataCleaning.<method_name> on df across the pool.
+            - Returns:
+                - DataFrame: The same frame as the serial method.
+
+        2. clean_user_data(df), clean_card_data(df), ... clean_time(df)
+            - Shortcuts for run('clean_user_data', df), and so on.
+
+        3. close()
+            - Shuts the pool down. PartitionedCleaner is also a context manager.
+    """
+    # Methods with a global drop_duplicates step, and the columns it deduplicates on
+    HASH_PARTITION_KEYS = {'clean_card_data': ['card_number']}
+    # Carries each row's position through the workers when the merge needs it
+    ROW_COLUMN = '__row_position__'
+    # DataCleaning attributes holding the values of the last call that could not be parsed, a Series or a dict of
+    # Series by column
+    DIAGNOSTIC_ATTRIBUTES = ('unparsed_dates', 'unparsed_weights')
+
+    def __init__(self, cleaner=None, workers=None, partitions_per_worker=2, min_partition_rows=10000):
+        self.cleaner = cleaner or DataCleaning()
+        self.workers = workers or os.cpu_count()
+        self.partitions_per_worker = partitions_per_worker
+        self.min_partition_rows = min_partition_rows
+        self._executor = None
+        # Pipeline stages clean their tables on separate threads, sharing one pool
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name.startswith('clean_') and hasattr(DataCleaning, name):
+            return functools.partial(self.run, name)
+        raise AttributeError(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is not None:
+                return self._executor
+            # Spawned, not forked: the pipeline runs other stages on threads (and a JVM for the PDF) meanwhile.
+            # The cleaner is pickled to the workers with its settings and registered weight units.
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_start_worker, initargs=(self.cleaner,))
+            return self._executor
+
+    def run(self, method_name, df):
+        number_of_partitions = min(self.workers * self.partitions_per_worker, len(df) // self.min_partition_rows)
+        if self.workers <= 1 or number_of_partitions <= 1:
+            return getattr(self.cleaner, method_name)(df)
+        partitions = self._split(method_name, df, number_of_partitions)
+        handles = [_to_shared_memory(partition) for partition in partitions]
+        del partitions
+        try:
+            futures = [self._pool().submit(_clean_partition, method_name, handle) for handle in handles]
+            results = [future.result() for future in futures]
+            cleaned = [_from_shared_memory(cleaned_handle) for cleaned_handle, _, _ in results]
+        finally:
+            for handle in handles:
+                _unlink(handle)
+        if instrumentation.enabled:
+            for _, _, records in results:
+                instrumentation.merge(records)
+        self._merge_diagnostics(df, method_name, [diagnostics for _, diagnostics, _ in results])
+        return self._merge(method_name, cleaned)
+
+    def _split(self, method_name, df, number_of_partitions):
+        keys = self.HASH_PARTITION_KEYS.get(method_name)
+        if keys is None:
+            bounds = np.linspace(0, len(df), number_of_partitions + 1).astype(int)
+            return [df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        df = df.assign(**{self.ROW_COLUMN: np.arange(len(df))})
+        # Rows sharing a key land in the same partition, in their original order
+        buckets = pd.util.hash_pandas_object(df[keys], index=False).to_numpy() % number_of_partitions
+        return [df[buckets == bucket] for bucket in range(number_of_partitions)]
+
+    def _merge_diagnostics(self, df, method_name, partition_diagnostics):
+        for name in self.DIAGNOSTIC_ATTRIBUTES:
+            values = [diagnostics[name] for diagnostics in partition_diagnostics if name in diagnostics]
+            if not values:
+                continue
+            if isinstance(values[0], dict):
+                columns = {column: None for value in values for column in value}
+                merged = {column: self._in_row_order(df, method_name, [value[column] for value in values
+                                                                       if column in value]) for column in columns}
+                # unparsed_dates, the only diagnostic kept by column
+                self.cleaner._record_unparsed_dates(merged)
+            else:
+                setattr(self.cleaner, name, self._in_row_order(df, method_name, values))
+
+    def _in_row_order(self, df, method_name, parts):
+        merged = pd.concat(parts)
+        # Hash partitions interleave the rows, put them back in the order of the frame
+        if method_name in self.HASH_PARTITION_KEYS and df.index.is_unique:
+            merged = merged.iloc[np.argsort(df.index.get_indexer(merged.index), kind='stable')]
+        return merged
+
+    def _merge(self, method_name, cleaned):
+        merged = pd.concat(cleaned, ignore_index=True)
+        merged = _restore_categoricals(merged, cleaned)
+        if self.ROW_COLUMN in merged.columns:
+            merged = merged.sort_values(self.ROW_COLUMN, kind='stable').drop(columns=[self.ROW_COLUMN])
+            merged = merged.reset_index(drop=True)
+        return merged
+
+
+def _restore_categoricals(merged, parts):
+    # Partitions of a categorical column can have different categories, which concat turns into object
+    for column in merged.columns:
+        dtypes = [part[column].dtype for part in parts if len(part)]
+        if dtypes and all(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes):
+            categories = pd.Index(np.concatenate([dtype.categories.to_numpy(dtype=object) for dtype in dtypes]))
+            merged[column] = merged[column].astype(pd.CategoricalDtype(categories.unique().sort_values()))
+    return merged
+
+
+_worker_cleaner = None
+
+
+def _start_worker(cleaner):
+    global _worker_cleaner
+    _worker_cleaner = cleaner
+
+
+def _clean_partition(method_name, handle):
+    partition = _from_shared_memory(handle, owner=False)
+    # Only what this partition leaves behind is sent back: the diagnostics of earlier tasks are cleared
+    _worker_cleaner.unparsed_dates = {}
+    for name in PartitionedCleaner.DIAGNOSTIC_ATTRIBUTES:
+        if name != 'unparsed_dates':
+            vars(_worker_cleaner).pop(name, None)
+    instrumentation.reset()
+    cleaned = getattr(_worker_cleaner, method_name)(partition)
+    diagnostics = {name: getattr(_worker_cleaner, name) for name in PartitionedCleaner.DIAGNOSTIC_ATTRIBUTES
+                   if hasattr(_worker_cleaner, name)}
+    return _to_shared_memory(cleaned, owner=False), diagnostics, instrumentation.records
+
+
+def _to_shared_memory(df, owner=True):
+    buffers = []
+    payload = pickle.dumps(df, protocol=5, buffer_callback=buffers.append)
+    parts = [memoryview(payload)] + [buffer.raw() for buffer in buffers]
+    sizes = [part.nbytes for part in parts]
+    block = shared_memory.SharedMemory(create=True, size=max(1, sum(sizes)))
+    offset = 0
+    for part in parts:
+        block.buf[offset:offset + part.nbytes] = part.cast('B')
+        offset += part.nbytes
+    block.close()
+    if not owner:
+        _untrack(block)
+    return block.name, sizes
+
+
+def _from_shared_memory(handle, owner=True):
+    name, sizes = handle
+    block = shared_memory.SharedMemory(name=name)
+    if not owner:
+        _untrack(block)
+    chunks = []
+    offset = 0
+    for size in sizes:
+        # Copy out of the block, so that it can be released straight away
+        chunks.append(bytearray(block.buf[offset:offset + size]))
+        offset += size
+    block.close()
+    if owner:
+        block.unlink()
+    return pickle.loads(chunks[0], buffers=chunks[1:])
+
+
+def _untrack(block):
+    # Blocks are unlinked by the parent process. Without this, the worker's resource tracker would unlink the ones
+    # the worker created or attached to as well, and warn about them, when the pool shuts down.
+    resource_tracker.unregister(block._name, 'shared_memory')
+
+
+def _unlink(handle):
+    try:
+        block = shared_memory.SharedMemory(name=handle[0])
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
@@ -0,0 +1,140 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import time
+
+
+class Stage:
+    """
+    A named unit of work in a Pipeline, run once all the stages it depends on have succeeded.
+
+    Attributes:
+        name (str): Unique name of the stage, used by --only/--skip and in reports.
+        func (callable): Function called with no arguments to run the stage.
+        depends_on (tuple): Names of the stages that must finish first.
+        status (str): 'pending', 'running', 'done', 'failed', 'skipped' or 'blocked' (a dependency failed).
+        duration (float): Wall time of the stage in seconds, once it has run.
+    """
+    def __init__(self, name, func, depends_on=()):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.status = 'pending'
+        self.duration = 0.0
+        self.error = None
+
+
+class Pipeline:
+    """
+    This class schedules the extract -> clean -> load chains as a DAG of stages, running every stage whose
+    dependencies are satisfied concurrently on a thread pool. The chains are dominated by network and database I/O,
+    so threads overlap them well.
+
+    Attributes:
+        max_workers (int): Maximum number of stages running at the same time.
+        stages (dict): The registered stages, by name, in registration order.
+
+    Methods:
+        1. add_stage(name, func, depends_on=())
+            - Registers a stage. Dependencies must be registered first.
+
+        2. run(only=None, skip=None)
+            - Runs the selected stages. Stages left out by only/skip count as satisfied dependencies, while the
+              dependents of a failed stage are blocked.
+            - Parameters:
+                - only (list): Names of the only stages to run, None for all of them.
+                - skip (list): Names of stages not to run.
+            - Returns:
+                - bool: True if every selected stage succeeded.
+
+        3. plan(only=None, skip=None)
+            - Returns the names of the stages run(only, skip) would run, in registration order, without running them.
+
+        4. critical_path()
+            - Returns the chain of dependent stages with the longest total duration in the last run.
+            - Returns:
+                - tuple: (list of stage names, total seconds).
+
+        5. report()
+            - Prints the status and duration of every stage, the wall time and the critical path of the last run.
+    """
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.stages = {}
+        self.wall_time = 0.0
+
+    def add_stage(self, name, func, depends_on=()):
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dependency}'")
+        self.stages[name] = Stage(name, func, depends_on)
+        return self.stages[name]
+
+    def run(self, only=None, skip=None):
+        selected = self.plan(only, skip)
+        for stage in self.stages.values():
+            stage.status = 'pending' if stage.name in selected else 'skipped'
+            stage.duration = 0.0
+            stage.error = None
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while True:
+                self._block_dependents_of_failures()
+                for stage in self._ready_stages():
+                    stage.status = 'running'
+                    running[executor.submit(self._run_stage, stage)] = stage
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    running.pop(future)
+        self.wall_time = time.perf_counter() - start
+        return all(stage.status in ('done', 'skipped') for stage in self.stages.values())
+
+    def plan(self, only=None, skip=None):
+        unknown = set(only or []) | set(skip or [])
+        unknown -= set(self.stages)
+        if unknown:
+            raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+        return [name for name in self.stages if (only is None or name in only) and name not in (skip or [])]
+
+    def _run_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            stage.func()
+            stage.status = 'done'
+        except Exception as e:
+            stage.status = 'failed'
+            stage.error = e
+            print(f"Stage '{stage.name}' failed: {e}")
+        finally:
+            stage.duration = time.perf_counter() - start
+
+    def _ready_stages(self):
+        return [stage for stage in self.stages.values() if stage.status == 'pending' and all(
+            self.stages[dependency].status in ('done', 'skipped') for dependency in stage.depends_on)]
+
+    def _block_dependents_of_failures(self):
+        # Stages are registered after their dependencies, so one pass in order propagates the blocking
+        for stage in self.stages.values():
+            if stage.status == 'pending' and any(
+                    self.stages[dependency].status in ('failed', 'blocked') for dependency in stage.depends_on):
+                stage.status = 'blocked'
+
+    def critical_path(self):
+        finish_times = {}
+        paths = {}
+        for stage in self.stages.values():
+            longest = max(stage.depends_on, key=lambda dependency: finish_times[dependency], default=None)
+            finish_times[stage.name] = stage.duration + (finish_times[longest] if longest else 0.0)
+            paths[stage.name] = (paths[longest] if longest else []) + ([stage.name] if stage.duration else [])
+        if not finish_times:
+            return [], 0.0
+        last = max(finish_times, key=finish_times.get)
+        return paths[last], finish_times[last]
+
+    def report(self):
+        for stage in self.stages.values():
+            print(f"  {stage.name:<12} {stage.status:<8} {stage.duration:8.2f} s")
+        path, total = self.critical_path()
+        print(f"Pipeline wall time: {self.wall_time:.2f} s")
+        print(f"Critical path: {' -> '.join(path) or '(none)'} ({total:.2f} s)")
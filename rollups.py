@@ -0,0 +1,305 @@
+from instrumentation import instrumented
+from sqlalchemy import bindparam, text
+import pandas as pd
+
+
+# Sales of each (year, month, store), and of each product, with the dimension tables joined the way the reports of
+# mdrc_data_query.sql join them. Orders without a matching date are kept under year = month = '', so that the reports
+# that do not join dim_date_times still count them; product_matches counts the orders with a matching product, which
+# the reports joining dim_products require. The placeholder rows of dim_card_details, dim_store_details and
+# dim_products (the key alone, added by star_schema.sql and IncrementalLoader) match in the LEFT JOINs here as they do
+# in the INNER JOINs of the reports. dim_date_times never gets placeholders, so year = '' only holds orders without a
+# date, which the reports joining dim_date_times leave out too.
+SALES_COLUMNS = """
+    number_of_sales BIGINT NOT NULL,
+    product_quantity BIGINT,
+    total_sales DOUBLE PRECISION,
+    product_matches BIGINT NOT NULL"""
+SALES_AGGREGATES = """
+    COUNT(o.product_quantity), SUM(o.product_quantity), SUM(o.product_quantity * p.product_price), COUNT(p.product_code)"""
+ROLLUP_TABLES = {
+    'rollup_sales_by_date_store': {
+        'keys': ('year', 'month', 'store_code'),
+        'create': f"""
+            CREATE TABLE rollup_sales_by_date_store (
+                year VARCHAR(4) NOT NULL,
+                month VARCHAR(2) NOT NULL,
+                store_code VARCHAR(12) NOT NULL,{SALES_COLUMNS},
+                PRIMARY KEY (year, month, store_code))""",
+        'select': f"""
+            SELECT COALESCE(d.year, ''), COALESCE(d.month, ''), COALESCE(o.store_code, ''),{SALES_AGGREGATES}
+            FROM orders_table o
+            LEFT JOIN dim_date_times d ON o.date_uuid = d.date_uuid
+            LEFT JOIN dim_products p ON o.product_code = p.product_code
+            WHERE o.index > :low AND o.index <= :high
+            GROUP BY 1, 2, 3""",
+    },
+    'rollup_sales_by_product': {
+        'keys': ('product_code',),
+        'create': f"""
+            CREATE TABLE rollup_sales_by_product (
+                product_code VARCHAR(12) NOT NULL PRIMARY KEY,{SALES_COLUMNS})""",
+        'select': f"""
+            SELECT COALESCE(o.product_code, ''),{SALES_AGGREGATES}
+            FROM orders_table o
+            LEFT JOIN dim_products p ON o.product_code = p.product_code
+            WHERE o.index > :low AND o.index <= :high
+            GROUP BY 1""",
+    },
+}
+# Stores per country, locality and store type. Rebuilt on every refresh, as it only has a few hundred stores to read,
+# and an append of IncrementalLoader may have added placeholder stores to dim_store_details.
+STORE_ROLLUP = """
+    CREATE TABLE rollup_stores AS
+    SELECT country_code, locality, store_type, COUNT(store_code) AS store_count, SUM(staff_numbers) AS staff_numbers
+    FROM dim_store_details
+    GROUP BY country_code, locality, store_type"""
+# Tables the rollups are computed from. Replacing any of them (a new relation OID), or changing one of them in place
+# with DimensionUpserter (a new change count in fingerprint_tables), forces a full rebuild.
+SOURCE_TABLES = ('orders_table', 'dim_date_times', 'dim_products', 'dim_store_details')
+WEB_STORE_CODE = 'WEB-1388012W'
+# The SalesRollups method answering each query of mdrc_data_query.sql, in the order of the file
+REPORT_METHODS = ('stores_by_country', 'stores_by_locality', 'sales_by_month', 'online_vs_offline',
+                  'sales_by_store_type', 'top_months', 'staff_by_country', 'store_type_sales', 'time_between_sales')
+
+
+class SalesRollups:
+    """
+    This class maintains summary tables of the sales in the warehouse, and answers the reports of mdrc_data_query.sql
+    from them instead of scanning orders_table joined with the dimension tables.
+
+    The rollups are keyed by date and store (rollup_sales_by_date_store), by product (rollup_sales_by_product) and by
+    country (rollup_stores). The store attributes (store_type, country_code) are joined from dim_store_details when a
+    report runs, as there are only a few hundred stores.
+
+    refresh() keeps them up to date:
+        - After a full load, when orders_table or one of the dimension tables has been replaced or upserted into
+          (see dimension_upsert.py), the rollups are rebuilt from scratch.
+        - When orders were only appended, only the orders past the watermark (the highest orders_table.index already
+          rolled up) are aggregated and added to the existing rows, with INSERT ... ON CONFLICT DO UPDATE. The store
+          rollup is rebuilt, for the placeholder stores the append may have added.
+    Either way the rollups and the watermark are updated in one transaction.
+
+    Attributes:
+        db_connector (DatabaseConnector): Connector to the warehouse.
+
+    Methods:
+        1. refresh()
+            - Brings the rollups up to date, incrementally when possible.
+            - Returns:
+                - str: 'rebuilt' or 'incremental'.
+
+        2. rebuild()
+            - Recomputes every rollup from scratch.
+
+        3. stores_by_country(), stores_by_locality(limit=7), sales_by_month(limit=6), online_vs_offline(),
+           sales_by_store_type(), top_months(limit=10), staff_by_country(), store_type_sales(country_code='DE'),
+           time_between_sales(limit=5)
+            - The reports of mdrc_data_query.sql, in order, with the same columns and ordering.
+            - Returns:
+                - DataFrame: The report.
+
+        4. top_products(limit=10)
+            - Products with the highest sales.
+    """
+    def __init__(self, db_connector):
+        self.db_connector = db_connector
+
+    def _engine(self):
+        return self.db_connector.get_engine('warehouse')
+
+    @instrumented
+    def refresh(self):
+        with self._engine().begin() as connection:
+            # One refresh at a time, so that two runs cannot roll up the same orders
+            connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('sales_rollups'))"))
+            versions = self._source_versions(connection)
+            state = self._state(connection)
+            if state is None or state['versions'] != versions:
+                self._rebuild(connection, versions)
+                return 'rebuilt'
+            self._append(connection, state['watermark'], versions)
+            return 'incremental'
+
+    @instrumented
+    def rebuild(self):
+        with self._engine().begin() as connection:
+            connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('sales_rollups'))"))
+            self._rebuild(connection, self._source_versions(connection))
+
+    def _source_versions(self, connection):
+        row = connection.execute(text(
+            'SELECT ' + ', '.join(f"to_regclass('{table_name}')::oid" for table_name in SOURCE_TABLES))).fetchone()
+        missing = [table_name for table_name, oid in zip(SOURCE_TABLES, row) if oid is None]
+        if missing:
+            raise RuntimeError(f"Cannot roll up the sales, missing tables: {', '.join(missing)}")
+        versions = ','.join(str(oid) for oid in row)
+        if connection.execute(text("SELECT to_regclass('fingerprint_tables') IS NOT NULL")).scalar():
+            changes = connection.execute(text(
+                "SELECT table_name, changes FROM fingerprint_tables WHERE table_name IN :table_names ORDER BY 1"
+            ).bindparams(bindparam('table_names', expanding=True)), {'table_names': list(SOURCE_TABLES)}).fetchall()
+            versions += ';' + ','.join(f'{table_name}:{count}' for table_name, count in changes)
+        return versions
+
+    def _state(self, connection):
+        connection.execute(text("""
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                name TEXT PRIMARY KEY, versions TEXT NOT NULL, watermark BIGINT NOT NULL, refreshed_at TIMESTAMP)"""))
+        row = connection.execute(text(
+            "SELECT versions, watermark FROM rollup_state WHERE name = 'sales'")).fetchone()
+        return None if row is None else {'versions': row[0], 'watermark': row[1]}
+
+    def _save_state(self, connection, versions, watermark):
+        connection.execute(text("""
+            INSERT INTO rollup_state (name, versions, watermark, refreshed_at) VALUES ('sales', :versions, :watermark, now())
+            ON CONFLICT (name) DO UPDATE
+            SET versions = EXCLUDED.versions, watermark = EXCLUDED.watermark, refreshed_at = EXCLUDED.refreshed_at"""),
+            {'versions': versions, 'watermark': watermark})
+
+    def _high_watermark(self, connection, low):
+        high = connection.execute(text('SELECT MAX(index) FROM orders_table WHERE index > :low'), {'low': low}).scalar()
+        return low if high is None else high
+
+    def _rebuild(self, connection, versions):
+        high = self._high_watermark(connection, -1)
+        for table_name, rollup in ROLLUP_TABLES.items():
+            connection.execute(text(f'DROP TABLE IF EXISTS {table_name}'))
+            connection.execute(text(rollup['create']))
+            connection.execute(text(f"INSERT INTO {table_name} {rollup['select']}"), {'low': -1, 'high': high})
+        self._rebuild_stores(connection)
+        self._save_state(connection, versions, high)
+
+    def _rebuild_stores(self, connection):
+        connection.execute(text('DROP TABLE IF EXISTS rollup_stores'))
+        connection.execute(text(STORE_ROLLUP))
+
+    def _append(self, connection, low, versions):
+        high = self._high_watermark(connection, low)
+        if high == low:
+            return
+        for table_name, rollup in ROLLUP_TABLES.items():
+            keys = ', '.join(rollup['keys'])
+            connection.execute(text(f"""
+                INSERT INTO {table_name} AS r {rollup['select']}
+                ON CONFLICT ({keys}) DO UPDATE SET
+                    number_of_sales = r.number_of_sales + EXCLUDED.number_of_sales,
+                    product_quantity = COALESCE(r.product_quantity + EXCLUDED.product_quantity, r.product_quantity,
+                                                EXCLUDED.product_quantity),
+                    total_sales = COALESCE(r.total_sales + EXCLUDED.total_sales, r.total_sales, EXCLUDED.total_sales),
+                    product_matches = r.product_matches + EXCLUDED.product_matches"""), {'low': low, 'high': high})
+        self._rebuild_stores(connection)
+        self._save_state(connection, versions, high)
+
+    def _query(self, query, parameters=None):
+        with self._engine().connect() as connection:
+            return pd.read_sql(text(query), connection, params=parameters)
+
+    # Milestone 4, task 1
+    def stores_by_country(self):
+        return self._query("""
+            SELECT country_code, SUM(store_count) AS store_count
+            FROM rollup_stores
+            GROUP BY country_code
+            ORDER BY store_count DESC""")
+
+    # Milestone 4, task 2
+    def stores_by_locality(self, limit=7):
+        return self._query("""
+            SELECT locality, SUM(store_count) AS store_count
+            FROM rollup_stores
+            GROUP BY locality
+            ORDER BY store_count DESC
+            LIMIT :limit""", {'limit': limit})
+
+    # Milestone 4, task 3
+    def sales_by_month(self, limit=6):
+        return self._query("""
+            SELECT SUM(total_sales) AS total_sales, month
+            FROM rollup_sales_by_date_store
+            WHERE year <> ''
+            GROUP BY month
+            HAVING SUM(product_matches) > 0
+            ORDER BY total_sales DESC
+            LIMIT :limit""", {'limit': limit})
+
+    # Milestone 4, task 3 (web vs offline)
+    def online_vs_offline(self):
+        return self._query("""
+            SELECT
+                SUM(r.number_of_sales) AS number_of_sales,
+                SUM(r.product_quantity) AS product_quantity_count,
+                CASE WHEN s.store_code LIKE :web_store_code THEN 'Web' ELSE 'Offline' END AS location
+            FROM rollup_sales_by_date_store r
+            INNER JOIN dim_store_details s ON r.store_code = s.store_code
+            GROUP BY location
+            ORDER BY number_of_sales""", {'web_store_code': WEB_STORE_CODE})
+
+    # Milestone 4, task 4
+    def sales_by_store_type(self):
+        return self._query("""
+            SELECT
+                s.store_type AS store_type,
+                ROUND(CAST(SUM(r.total_sales) AS decimal), 2) AS total_sales,
+                ROUND(CAST(SUM(r.total_sales) AS decimal)
+                      / CAST((SELECT SUM(total_sales) FROM rollup_sales_by_product) AS decimal) * 100, 2)
+                    AS percentag_total
+            FROM rollup_sales_by_date_store r
+            INNER JOIN dim_store_details s ON r.store_code = s.store_code
+            GROUP BY s.store_type
+            HAVING SUM(r.product_matches) > 0
+            ORDER BY total_sales DESC""")
+
+    # Milestone 4, task 5
+    def top_months(self, limit=10):
+        return self._query("""
+            SELECT ROUND(CAST(SUM(total_sales) AS decimal), 2) AS total_sales, year, month
+            FROM rollup_sales_by_date_store
+            WHERE year <> ''
+            GROUP BY year, month
+            HAVING SUM(product_matches) > 0
+            ORDER BY total_sales DESC
+            LIMIT :limit""", {'limit': limit})
+
+    # Milestone 4, task 7. Web counted as GB.
+    def staff_by_country(self):
+        return self._query("""
+            SELECT COALESCE(country_code, 'GB') AS country_code, SUM(staff_numbers) AS total_staff_headcount
+            FROM rollup_stores
+            GROUP BY COALESCE(country_code, 'GB')
+            ORDER BY total_staff_headcount DESC""")
+
+    # Milestone 4, task 8
+    def store_type_sales(self, country_code='DE'):
+        return self._query("""
+            SELECT s.store_type AS store_type, ROUND(CAST(SUM(r.total_sales) AS decimal), 2) AS total_sales
+            FROM rollup_sales_by_date_store r
+            INNER JOIN dim_store_details s ON r.store_code = s.store_code
+            WHERE r.year <> '' AND s.country_code = :country_code
+            GROUP BY s.store_type
+            HAVING SUM(r.product_matches) > 0
+            ORDER BY total_sales ASC""", {'country_code': country_code})
+
+    # Milestone 4, task 9. Computed from dim_date_times alone, the sales rollups are not involved.
+    def time_between_sales(self, limit=5):
+        return self._query("""
+            WITH cte AS (
+                SELECT TO_TIMESTAMP(CONCAT(year, '-', month, '-', day, ' ', timestamp), 'YYYY-MM-DD HH24:MI:SS')
+                    AS datetimes, year
+                FROM dim_date_times
+            ), cte2 AS (
+                SELECT year, datetimes, LEAD(datetimes, 1) OVER (ORDER BY datetimes DESC) AS time_difference
+                FROM cte
+            )
+            SELECT year, AVG((datetimes - time_difference)) AS actual_time_taken
+            FROM cte2
+            GROUP BY year
+            ORDER BY actual_time_taken DESC
+            LIMIT :limit""", {'limit': limit})
+
+    def top_products(self, limit=10):
+        return self._query("""
+            SELECT product_code, number_of_sales, product_quantity, ROUND(CAST(total_sales AS decimal), 2) AS total_sales
+            FROM rollup_sales_by_product
+            WHERE product_matches > 0
+            ORDER BY total_sales DESC NULLS LAST
+            LIMIT :limit""", {'limit': limit})
@@ -0,0 +1,218 @@
+from instrumentation import instrumentation
+from urllib.parse import urlparse
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+
+class SourceCache:
+    """
+    This class provides an on-disk, content-addressed cache for the raw sources of the pipeline (the card details PDF,
+    the products CSV and the date details JSON) and for the DataFrames parsed from them.
+
+    Each entry is keyed by the source URL plus a validator: the ETag or Last-Modified header for HTTP(S) sources, the
+    object ETag for s3:// sources, the modification time and size for local files, or the SHA-256 of the downloaded
+    content when the source exposes none of those. The key also holds the name of the parse function and a hash of
+    its code and of PARSE_CODE_FILES, so that a changed parser does not serve frames parsed by the old one. A rerun
+    against an unchanged source only costs a HEAD request and an unpickle.
+
+    Attributes:
+        cache_dir (str): Directory holding the cached artifacts and the 'index.json' manifest.
+        max_bytes (int): Size budget for the cache. The least recently used entries are evicted beyond it.
+        bypass (bool): When True the cache is neither read nor written and every source is parsed from scratch.
+
+    Methods:
+        1. get_frame(url, parse)
+            - Returns the DataFrame parsed from a source, from the cache when the source is unchanged.
+            - Parameters:
+                - url (str): HTTP(S) URL, s3:// address or local path of the source.
+                - parse (callable): Function turning a local path (or the url itself when bypassing) into a DataFrame.
+            - Returns:
+                - DataFrame: The parsed source.
+
+        2. validator(url)
+            - Returns the ETag/Last-Modified style validator of a source, or None if it has none.
+
+        3. clear()
+            - Removes every cached entry.
+    """
+    # The code behind the parse functions of data_extraction.py, besides the file each function is defined in
+    PARSE_CODE_FILES = ('data_extraction.py', 'columnar_json.py')
+
+    def __init__(self, cache_dir='.source_cache', max_bytes=2 * 1024 ** 3, bypass=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self._lock = threading.Lock()
+        if not bypass:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._index_path = os.path.join(cache_dir, 'index.json')
+
+    def get_frame(self, url, parse):
+        if self.bypass:
+            return parse(url)
+        validator = self.validator(url)
+        parser_version = self._parser_version(parse)
+        if validator is not None:
+            cached = self._load(self._key(url, validator, parser_version))
+            if cached is not None:
+                return cached
+        raw_path = self._fetch_raw(url)
+        if validator is None:
+            validator = f"sha256:{self._hash_file(raw_path)}"
+            cached = self._load(self._key(url, validator, parser_version))
+            if cached is not None:
+                self._discard_download(url, raw_path)
+                return cached
+        try:
+            df = parse(raw_path)
+        except Exception:
+            self._discard_download(url, raw_path)
+            raise
+        self._store(self._key(url, validator, parser_version), url, validator, raw_path, df)
+        return df
+
+    def validator(self, url):
+        scheme = urlparse(url).scheme
+        try:
+            if scheme in ('http', 'https'):
+                import requests
+                response = requests.head(url, allow_redirects=True, timeout=10)
+                response.raise_for_status()
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+                if etag or last_modified:
+                    return f"{etag}|{last_modified}|{response.headers.get('Content-Length')}"
+                return None
+            if scheme == 's3':
+                bucket, key = self._split_s3_address(url)
+                import boto3
+                return boto3.client('s3').head_object(Bucket=bucket, Key=key)['ETag']
+            stat = os.stat(url)
+            return f"{stat.st_mtime_ns}-{stat.st_size}"
+        except Exception as e:
+            print(f"Could not validate '{url}', falling back to a content hash: {e}")
+            return None
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _key(self, url, validator, parser_version):
+        return hashlib.sha256(f"{url}\n{validator}\n{parser_version}".encode()).hexdigest()
+
+    def _parser_version(self, parse):
+        name = f"{getattr(parse, '__module__', None)}.{getattr(parse, '__qualname__', type(parse).__qualname__)}"
+        digest = hashlib.sha256(name.encode())
+        code_dir = os.path.dirname(os.path.abspath(__file__))
+        paths = [os.path.join(code_dir, path) for path in self.PARSE_CODE_FILES]
+        try:
+            paths.insert(0, inspect.getsourcefile(parse))
+        except TypeError:
+            # Built-in functions and other callables without a source file are only keyed by name
+            pass
+        for path in paths:
+            if path is not None and os.path.exists(path):
+                with open(path, 'rb') as code_file:
+                    digest.update(code_file.read())
+        return digest.hexdigest()
+
+    def _hash_file(self, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as raw_file:
+            for block in iter(lambda: raw_file.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _split_s3_address(self, url):
+        parsed = urlparse(url)
+        return parsed.netloc, parsed.path.lstrip('/')
+
+    def _fetch_raw(self, url):
+        # Local files are parsed in place, remote sources are downloaded next to the cache entries
+        scheme = urlparse(url).scheme
+        if scheme not in ('http', 'https', 's3'):
+            return url
+        handle, raw_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.download')
+        os.close(handle)
+        if scheme == 's3':
+            bucket, key = self._split_s3_address(url)
+            import boto3
+            boto3.client('s3').download_file(bucket, key, raw_path)
+        else:
+            import requests
+            with requests.get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                with open(raw_path, 'wb') as raw_file:
+                    for block in response.iter_content(chunk_size=1024 * 1024):
+                        raw_file.write(block)
+        instrumentation.record_bytes(os.path.getsize(raw_path))
+        return raw_path
+
+    def _discard_download(self, url, raw_path):
+        if raw_path != url:
+            os.remove(raw_path)
+
+    def _read_index(self):
+        try:
+            with open(self._index_path) as index_file:
+                return json.load(index_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_index(self, index):
+        temporary_path = f"{self._index_path}.tmp"
+        with open(temporary_path, 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(temporary_path, self._index_path)
+
+    def _load(self, key):
+        frame_path = os.path.join(self.cache_dir, f"{key}.pkl")
+        with self._lock:
+            index = self._read_index()
+            if key not in index or not os.path.exists(frame_path):
+                return None
+            index[key]['last_access'] = time.time()
+            self._write_index(index)
+        try:
+            with open(frame_path, 'rb') as frame_file:
+                return pickle.load(frame_file)
+        except FileNotFoundError:
+            # Evicted by another thread since the index was read
+            return None
+
+    def _store(self, key, url, validator, raw_path, df):
+        files = {}
+        if raw_path != url:
+            stored_raw_path = os.path.join(self.cache_dir, f"{key}.raw")
+            os.replace(raw_path, stored_raw_path)
+            files['raw'] = os.path.getsize(stored_raw_path)
+        frame_path = os.path.join(self.cache_dir, f"{key}.pkl")
+        with open(frame_path, 'wb') as frame_file:
+            pickle.dump(df, frame_file, protocol=pickle.HIGHEST_PROTOCOL)
+        files['pkl'] = os.path.getsize(frame_path)
+        with self._lock:
+            index = self._read_index()
+            index[key] = {'url': url, 'validator': validator, 'files': files, 'last_access': time.time()}
+            self._evict(index)
+            self._write_index(index)
+
+    def _evict(self, index):
+        # Drop the least recently used entries until the cache fits in max_bytes
+        total_bytes = sum(sum(entry['files'].values()) for entry in index.values())
+        for key in sorted(index, key=lambda key: index[key]['last_access']):
+            if total_bytes <= self.max_bytes:
+                break
+            for extension in index[key]['files']:
+                path = os.path.join(self.cache_dir, f"{key}.{extension}")
+                if os.path.exists(path):
+                    os.remove(path)
+            total_bytes -= sum(index[key]['files'].values())
+            del index[key]
@@ -0,0 +1,217 @@
+from instrumentation import instrumentation, instrumented
+from urllib.parse import quote
+import hashlib
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shutil
+import threading
+import time
+
+
+class StagingArea:
+    """
+    This class keeps the cleaned tables on disk as partitioned Parquet between cleaning and loading, so that a failed
+    load can be retried, or the whole warehouse rebuilt, without extracting and cleaning the sources again.
+
+    Each table is staged in its own directory, one subdirectory per value of its partition column in the Hive layout
+    (e.g. 'dim_store_details/country_code=GB/part-00000.parquet'), with one file per partition for every frame or
+    chunk staged. Tables are read back one file at a time through memory-mapped reads, so a load never holds more
+    than one file of a streamed table in memory.
+
+    A manifest ('manifest.json') records, per table, the version of its inputs, the row count of the whole table and
+    of each partition, the pandas dtype and Parquet type of each column, when it was staged, and any metadata of the
+    extraction. A table is only
+    re-extracted and re-cleaned when the version of its inputs changed.
+
+    Attributes:
+        staging_dir (str): Directory holding one directory per staged table and the manifest.
+
+    Methods:
+        1. input_version(source_version, code_files=CLEANING_CODE_FILES, **settings)
+            - Combines the version of a table's source with the cleaning code and settings applied to it.
+            - Returns:
+                - str: The input version to pass to is_current and stage, or None if the source has no version.
+
+        2. is_current(table_name, input_version)
+            - Returns True if the table is staged from inputs of that version.
+
+        3. stage(table_name, frames, input_version, metadata=None)
+            - Writes a DataFrame, or an iterable of DataFrame chunks, as the staged table, replacing any previous
+              version once every chunk is written, and records it in the manifest. metadata, a JSON-serializable dict
+              read once every chunk is written, is recorded with it (e.g. the high-water mark of the extracted rows).
+            - Every chunk is cast to the dtypes of the first one, a ValueError is raised if one cannot be. If the
+              chunks raise, nothing is staged or recorded and the error is raised.
+            - Returns:
+                - int: Number of rows staged.
+
+        4. read_partitions(table_name)
+            - Yields the staged table one Parquet file at a time, with the dtypes it was staged with.
+
+        5. manifest()
+            - Returns the manifest entries of every staged table.
+    """
+    # Partition column of each table. orders_table has no date of its own, only the date_uuid key into
+    # dim_date_times, so it is partitioned on the first character of date_uuid.
+    PARTITION_COLUMNS = {
+        'dim_users': 'country_code',
+        'orders_table': 'date_uuid',
+        'dim_card_details': 'card_provider',
+        'dim_store_details': 'country_code',
+        'dim_products': 'category',
+        'dim_date_times': 'year',
+    }
+    # Columns with (nearly) a distinct value per row, partitioned on their first character instead
+    PREFIX_PARTITION_COLUMNS = ('date_uuid',)
+    # Directory name of the partition of missing values, as in Hive
+    NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+    # Changes to these files change the staged output, so they are part of every input version
+    CLEANING_CODE_FILES = ('data_cleaning.py', 'date_parsing.py', 'compact_dtypes.py')
+
+    def __init__(self, staging_dir='staging'):
+        self.staging_dir = staging_dir
+        self._lock = threading.Lock()
+        os.makedirs(staging_dir, exist_ok=True)
+        self._manifest_path = os.path.join(staging_dir, 'manifest.json')
+
+    def input_version(self, source_version, code_files=CLEANING_CODE_FILES, **settings):
+        if source_version is None:
+            return None
+        digest = hashlib.sha256(str(source_version).encode())
+        for path in code_files:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), path), 'rb') as code_file:
+                digest.update(code_file.read())
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def is_current(self, table_name, input_version):
+        if input_version is None:
+            return False
+        entry = self.manifest().get(table_name)
+        return (entry is not None and entry['input_version'] == input_version
+                and os.path.isdir(os.path.join(self.staging_dir, table_name)))
+
+    @instrumented
+    def stage(self, table_name, frames, input_version=None, metadata=None):
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+        table_dir = os.path.join(self.staging_dir, table_name)
+        # Write next to the current version and swap once complete, so a failure leaves the previous one in place
+        temporary_dir = f"{table_dir}.tmp"
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        os.makedirs(temporary_dir)
+        partition_rows = {}
+        dtypes = None
+        arrow_schema = None
+        part_number = 0
+        try:
+            for df in frames:
+                if dtypes is None:
+                    dtypes = {column: _dtype_name(dtype) for column, dtype in df.dtypes.items()}
+                else:
+                    df = _match_dtypes(table_name, df, dtypes)
+                for partition, partition_df in self._partitions(table_name, df):
+                    partition_dir = os.path.join(temporary_dir, partition)
+                    os.makedirs(partition_dir, exist_ok=True)
+                    table = pa.Table.from_pandas(partition_df, preserve_index=True)
+                    path = os.path.join(partition_dir, f"part-{part_number:05d}.parquet")
+                    pq.write_table(table, path)
+                    instrumentation.record_bytes(os.path.getsize(path))
+                    arrow_schema = arrow_schema or {field.name: str(field.type) for field in table.schema}
+                    partition_rows[partition] = partition_rows.get(partition, 0) + len(partition_df)
+                part_number += 1
+        except BaseException:
+            # A stream cut short is never recorded, the previous version and its manifest entry stay current
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+            raise
+        with self._lock:
+            shutil.rmtree(table_dir, ignore_errors=True)
+            os.replace(temporary_dir, table_dir)
+            manifest = self._read_manifest()
+            manifest[table_name] = {
+                'input_version': input_version,
+                'rows': sum(partition_rows.values()),
+                'partition_column': self.PARTITION_COLUMNS.get(table_name),
+                'partitions': partition_rows,
+                'dtypes': dtypes or {},
+                'parquet_schema': arrow_schema or {},
+                'staged_at': time.time(),
+                'metadata': dict(metadata or {}),
+            }
+            self._write_manifest(manifest)
+        return manifest[table_name]['rows']
+
+    def _partitions(self, table_name, df):
+        column = self.PARTITION_COLUMNS.get(table_name)
+        if column is None or column not in df.columns or df.empty:
+            yield 'all', df
+            return
+        keys = df[column].astype(str)
+        if column in self.PREFIX_PARTITION_COLUMNS:
+            keys = keys.str[0]
+        keys = keys.where(df[column].notna().to_numpy(), self.NULL_PARTITION)
+        for key, partition_df in df.groupby(keys.to_numpy(), sort=True):
+            value = key if key == self.NULL_PARTITION else quote(key, safe='')
+            yield f"{column}={value}", partition_df
+
+    def read_partitions(self, table_name):
+        entry = self.manifest().get(table_name)
+        if entry is None:
+            raise FileNotFoundError(f"'{table_name}' has not been staged in {self.staging_dir}")
+        table_dir = os.path.join(self.staging_dir, table_name)
+        for partition in sorted(entry['partitions']):
+            partition_dir = os.path.join(table_dir, partition)
+            for file_name in sorted(os.listdir(partition_dir)):
+                path = os.path.join(partition_dir, file_name)
+                instrumentation.record_bytes(os.path.getsize(path))
+                df = pq.read_table(path, memory_map=True).to_pandas()
+                yield _restore_dtypes(df, entry['dtypes'])
+
+    def manifest(self):
+        with self._lock:
+            return self._read_manifest()
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_manifest(self, manifest):
+        temporary_path = f"{self._manifest_path}.tmp"
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(temporary_path, self._manifest_path)
+
+
+def _dtype_name(dtype):
+    # Keep the storage of string columns, str() alone names both 'string'
+    if isinstance(dtype, pd.StringDtype):
+        return f"string[{dtype.storage}]"
+    return str(dtype)
+
+
+def _match_dtypes(table_name, df, dtypes):
+    # Every chunk is staged with the columns and dtypes of the first one, recorded in the manifest
+    if list(df.columns) != list(dtypes):
+        raise ValueError(f"A chunk of '{table_name}' has columns {list(df.columns)}, expected {list(dtypes)}")
+    for column, dtype in dtypes.items():
+        if _dtype_name(df[column].dtype) == dtype:
+            continue
+        try:
+            df = df.assign(**{column: df[column].astype(dtype)})
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Column '{column}' of a chunk of '{table_name}' is {df[column].dtype} and cannot be "
+                             f"staged as {dtype}, the dtype of the first chunk: {e}") from e
+    return df
+
+
+def _restore_dtypes(df, dtypes):
+    # Parquet reads Arrow strings back as Python strings, and object columns holding only numbers as numbers
+    for column, dtype in dtypes.items():
+        if column in df.columns and dtype != 'category' and _dtype_name(df[column].dtype) != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+
+
+"""
+Synthetic Data Generators
+
+Seeded generators producing DataFrames shaped like each raw source of the pipeline, including the dirty rows that
+DataCleaning has to deal with: NULL rows, rows filled with random symbols, misspelt country codes ('GGB'), continent
+typos ('eeEurope'), garbage weights, mixed date formats and duplicated card numbers.
+
+Values are drawn from small pools of pre-built strings, so that 10M-row frames can be generated in seconds and
+entirely offline.
+
+Generators (all take rows and seed, and return a DataFrame):
+- generate_users: legacy_users table from RDS, input of clean_user_data.
+- generate_cards: card details PDF, input of clean_card_data.
+- generate_stores: store details API, input of clean_store_data.
+- generate_products: products CSV from S3, input of clean_product_data.
+- generate_orders: orders_table from RDS, input of clean_orders_data.
+- generate_date_times: date details JSON, input of clean_time.
+"""
+
+# Share of rows replaced by each kind of dirty row
+NULL_ROW_RATE = 0.001
+RANDOM_ROW_RATE = 0.001
+POOL_SIZE = 5000
+
+
+def _random_strings(rng, count, length=10):
+    letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'))
+    return [''.join(row) for row in rng.choice(letters, size=(count, length))]
+
+
+def _uuids(rng, count):
+    values = rng.integers(0, 2 ** 63, size=(count, 2))
+    return [f'{high:016x}{low:016x}' for high, low in values]
+
+
+def _pick(rng, pool, rows):
+    return np.asarray(pool, dtype=object)[rng.integers(0, len(pool), rows)]
+
+
+def _dates(rng, count, start_year, end_year, formats=('%Y-%m-%d',)):
+    days = rng.integers(0, (end_year - start_year) * 365, count)
+    dates = pd.Timestamp(f'{start_year}-01-01') + pd.to_timedelta(days, unit='D')
+    chosen = rng.integers(0, len(formats), count)
+    return [date.strftime(formats[choice]) for date, choice in zip(dates, chosen)]
+
+
+def _dirty_rows(rng, df, rows, null_value=None):
+    # Overwrite whole rows with NULLs and with random symbols, the way the real sources are corrupted
+    null_rows = rng.random(rows) < NULL_ROW_RATE
+    random_rows = rng.random(rows) < RANDOM_ROW_RATE
+    df.loc[null_rows, :] = null_value
+    symbols = np.asarray(_random_strings(rng, POOL_SIZE), dtype=object)
+    random_values = symbols[rng.integers(0, POOL_SIZE, random_rows.sum())]
+    df.loc[random_rows, :] = np.repeat(random_values[:, None], df.shape[1], axis=1)
+    return df
+
+
+def generate_users(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    countries = _pick(rng, ['United Kingdom', 'Germany', 'United States'], rows)
+    country_codes = pd.Series(countries).map({'United Kingdom': 'GB', 'Germany': 'DE', 'United States': 'US'})
+    # A few GB users carry the misspelt 'GGB' code
+    country_codes = country_codes.mask((countries == 'United Kingdom') & (rng.random(rows) < 0.01), 'GGB')
+    phone_formats = _pick(rng, ['+44(0){}', '0{} 960', '+49(0)30 {}', '(030) {}', '+1-{}-0100', '001-{}x123'], rows)
+    phone_numbers = [phone_format.format(number) for phone_format, number in
+                     zip(phone_formats, rng.integers(1000, 99999, rows))]
+    df = pd.DataFrame({
+        'first_name': _pick(rng, _random_strings(rng, POOL_SIZE, 6), rows),
+        'last_name': _pick(rng, _random_strings(rng, POOL_SIZE, 8), rows),
+        'date_of_birth': _pick(rng, _dates(rng, POOL_SIZE, 1940, 2006, ('%Y-%m-%d', '%Y %B %d', '%B %Y %d')), rows),
+        'company': _pick(rng, _random_strings(rng, POOL_SIZE, 12), rows),
+        'email_address': _pick(rng, [f'{name.lower()}@example.com' for name in _random_strings(rng, POOL_SIZE, 8)],
+                               rows),
+        'address': _pick(rng, _random_strings(rng, POOL_SIZE, 24), rows),
+        'country': countries,
+        'country_code': country_codes.to_numpy(dtype=object),
+        'phone_number': phone_numbers,
+        'join_date': _pick(rng, _dates(rng, POOL_SIZE, 1992, 2023, ('%Y-%m-%d', '%Y/%m/%d', '%Y %B %d')), rows),
+        'user_uuid': _pick(rng, _uuids(rng, POOL_SIZE), rows),
+    })
+    return _dirty_rows(rng, df, rows, null_value='NULL')
+
+
+def generate_cards(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    card_numbers = rng.integers(10 ** 11, 10 ** 16, rows).astype(str).astype(object)
+    # Some card numbers come out of the PDF with leading '?' characters
+    mangled = rng.random(rows) < 0.005
+    card_numbers[mangled] = ['???' + number for number in card_numbers[mangled]]
+    # Duplicate a share of the card numbers so _remove_duplicate_rows has work to do
+    duplicated = rng.random(rows) < 0.01
+    card_numbers[duplicated] = card_numbers[rng.integers(0, rows, duplicated.sum())]
+    df = pd.DataFrame({
+        'card_number': card_numbers,
+        'expiry_date': _pick(rng, [f'{month:02d}/{year}' for month in range(1, 13) for year in range(22, 32)], rows),
+        'card_provider': _pick(rng, ['VISA 16 digit', 'JCB 16 digit', 'Mastercard', 'American Express',
+                                     'Diners Club / Carte Blanche', 'Discover', 'Maestro'], rows),
+        'date_payment_confirmed': _pick(rng, _dates(rng, POOL_SIZE, 1992, 2023), rows),
+    })
+    return _dirty_rows(rng, df, rows, null_value='NULL')
+
+
+def generate_stores(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    country_codes = _pick(rng, ['GB', 'DE', 'US'], rows)
+    continents = np.where(country_codes == 'US', 'America', 'Europe').astype(object)
+    typos = rng.random(rows) < 0.02
+    continents[typos] = 'ee' + continents[typos]
+    staff_numbers = rng.integers(1, 200, rows).astype(str).astype(object)
+    letters = rng.random(rows) < 0.01
+    staff_numbers[letters] = ['J' + staff for staff in staff_numbers[letters]]
+    df = pd.DataFrame({
+        'index': np.arange(rows),
+        'address': _pick(rng, _random_strings(rng, POOL_SIZE, 24), rows),
+        'longitude': rng.uniform(-180, 180, rows).round(5).astype(str),
+        'lat': None,
+        'locality': _pick(rng, ['High Wycombe', 'Berlin', 'New York', 'Chapletown', 'Belper', 'Munich'], rows),
+        'store_code': [f'ST-{value:08X}' for value in rng.integers(0, 2 ** 32, rows)],
+        'staff_numbers': staff_numbers,
+        'opening_date': _pick(rng, _dates(rng, POOL_SIZE, 1990, 2023, ('%Y-%m-%d', '%Y %B %d', '%B %Y %d',
+                                                                       '%Y/%m/%d')), rows),
+        'store_type': _pick(rng, ['Local', 'Super Store', 'Mall Kiosk', 'Outlet', 'Web Portal'], rows),
+        'latitude': rng.uniform(-90, 90, rows).round(5).astype(str),
+        'country_code': country_codes,
+        'continent': continents,
+    })
+    return _dirty_rows(rng, df, rows, null_value='NULL')
+
+
+def generate_products(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    weight_values = rng.integers(1, 2000, POOL_SIZE)
+    weight_formats = ['{}g', '{}kg', '{}ml', '{}oz', '{} x {}g', '{}g .']
+    weights = [weight_formats[choice].format(value % 24 + 2, value) if choice == 4
+               else weight_formats[choice].format(value)
+               for choice, value in zip(rng.integers(0, len(weight_formats), POOL_SIZE), weight_values)]
+    df = pd.DataFrame({
+        'product_name': _pick(rng, _random_strings(rng, POOL_SIZE, 20), rows),
+        'product_price': _pick(rng, [f'£{price:.2f}' for price in rng.uniform(0.5, 500, POOL_SIZE)], rows),
+        'weight': _pick(rng, weights, rows),
+        'category': _pick(rng, ['toys-and-games', 'sports-and-leisure', 'pets', 'homeware', 'health-and-beauty',
+                                'food-and-drink', 'diy'], rows),
+        'EAN': rng.integers(10 ** 12, 10 ** 13, rows).astype(str),
+        'date_added': _pick(rng, _dates(rng, POOL_SIZE, 1992, 2023), rows),
+        'uuid': _pick(rng, _uuids(rng, POOL_SIZE), rows),
+        'removed': _pick(rng, ['Still_avaliable', 'Removed'], rows),
+        'product_code': [f'{letter}{number}-{value}' for letter, number, value in zip(
+            _pick(rng, list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'), rows), rng.integers(0, 10, rows),
+            rng.integers(1000, 99999999, rows))],
+    })
+    return _dirty_rows(rng, df, rows, null_value=np.nan)
+
+
+def generate_orders(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'level_0': np.arange(rows),
+        'date_uuid': _uuids(rng, rows),
+        'first_name': None,
+        'last_name': None,
+        'user_uuid': _pick(rng, _uuids(rng, POOL_SIZE), rows),
+        'card_number': _pick(rng, rng.integers(10 ** 11, 10 ** 16, POOL_SIZE).astype(str), rows),
+        'store_code': _pick(rng, [f'ST-{value:08X}' for value in rng.integers(0, 2 ** 32, 450)], rows),
+        'product_code': _pick(rng, [f'A{value}-{value * 7 % 1000}' for value in range(1800)], rows),
+        '1': None,
+        'product_quantity': rng.integers(1, 14, rows),
+    })
+
+
+def generate_date_times(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    seconds = rng.integers(0, 24 * 3600, rows)
+    hours = seconds // 3600
+    time_periods = np.select([hours < 6, hours < 11, hours < 14, hours < 18],
+                             ['Late_Hours', 'Morning', 'Midday', 'Evening'], 'Late_Hours').astype(object)
+    df = pd.DataFrame({
+        'timestamp': [f'{hour:02d}:{minute:02d}:{second:02d}' for hour, minute, second in
+                      zip(hours, seconds // 60 % 60, seconds % 60)],
+        'month': rng.integers(1, 13, rows).astype(str),
+        'year': rng.integers(1992, 2023, rows).astype(str),
+        'day': rng.integers(1, 29, rows).astype(str),
+        'time_period': time_periods,
+        'date_uuid': _uuids(rng, rows),
+    })
+    return _dirty_rows(rng, df, rows, null_value='NULL')
@@ -0,0 +1,176 @@
+from sqlalchemy import BigInteger, Boolean, Column, Date, Float, MetaData, SmallInteger, String, Table, Text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.schema import CreateTable
+import numpy as np
+import pandas as pd
+
+
+"""
+Table Schemas
+
+Registry of the final shape of every warehouse table: the SQL type of each column, the columns derived from the
+cleaned data, and the keys and join indexes of the star schema.
+DatabaseConnector.upload_to_db(..., schema=TABLE_SCHEMAS[table_name]) creates the table with these types and computes
+the derived columns on the way in, so each table is written once, in its final shape, instead of being loaded as TEXT
+and rewritten by a series of ALTER TABLE ... TYPE ... USING and UPDATE statements.
+
+Values are sent to Postgres as text and parsed by the input function of the column type, which is the same parsing
+the `::UUID`, `::DATE` or `::SMALLINT` casts of star_schema.sql used to apply.
+
+The keys and indexes are created once every table is loaded, by DatabaseConnector.create_primary_keys,
+create_indexes and create_foreign_keys, and dropped before a table is reloaded by DatabaseConnector.drop_keys.
+"""
+
+
+class TableSchema:
+    """
+    This class describes the final shape of a warehouse table.
+
+    Attributes:
+        columns (dict): SQLAlchemy type of each column, in table order.
+        derived (dict): Function per derived column, taking the frame and returning the column's values. Derived
+            columns are computed in order, and may replace a cleaned column of the same name.
+        dropped (tuple): Cleaned columns that are not loaded.
+        primary_key (str): Primary key column, None for no primary key.
+        foreign_keys (dict): Dimension table referenced by each foreign key column, through its primary key.
+        indexes (tuple): Columns indexed for the joins of the star schema, beyond the primary key.
+
+    Methods:
+        1. prepare(df)
+            - Returns df in the table's final shape: derived columns computed, dropped columns removed, columns in
+              table order, and integral numbers bound for text columns written without a decimal part.
+            - Raises:
+                - ValueError: If df has a column the schema does not know, or lacks one it needs.
+
+        2. create_table_sql(table_name)
+            - Returns the CREATE TABLE statement of the table.
+    """
+    def __init__(self, columns, derived=None, dropped=(), primary_key=None, foreign_keys=None, indexes=()):
+        self.columns = columns
+        self.derived = derived or {}
+        self.dropped = tuple(dropped)
+        self.primary_key = primary_key
+        self.foreign_keys = foreign_keys or {}
+        self.indexes = tuple(indexes)
+
+    def prepare(self, df):
+        df = df.copy()
+        for column, derive in self.derived.items():
+            df[column] = derive(df)
+        unexpected = [column for column in df.columns if column not in self.columns and column not in self.dropped]
+        missing = [column for column in self.columns if column not in df.columns]
+        if unexpected or missing:
+            raise ValueError(f"Columns do not match the table schema, unexpected: {unexpected}, missing: {missing}")
+        df = df[list(self.columns)]
+        for column, column_type in self.columns.items():
+            if isinstance(column_type, String) and pd.api.types.is_float_dtype(df[column].dtype):
+                # A float column cast to VARCHAR gives '9', not '9.0'
+                values = df[column]
+                if (values.dropna() == np.floor(values.dropna())).all():
+                    df[column] = values.astype('Int64')
+        return df
+
+    def create_table_sql(self, table_name):
+        columns = [Column(name, column_type) for name, column_type in self.columns.items()]
+        table = Table(table_name, MetaData(), *columns)
+        return str(CreateTable(table).compile(dialect=postgresql.dialect()))
+
+
+def _merge_latitude(df):
+    # CONCAT(lat, '', latitude): lat is filled for a few stores only, missing values count as empty strings
+    merged = df['lat'].astype(object).fillna('').astype(str) + df['latitude'].astype(object).fillna('').astype(str)
+    return merged.where(merged != '', None)
+
+
+def _strip_pound_sign(df):
+    prices = df['product_price'].astype(object)
+    return prices.where(~prices.str.startswith('£', na=False), prices.str.replace('£', '', regex=False))
+
+
+def _weight_class(df):
+    weight = df['weight'].astype(float)
+    # Missing weights fail every comparison and fall through to 'Truck_Required', as in the SQL CASE
+    return np.select([weight < 2, (weight >= 2) & (weight < 40), (weight >= 40) & (weight < 140)],
+                     ['Light', 'Mid_Sized', 'Heavy'], 'Truck_Required')
+
+
+def _still_available(df):
+    # The source spells it 'Still_avaliable'
+    availability = {'Still_avaliable': True, 'Still_available': True, 'Removed': False}
+    return df['removed'].astype(object).map(availability).astype('boolean')
+
+
+TABLE_SCHEMAS = {
+    'orders_table': TableSchema({
+        'index': BigInteger(),
+        'date_uuid': UUID(),
+        'user_uuid': UUID(),
+        'card_number': String(19),
+        'store_code': String(12),
+        'product_code': String(12),
+        'product_quantity': SmallInteger(),
+    }, foreign_keys={'date_uuid': 'dim_date_times', 'user_uuid': 'dim_users', 'card_number': 'dim_card_details',
+                     'store_code': 'dim_store_details', 'product_code': 'dim_products'},
+        # Postgres does not index the referencing side of a foreign key
+        indexes=('date_uuid', 'user_uuid', 'card_number', 'store_code', 'product_code')),
+    'dim_users': TableSchema({
+        'index': BigInteger(),
+        'first_name': String(255),
+        'last_name': String(255),
+        'date_of_birth': Date(),
+        'company': Text(),
+        'email_address': Text(),
+        'address': Text(),
+        'country': Text(),
+        'country_code': String(2),
+        'phone_number': Text(),
+        'join_date': Date(),
+        'user_uuid': UUID(),
+    }, primary_key='user_uuid'),
+    # 'level_0' is the frame's own index, written next to the 'index' column that comes from the API
+    'dim_store_details': TableSchema({
+        'level_0': BigInteger(),
+        'index': BigInteger(),
+        'address': Text(),
+        'longitude': Float(),
+        'locality': String(255),
+        'store_code': String(12),
+        'staff_numbers': SmallInteger(),
+        'opening_date': Date(),
+        'store_type': String(255),
+        'latitude': Float(),
+        'country_code': String(2),
+        'continent': String(255),
+    }, derived={'latitude': _merge_latitude}, dropped=('lat',), primary_key='store_code'),
+    'dim_products': TableSchema({
+        'index': BigInteger(),
+        'product_name': Text(),
+        'product_price': Float(),
+        'weight': Float(),
+        'category': Text(),
+        'EAN': String(17),
+        'date_added': Date(),
+        'uuid': UUID(),
+        'still_available': Boolean(),
+        'product_code': String(12),
+        'weight_class': String(14),
+    }, derived={'product_price': _strip_pound_sign, 'weight_class': _weight_class,
+                'still_available': _still_available}, dropped=('removed',), primary_key='product_code'),
+    'dim_date_times': TableSchema({
+        'index': BigInteger(),
+        'timestamp': Text(),
+        'month': String(2),
+        'year': String(4),
+        'day': String(2),
+        'time_period': String(10),
+        'date_uuid': UUID(),
+    }, primary_key='date_uuid'),
+    'dim_card_details': TableSchema({
+        'index': BigInteger(),
+        'card_number': String(19),
+        'expiry_date': String(5),
+        'card_provider': Text(),
+        'date_payment_confirmed': Date(),
+    }, primary_key='card_number'),
+}
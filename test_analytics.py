@@ -0,0 +1,24 @@
+from analytics import LocalAnalytics, to_duckdb_sql
+import pandas as pd
+
+
+def test_to_duckdb_sql_rewrites_the_templates_of_to_timestamp_and_to_char_only():
+    query = ("SELECT TO_TIMESTAMP(CONCAT(year, '-', month), 'YYYY-MM'), to_char(d, 'DD/MM'), 'MM', 'YYYY-DD' "
+             "FROM t WHERE code = 'DD'")
+    assert to_duckdb_sql(query) == ("SELECT strptime(CONCAT(year, '-', month), '%Y-%m'), strftime(d, '%d/%m'), "
+                                     "'MM', 'YYYY-DD' FROM t WHERE code = 'DD'")
+
+
+def test_to_duckdb_sql_rewrites_regular_expression_matches_and_bare_decimals():
+    assert to_duckdb_sql("SELECT CAST(x AS decimal) FROM t WHERE code ~ '^[A-Z]+$'") == (
+        "SELECT CAST(x AS DECIMAL(38, 10)) FROM t WHERE regexp_matches(code, '^[A-Z]+$')")
+
+
+def test_query_runs_the_rewritten_postgres_sql_on_registered_frames():
+    with LocalAnalytics() as analytics:
+        analytics.register('dates', pd.DataFrame({'year': ['2010', '1994'], 'month': ['10', '11'],
+                                                  'day': ['04', '24'], 'timestamp': ['12:30:00', '09:05:01']}))
+        result = analytics.query("SELECT TO_TIMESTAMP(CONCAT(year, '-', month, '-', day, ' ', timestamp), "
+                                 "'YYYY-MM-DD HH24:MI:SS') AS Datetimes FROM dates ORDER BY datetimes")
+    assert result.columns.tolist() == ['datetimes']
+    assert result['datetimes'].tolist() == [pd.Timestamp('1994-11-24 09:05:01'), pd.Timestamp('2010-10-04 12:30:00')]
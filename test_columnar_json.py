@@ -0,0 +1,43 @@
+from columnar_json import read_columnar_json
+import columnar_json
+import io
+import json
+import pandas as pd
+import pytest
+
+
+@pytest.mark.parametrize('block_size', [3, 17, 1024 ** 2])
+def test_read_columnar_json_matches_json_load_at_any_block_size(block_size):
+    document = {
+        'timestamp': {str(row): f"{row % 24:02d}:00:00" for row in range(50)},
+        'note': {str(row): 'a,}{"b' if row % 3 else None for row in range(50)},
+        'nested': {str(row): {'x': row, 'y': [1, {'z': '}'}]} for row in range(50)},
+    }
+    df = read_columnar_json(io.StringIO(json.dumps(document)), block_size=block_size)
+    pd.testing.assert_frame_equal(df, pd.DataFrame({name: list(column.values()) for name, column in document.items()}))
+
+
+def test_read_columnar_json_types_integer_columns():
+    document = json.dumps({'month': {'0': '1', '1': 'x', '2': None, '3': '12'}})
+    month = read_columnar_json(io.StringIO(document), {'month': 'Int8'})['month']
+    assert str(month.dtype) == 'Int8'
+    assert month.tolist() == [1, pd.NA, pd.NA, 12]
+
+
+def test_read_columnar_json_keeps_numbers_that_are_not_integers_as_floats():
+    document = json.dumps({'month': {'0': '1', '1': '2.5', '2': 'x', '3': '300'}})
+    month = read_columnar_json(io.StringIO(document), {'month': 'Int8'})['month']
+    expected = pd.to_numeric(pd.Series(['1', '2.5', 'x', '300']), errors='coerce')
+    pd.testing.assert_series_equal(month, expected, check_names=False)
+
+
+def test_decode_members_decodes_a_block_at_most_three_times(monkeypatch):
+    decodes = []
+    try_decode = columnar_json._try_decode
+    monkeypatch.setattr(columnar_json, '_try_decode', lambda *args: decodes.append(args) or try_decode(*args))
+    # Braces and commas inside strings and nested values, and a member cut off by the end of the buffer
+    buffer = ', '.join(f'"{row}": {{"v": "}},{{", "w": [{row}, {{}}]}}' for row in range(1000)) + ', "1000": "a,}'
+    members, cut, closed = columnar_json._decode_members(buffer, 0)
+    assert len(members) == 1000 and not closed
+    assert buffer[cut:].startswith(', "1000"')
+    assert len(decodes) <= 3
@@ -0,0 +1,57 @@
+from benchmarks import _legacy_convert_product_weights
+from data_cleaning import DataCleaning
+from synthetic_data import generate_stores
+import numpy as np
+import pandas as pd
+
+
+def _weights(rows=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    units = rng.choice(['g', 'kg', 'ml', 'oz', ''], rows)
+    weights = [f"{value:.3f}{unit}" for value, unit in zip(rng.random(rows) * 900, units)]
+    weights += [f"{count} x {value:.2f}g" for count, value in zip(rng.integers(2, 20, rows // 4),
+                                                                   rng.random(rows // 4) * 500)]
+    weights += ['77g .', '1.5l', '250ml', '12 x 100g']
+    return pd.DataFrame({'weight': weights})
+
+
+def test_convert_product_weights_gives_the_legacy_kilograms_to_the_last_bit():
+    weights = _weights()
+    legacy = _legacy_convert_product_weights(weights.copy())['weight'].astype(float).to_numpy()
+    converted = DataCleaning()._convert_product_weights(weights.copy())['weight'].astype(float).to_numpy()
+    assert np.array_equal(legacy, converted)
+
+
+def test_convert_product_weights_reports_unparsed_weights():
+    cleaner = DataCleaning()
+    converted = cleaner._convert_product_weights(pd.DataFrame({'weight': ['1kg', 'heavy', None]}))
+    assert converted['weight'].iloc[0] == 1.0
+    assert converted['weight'].iloc[1:].isna().all()
+    assert cleaner.unparsed_weights.tolist() == ['heavy']
+
+
+def test_register_weight_unit_only_changes_that_cleaner():
+    cleaner, other = DataCleaning(), DataCleaning()
+    cleaner.register_weight_unit('mg', units_per_kilogram=1000000)
+    assert cleaner._convert_product_weights(pd.DataFrame({'weight': ['500mg']}))['weight'].iloc[0] == 500 / 1000000
+    assert pd.isna(other._convert_product_weights(pd.DataFrame({'weight': ['500mg']}))['weight'].iloc[0])
+    assert 'mg' not in DataCleaning.WEIGHT_UNITS
+
+
+def test_clean_store_data_returns_the_stores_with_or_without_level_0():
+    stores = generate_stores(200)
+    without_level_0 = DataCleaning().clean_store_data(stores)
+    with_level_0 = DataCleaning().clean_store_data(stores.assign(level_0=range(len(stores))))
+    assert with_level_0 is not None and 'level_0' not in with_level_0.columns
+    pd.testing.assert_frame_equal(with_level_0, without_level_0)
+
+
+def test_standardize_phone_numbers_strips_prefixes_and_symbols_and_keeps_the_dtype():
+    df = pd.DataFrame({'country_code': ['GB', 'DE', 'US', 'GB', None],
+                       'phone_number': ['+44(0)20 7946 0958', '+49-30 1234567', '(212) 555-0100', '020.7946.0958',
+                                        '7946']})
+    expected = ['02079460958', '0301234567', '02125550100', '02079460958', '07946']
+    assert DataCleaning()._standardize_phone_numbers(df.copy())['phone_number'].tolist() == expected
+    categorical = DataCleaning()._standardize_phone_numbers(df.astype({'phone_number': 'category'}))['phone_number']
+    assert isinstance(categorical.dtype, pd.CategoricalDtype)
+    assert categorical.tolist() == expected
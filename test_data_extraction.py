@@ -0,0 +1,42 @@
+from data_extraction import DataExtractor
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+import data_extraction
+import pandas as pd
+import pytest
+
+
+class _Connector:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def init_db_engine(self):
+        return self.engine
+
+
+def test_stream_rds_table_yields_every_chunk():
+    engine = create_engine('sqlite://')
+    pd.DataFrame({'level_0': range(5), 'value': list('abcde')}).to_sql('orders', engine, index=False)
+    chunks = list(DataExtractor(None).stream_rds_table(_Connector(engine), 'orders', chunksize=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+
+def test_stream_rds_table_raises_when_the_connection_drops_mid_stream(monkeypatch):
+    def read_sql(query, connection, chunksize):
+        yield pd.DataFrame({'level_0': [0, 1]})
+        raise OperationalError('SELECT', {}, Exception('server closed the connection unexpectedly'))
+
+    monkeypatch.setattr(data_extraction.pd, 'read_sql', read_sql)
+    stream = DataExtractor(None).stream_rds_table(_Connector(create_engine('sqlite://')), 'orders')
+    assert len(next(stream)) == 2
+    with pytest.raises(OperationalError):
+        next(stream)
+
+
+def test_stream_rds_table_reports_a_connection_that_cannot_be_opened(capsys):
+    class _Unreachable:
+        def init_db_engine(self):
+            raise OperationalError('connect', {}, Exception('could not connect to server'))
+
+    assert list(DataExtractor(None).stream_rds_table(_Unreachable(), 'orders')) == []
+    assert "Error connecting to stream table 'orders'" in capsys.readouterr().out
@@ -0,0 +1,94 @@
+from database_utils import DatabaseConnector, _split_sql_script
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DataError
+from sqlalchemy.pool import StaticPool
+import pandas as pd
+import pytest
+
+
+def test_split_sql_script_labels_each_statement_with_its_comments():
+    script = "-- Stores per country\nSELECT 1;\n\n-- Sales per month\nSELECT 2;\n"
+    assert list(_split_sql_script(script)) == [('Stores per country', 'SELECT 1'), ('Sales per month', 'SELECT 2')]
+
+
+def test_split_sql_script_keeps_semicolons_inside_strings_and_identifiers():
+    script = "SELECT 'a;b', 'it''s; fine' AS \"odd;name\";\nSELECT 2;"
+    assert [query for _, query in _split_sql_script(script)] == [
+        "SELECT 'a;b', 'it''s; fine' AS \"odd;name\"", 'SELECT 2']
+
+
+def test_split_sql_script_keeps_semicolons_inside_dollar_quoted_bodies_and_comments():
+    script = ("CREATE FUNCTION f() RETURNS int AS $body$ BEGIN RETURN 1; END; $body$ LANGUAGE plpgsql;\n"
+              "DO $$ BEGIN PERFORM 1; END $$;\n"
+              "/* a; b */ SELECT 3; -- trailing; comment\n")
+    queries = [query for _, query in _split_sql_script(script)]
+    assert queries == [
+        'CREATE FUNCTION f() RETURNS int AS $body$ BEGIN RETURN 1; END; $body$ LANGUAGE plpgsql',
+        'DO $$ BEGIN PERFORM 1; END $$',
+        '/* a; b */ SELECT 3',
+    ]
+
+
+def _sqlite_connector(monkeypatch, fail_on=None):
+    # COPY is Postgres only, the rows are inserted instead; the transaction is what is tested
+    engine = create_engine('sqlite://', poolclass=StaticPool)
+    # pysqlite commits before DDL on its own; let SQLAlchemy issue BEGIN so DROP and CREATE can be rolled back
+    event.listen(engine, 'connect', lambda dbapi_connection, record: setattr(dbapi_connection, 'isolation_level', None))
+    event.listen(engine, 'begin', lambda connection: connection.exec_driver_sql('BEGIN'))
+    connector = DatabaseConnector()
+    monkeypatch.setattr(connector, 'get_engine', lambda target='source': engine)
+
+    def copy_rows(frame, table_name, connection, chunksize=100000):
+        if fail_on is not None and frame['store'].iloc[0] == fail_on:
+            raise DataError('COPY', {}, Exception('invalid input syntax'))
+        columns = ', '.join(f'"{column}"' for column in frame.columns)
+        values = ', '.join(f':{column}' for column in frame.columns)
+        connection.execute(text(f'INSERT INTO "{table_name}" ({columns}) VALUES ({values})'),
+                           frame.to_dict('records'))
+
+    monkeypatch.setattr(connector, 'copy_rows', copy_rows)
+    return connector, engine
+
+
+def _partitions(stores):
+    return [pd.DataFrame({'store': [store, store], 'staff': [1, 2]}) for store in stores]
+
+
+def test_replace_table_loads_every_frame_in_place_of_the_previous_table(monkeypatch):
+    connector, engine = _sqlite_connector(monkeypatch)
+    connector.replace_table('stores', _partitions(['old']))
+    assert connector.replace_table('stores', _partitions(['a', 'b', 'c'])) == 6
+    assert pd.read_sql('SELECT store FROM stores', engine)['store'].tolist() == ['a', 'a', 'b', 'b', 'c', 'c']
+
+
+def test_replace_table_keeps_the_previous_table_when_a_frame_fails(monkeypatch):
+    connector, engine = _sqlite_connector(monkeypatch, fail_on='b')
+    connector.replace_table('stores', _partitions(['old']))
+    with pytest.raises(DataError):
+        connector.replace_table('stores', _partitions(['a', 'b', 'c']))
+    assert pd.read_sql('SELECT store FROM stores', engine)['store'].tolist() == ['old', 'old']
+
+
+def test_replace_table_keeps_the_previous_table_without_rows(monkeypatch):
+    connector, engine = _sqlite_connector(monkeypatch)
+    connector.replace_table('stores', _partitions(['old']))
+    assert connector.replace_table('stores', []) == 0
+    assert len(pd.read_sql('SELECT store FROM stores', engine)) == 2
+
+
+def test_upload_to_db_falls_back_to_to_sql_without_copy_support(monkeypatch, caplog):
+    connector, engine = _sqlite_connector(monkeypatch)
+    with caplog.at_level('WARNING', logger='database_utils'):
+        connector.upload_to_db(_partitions(['a'])[0], 'stores')
+    assert pd.read_sql('SELECT store FROM stores', engine)['store'].tolist() == ['a', 'a']
+    assert "no COPY support, uploading 'stores' with to_sql" in caplog.text
+
+
+def test_upload_to_db_raises_a_failing_copy(monkeypatch):
+    connector, engine = _sqlite_connector(monkeypatch, fail_on='a')
+    # As if the driver were psycopg2, so that the rows go through copy_rows
+    monkeypatch.setattr(engine.dialect, 'driver', 'psycopg2')
+    with pytest.raises(DataError):
+        connector.upload_to_db(_partitions(['a'])[0], 'stores')
+    with engine.connect() as connection:
+        assert not engine.dialect.has_table(connection, 'stores')
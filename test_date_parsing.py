@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+from date_parsing import DateParser
+import pandas as pd
+import pickle
+
+
+def test_parse_reads_every_known_format_and_reports_the_rest_as_nat():
+    values = pd.Series(['2010-10-04', '1994/11/24', '2010 October 04', 'May 2003 27', 'GB', None, '2010-10-04'],
+                       index=range(10, 17), name='opening_date')
+    parsed = DateParser().parse(values)
+    expected = pd.to_datetime(['2010-10-04', '1994-11-24', '2010-10-04', '2003-05-27', None, None, '2010-10-04'])
+    assert parsed.index.equals(values.index) and parsed.name == 'opening_date'
+    assert parsed.tolist() == expected.tolist()
+
+
+def test_parse_gives_the_same_dates_with_the_strings_remembered_or_evicted():
+    parser = DateParser(max_cache_size=3)
+    values = pd.Series([f"2001-01-{day:02d}" for day in range(1, 29)] + ['1999/12/31'])
+    first = parser.parse(values)
+    assert len(parser._cache) <= 3
+    pd.testing.assert_series_equal(parser.parse(values), first)
+    pd.testing.assert_series_equal(parser.parse(values[::-1]), first[::-1])
+
+
+def test_parse_is_safe_to_share_between_threads():
+    parser = DateParser(max_cache_size=500)
+    chunks = [pd.Series([f"{2000 + (chunk + day) % 20}-{day % 12 + 1:02d}-{day % 28 + 1:02d}" for day in range(300)])
+              for chunk in range(40)]
+    expected = [DateParser().parse(chunk) for chunk in chunks]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        parsed = list(executor.map(parser.parse, chunks * 5))
+    for position, result in enumerate(parsed):
+        pd.testing.assert_series_equal(result, expected[position % len(chunks)])
+    assert parser._cache.index.is_unique
+
+
+def test_a_parser_can_be_pickled_with_what_it_remembers():
+    parser = DateParser()
+    parser.parse(pd.Series(['2010 October 04']))
+    copy = pickle.loads(pickle.dumps(parser))
+    assert copy._cache.equals(parser._cache)
+    assert copy.parse(pd.Series(['2010 October 04'])).tolist() == [pd.Timestamp('2010-10-04')]
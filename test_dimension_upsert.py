@@ -0,0 +1,32 @@
+from dimension_upsert import _fingerprints, _positional_columns
+import pandas as pd
+
+
+def _dates():
+    return pd.DataFrame({'month': pd.array([1, 2, None], dtype='Int64'), 'time_period': ['Evening', None, 'Late_Hours'],
+                         'date_uuid': ['a', 'b', 'c']})
+
+
+def test_fingerprints_do_not_depend_on_the_dtypes_a_column_is_cleaned_into():
+    dates = _dates()
+    compact = dates.astype({'month': 'Int8', 'time_period': 'category', 'date_uuid': 'string[pyarrow]'})
+    assert _fingerprints(dates).equals(_fingerprints(compact))
+
+
+def test_fingerprints_change_with_any_value_and_tell_missing_values_apart():
+    dates = _dates()
+    fingerprints = _fingerprints(dates)
+    assert fingerprints.is_unique
+    changed = dates.assign(time_period=['Evening', 'None', 'Late_Hours'])
+    assert (_fingerprints(changed) != fingerprints).tolist() == [False, True, False]
+
+
+def test_positional_columns_leave_renumbered_rows_unchanged():
+    dates = _dates()
+    renumbered = dates.iloc[1:]
+    renumbered.index = range(len(renumbered))
+    assert _positional_columns(dates) == ['index']
+    fingerprint = lambda df: _fingerprints(df.reset_index().drop(columns=_positional_columns(df)))
+    assert fingerprint(renumbered).tolist() == fingerprint(dates).iloc[1:].tolist()
+    # A frame that already has an 'index' column from its source is numbered in 'level_0'
+    assert _positional_columns(dates.assign(index=[7, 8, 9])) == ['level_0']
@@ -0,0 +1,43 @@
+from instrumentation import instrumentation, instrumented
+import pandas as pd
+
+
+class _Extractor:
+    @instrumented
+    def stream(self, chunks):
+        for number in range(chunks):
+            instrumentation.record_bytes(100)
+            yield pd.DataFrame({'value': [number, number]})
+
+
+class _Loader:
+    @instrumented
+    def load(self, extractor):
+        rows = 0
+        for chunk in extractor.stream(3):
+            instrumentation.record_bytes(1)
+            rows += len(chunk)
+        return rows
+
+
+def _record(step):
+    return next(record for record in instrumentation.records if record['step'] == step)
+
+
+def test_streamed_bytes_are_credited_to_the_generator_not_its_consumer():
+    instrumentation.reset()
+    assert _Loader().load(_Extractor()) == 6
+    stream, load = _record('_Extractor.stream'), _record('_Loader.load')
+    assert stream['bytes'] == 300
+    assert stream['rows_out'] == 6
+    assert stream['parent'] == '_Loader.load'
+    assert load['bytes'] == 3
+
+
+def test_a_generator_closed_early_is_still_recorded():
+    instrumentation.reset()
+    chunks = _Extractor().stream(3)
+    next(chunks)
+    chunks.close()
+    assert _record('_Extractor.stream')['bytes'] == 100
+    assert instrumentation._stack() == []
@@ -0,0 +1,57 @@
+from main import STAGES, parse_args, selected_stages
+import os
+import pytest
+import subprocess
+import sys
+
+
+# The modules build_run imports, and the libraries they bring in, none of which --dry-run needs
+PIPELINE_MODULES = ('compact_dtypes', 'data_extraction', 'data_cleaning', 'database_utils', 'dimension_upsert',
+                    'incremental_load', 'instrumentation', 'parallel_cleaning', 'rollups', 'source_cache', 'staging',
+                    'table_schemas', 'pandas', 'sqlalchemy', 'pyarrow', 'boto3', 'tabula', 'requests', 'pypdf')
+
+
+def test_parse_args_runs_every_stage_without_a_command():
+    args = parse_args([])
+    assert args.command is None and not args.dry_run
+    assert selected_stages(args) == (None, [])
+
+
+def test_a_command_runs_its_chain_then_the_star_schema_and_rollups():
+    args = parse_args(['orders', '--incremental', '--skip', 'rollups'])
+    assert args.command == 'orders' and args.incremental
+    assert selected_stages(args) == (['orders', 'star_schema', 'rollups'], ['rollups'])
+
+
+def test_options_given_before_a_command_are_kept():
+    args = parse_args(['--workers', '2', '--compact', 'cards', '--dry-run'])
+    assert (args.command, args.workers, args.compact, args.dry_run) == ('cards', 2, True, True)
+
+
+def test_only_selects_stages():
+    args = parse_args(['--only', 'users', 'star_schema'])
+    assert selected_stages(args) == (['users', 'star_schema'], [])
+
+
+@pytest.mark.parametrize('argv', [['--only', 'customers'], ['--skip', 'loads'], ['users', '--only', 'users'],
+                                  ['--only', 'users', 'orders', 'cards', 'users_table']])
+def test_parse_args_rejects_unknown_stages_and_only_with_a_command(argv, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        parse_args(argv)
+    assert exit_info.value.code == 2
+    assert 'error' in capsys.readouterr().err
+
+
+def test_every_stage_can_be_selected():
+    assert parse_args(['--only'] + STAGES).only == STAGES
+
+
+def test_dry_run_imports_none_of_the_pipeline_modules():
+    script = ("import sys, main\n"
+              "main.main(['orders', '--dry-run'])\n"
+              f"print(sorted(module for module in {PIPELINE_MODULES!r} if module in sys.modules))\n")
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    lines = result.stdout.splitlines()
+    assert lines[0].startswith('Dry run: 3 stages would run')
+    assert lines[-1] == '[]'
@@ -0,0 +1,41 @@
+from data_cleaning import DataCleaning
+from instrumentation import instrumentation
+from parallel_cleaning import PartitionedCleaner
+from synthetic_data import generate_cards, generate_products
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def parallel_cleaner():
+    with PartitionedCleaner(DataCleaning(), workers=2, min_partition_rows=100) as cleaner:
+        yield cleaner
+
+
+def _steps(records):
+    return sorted((record['step'], record['parent'], record['rows_in'], record['rows_out']) for record in records)
+
+
+@pytest.mark.parametrize('method_name, df', [('clean_card_data', generate_cards(2000)),
+                                             ('clean_product_data', generate_products(2000))])
+def test_parallel_run_reports_the_same_as_a_serial_run(parallel_cleaner, method_name, df):
+    serial_cleaner = DataCleaning()
+    instrumentation.reset()
+    serial = getattr(serial_cleaner, method_name)(df)
+    serial_records = instrumentation.records
+    instrumentation.reset()
+    parallel = parallel_cleaner.run(method_name, df)
+    pd.testing.assert_frame_equal(parallel, serial)
+    for name in PartitionedCleaner.DIAGNOSTIC_ATTRIBUTES:
+        expected = getattr(serial_cleaner, name, None)
+        merged = getattr(parallel_cleaner.cleaner, name, None)
+        if isinstance(expected, dict):
+            assert expected.keys() == merged.keys()
+            for column in expected:
+                pd.testing.assert_series_equal(merged[column], expected[column])
+        elif expected is not None:
+            pd.testing.assert_series_equal(merged, expected)
+    # Every step ran once per partition, with the rows of the whole frame
+    per_step = lambda records: {step: sum(record['rows_in'] or 0 for record in records if record['step'] == step)
+                                for step in {record['step'] for record in records}}
+    assert per_step(instrumentation.records) == per_step(serial_records)
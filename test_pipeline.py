@@ -0,0 +1,65 @@
+from pipeline import Pipeline
+import pytest
+import threading
+
+
+def _pipeline(calls, fail=()):
+    lock = threading.Lock()
+
+    def stage(name):
+        def run():
+            if name in fail:
+                raise RuntimeError(f"{name} broke")
+            with lock:
+                calls.append(name)
+        return run
+
+    pipeline = Pipeline(max_workers=4)
+    pipeline.add_stage('users', stage('users'))
+    pipeline.add_stage('orders', stage('orders'))
+    pipeline.add_stage('star_schema', stage('star_schema'), depends_on=['users', 'orders'])
+    pipeline.add_stage('rollups', stage('rollups'), depends_on=['star_schema'])
+    return pipeline
+
+
+def test_run_runs_each_stage_after_its_dependencies():
+    calls = []
+    pipeline = _pipeline(calls)
+    assert pipeline.run()
+    assert sorted(calls[:2]) == ['orders', 'users'] and calls[2:] == ['star_schema', 'rollups']
+    assert {stage.status for stage in pipeline.stages.values()} == {'done'}
+
+
+def test_run_blocks_the_dependents_of_a_failed_stage():
+    calls = []
+    pipeline = _pipeline(calls, fail=('orders',))
+    assert not pipeline.run()
+    assert calls == ['users']
+    assert {name: stage.status for name, stage in pipeline.stages.items()} == {
+        'users': 'done', 'orders': 'failed', 'star_schema': 'blocked', 'rollups': 'blocked'}
+    assert str(pipeline.stages['orders'].error) == 'orders broke'
+
+
+def test_stages_left_out_count_as_satisfied_dependencies():
+    calls = []
+    pipeline = _pipeline(calls)
+    assert pipeline.plan(skip=['users', 'orders']) == ['star_schema', 'rollups']
+    assert pipeline.run(only=['star_schema', 'rollups'])
+    assert calls == ['star_schema', 'rollups']
+    assert pipeline.stages['users'].status == 'skipped'
+
+
+def test_unknown_stages_are_rejected():
+    pipeline = _pipeline([])
+    with pytest.raises(ValueError, match='Unknown stages: loads'):
+        pipeline.plan(only=['loads'])
+    with pytest.raises(ValueError, match="depends on unknown stage 'products'"):
+        pipeline.add_stage('report', lambda: None, depends_on=['products'])
+
+
+def test_critical_path_follows_the_longest_chain_of_the_last_run():
+    pipeline = _pipeline([])
+    pipeline.run()
+    for name, seconds in (('users', 1.0), ('orders', 3.0), ('star_schema', 0.5), ('rollups', 0.25)):
+        pipeline.stages[name].duration = seconds
+    assert pipeline.critical_path() == (['orders', 'star_schema', 'rollups'], 3.75)
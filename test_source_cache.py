@@ -0,0 +1,97 @@
+from source_cache import SourceCache
+import os
+import pandas as pd
+import pytest
+import shutil
+
+
+def _source(tmp_path, text='product,price\na,1\nb,2\n'):
+    path = tmp_path / 'products.csv'
+    path.write_text(text)
+    return str(path)
+
+
+def _counting_parser(parsed):
+    def parse(path):
+        parsed.append(path)
+        return pd.read_csv(path)
+    return parse
+
+
+def test_get_frame_parses_an_unchanged_source_once(tmp_path):
+    source, parsed = _source(tmp_path), []
+    cache = SourceCache(str(tmp_path / 'cache'))
+    first = cache.get_frame(source, _counting_parser(parsed))
+    pd.testing.assert_frame_equal(SourceCache(str(tmp_path / 'cache')).get_frame(source, _counting_parser(parsed)),
+                                  first)
+    assert parsed == [source]
+
+
+def test_get_frame_parses_a_changed_source_again(tmp_path):
+    source, parsed = _source(tmp_path), []
+    cache = SourceCache(str(tmp_path / 'cache'))
+    cache.get_frame(source, _counting_parser(parsed))
+    _source(tmp_path, 'product,price\na,1\nb,2\nc,3\n')
+    assert len(cache.get_frame(source, _counting_parser(parsed))) == 3
+    assert len(parsed) == 2
+
+
+def test_bypass_neither_reads_nor_writes_the_cache(tmp_path):
+    source, parsed = _source(tmp_path), []
+    cache = SourceCache(str(tmp_path / 'cache'), bypass=True)
+    cache.get_frame(source, _counting_parser(parsed))
+    cache.get_frame(source, _counting_parser(parsed))
+    assert len(parsed) == 2
+    assert not os.path.exists(tmp_path / 'cache')
+
+
+def test_least_recently_used_entries_are_evicted_beyond_max_bytes(tmp_path):
+    cache = SourceCache(str(tmp_path / 'cache'))
+    sources = []
+    for name in ('first', 'second'):
+        path = tmp_path / f'{name}.csv'
+        path.write_text('product,price\na,1\n')
+        sources.append(str(path))
+        cache.get_frame(str(path), pd.read_csv)
+        # Room for one entry only
+        cache.max_bytes = sum(sum(entry['files'].values()) for entry in cache._read_index().values())
+    assert [entry['url'] for entry in cache._read_index().values()] == [sources[1]]
+    assert len([name for name in os.listdir(tmp_path / 'cache') if name.endswith('.pkl')]) == 1
+
+
+def test_get_frame_parses_again_with_a_different_parser(tmp_path):
+    source, parsed = _source(tmp_path), []
+    cache = SourceCache(str(tmp_path / 'cache'))
+    cache.get_frame(source, pd.read_csv)
+    cache.get_frame(source, _counting_parser(parsed))
+    assert parsed == [source]
+
+
+def test_a_failed_parse_removes_the_download(tmp_path, monkeypatch):
+    source = _source(tmp_path)
+    cache = SourceCache(str(tmp_path / 'cache'))
+    download = str(tmp_path / 'cache' / 'products.download')
+    monkeypatch.setattr(cache, 'validator', lambda url: None)
+    monkeypatch.setattr(cache, '_fetch_raw', lambda url: shutil.copy(source, download))
+
+    def parse(path):
+        raise ValueError('not a CSV')
+    with pytest.raises(ValueError):
+        cache.get_frame('https://example.com/products.csv', parse)
+    assert not os.path.exists(download)
+    assert cache._read_index() == {}
+
+
+def test_load_misses_an_entry_evicted_while_it_is_read(tmp_path, monkeypatch):
+    source = _source(tmp_path)
+    cache = SourceCache(str(tmp_path / 'cache'))
+    cache.get_frame(source, pd.read_csv)
+    key = next(iter(cache._read_index()))
+    write_index = cache._write_index
+
+    # Another thread evicts the entry once _load has found it in the index
+    def write_index_then_evict(index):
+        write_index(index)
+        os.remove(os.path.join(cache.cache_dir, f"{key}.pkl"))
+    monkeypatch.setattr(cache, '_write_index', write_index_then_evict)
+    assert cache._load(key) is None
@@ -0,0 +1,57 @@
+from staging import StagingArea
+import os
+import pandas as pd
+import pytest
+
+
+def _chunks(fail_after=None):
+    for number in range(3):
+        if number == fail_after:
+            raise ConnectionError('server closed the connection unexpectedly')
+        yield pd.DataFrame({'country_code': ['GB', 'DE'], 'staff_numbers': [number, number + 1]})
+
+
+def test_stage_records_every_chunk_in_the_manifest(tmp_path):
+    staging = StagingArea(str(tmp_path))
+    assert staging.stage('dim_store_details', _chunks(), 'v1') == 6
+    assert staging.is_current('dim_store_details', 'v1')
+    entry = staging.manifest()['dim_store_details']
+    assert entry['partitions'] == {'country_code=DE': 3, 'country_code=GB': 3}
+    assert entry['dtypes'] == {'country_code': 'object', 'staff_numbers': 'int64'}
+    assert sum(len(df) for df in staging.read_partitions('dim_store_details')) == 6
+
+
+def test_stage_keeps_the_previous_version_when_the_chunks_fail(tmp_path):
+    staging = StagingArea(str(tmp_path))
+    staging.stage('dim_store_details', _chunks(), 'v1')
+    with pytest.raises(ConnectionError):
+        staging.stage('dim_store_details', _chunks(fail_after=2), 'v2')
+    assert not staging.is_current('dim_store_details', 'v2')
+    assert staging.is_current('dim_store_details', 'v1')
+    assert staging.manifest()['dim_store_details']['rows'] == 6
+    assert sorted(os.listdir(tmp_path)) == ['dim_store_details', 'manifest.json']
+
+
+def test_stage_never_records_a_table_whose_first_stream_fails(tmp_path):
+    staging = StagingArea(str(tmp_path))
+    with pytest.raises(ConnectionError):
+        staging.stage('dim_store_details', _chunks(fail_after=1), 'v1')
+    assert not staging.is_current('dim_store_details', 'v1')
+    assert 'dim_store_details' not in staging.manifest()
+
+
+def test_stage_casts_every_chunk_to_the_dtypes_of_the_first(tmp_path):
+    staging = StagingArea(str(tmp_path))
+    chunks = [pd.DataFrame({'staff_numbers': [1.0, 2.0]}), pd.DataFrame({'staff_numbers': [3, 4]})]
+    staging.stage('dim_store_details', chunks, 'v1')
+    staged = pd.concat(staging.read_partitions('dim_store_details'))
+    assert staged['staff_numbers'].dtype == 'float64'
+    assert staged['staff_numbers'].tolist() == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_stage_rejects_a_chunk_that_does_not_fit_the_dtypes_of_the_first(tmp_path):
+    staging = StagingArea(str(tmp_path))
+    chunks = [pd.DataFrame({'staff_numbers': [1, 2]}), pd.DataFrame({'staff_numbers': ['3', 'many']})]
+    with pytest.raises(ValueError, match="cannot be staged as int64"):
+        staging.stage('dim_store_details', chunks, 'v1')
+    assert 'dim_store_details' not in staging.manifest()